@@ -0,0 +1,172 @@
+
+import argparse
+import json
+import math
+import os
+from pathlib import Path
+import sys
+import tempfile
+import time
+
+from mock_ica import CREATED, PROJECT_ID, MockICA, serve
+
+def get_args():
+    parser = argparse.ArgumentParser(description='benchmark icapy against a ' \
+                                     'local mock ICA server')
+    parser.add_argument('--files', type=int, default=5000,
+                        help='number of files in the listed folder (default=5000).')
+    parser.add_argument('--folders', type=int, default=20,
+                        help='number of folders to resolve paths across (default=20).')
+    parser.add_argument('--paths', type=int, default=200,
+                        help='number of paths to resolve (default=200).')
+    parser.add_argument('--analyses', type=int, default=5000,
+                        help='number of analyses to search (default=5000).')
+    parser.add_argument('--size', type=int, default=64,
+                        help='size of files to download and upload, in MB (default=64).')
+    parser.add_argument('--page-size', type=int, default=1000,
+                        help='largest page the server returns (default=1000).')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='seconds of latency for each API call (default=0.005).')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of API calls to fail with 429/503 (default=0).')
+    parser.add_argument('--deletes', type=int, default=500,
+                        help='number of files to delete concurrently (default=500).')
+    parser.add_argument('--max-concurrency', type=int, default=4,
+                        help='most API calls the server answers at once while ' \
+                             'deleting, with 429s for the rest (default=4).')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--check', default=False, action='store_true',
+                        help='fail if an operation makes more API calls than ' \
+                             'expected (only without injected errors)')
+    return parser.parse_args()
+
+def setup(home: str, base_url: str):
+    ''' point icapy at the mock server, with a config which won't prompt
+    '''
+    os.environ['HOME'] = home
+    os.environ['ICA_BASE_URL'] = base_url
+    config = Path(home) / '.config' / 'ica'
+    config.mkdir(parents=True)
+    with open(config / 'config.json', 'w') as handle:
+        json.dump({'ica_api_key': 'key', 'tenant': 'tenant',
+                   'ica_project_id': PROJECT_ID}, handle)
+
+def measure(state: MockICA, func):
+    ''' run a function, and get (result, seconds taken, API calls made)
+    '''
+    state.reset_calls()
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start, state.calls
+
+def run(args, state: MockICA, workdir: str):
+    ''' run each benchmark, and get rows of (name, value, unit, calls, max calls)
+    '''
+    # imported after setup, so the API location is read from ICA_BASE_URL
+    from icapy.cache import set_cache_enabled
+    from icapy.find import build_index, refresh_index
+    from icapy.index import get_index
+    from icapy.data import (create_download_url,
+                            delete_files,
+                            list_files,
+                            resolve_paths,
+                            upload_file,
+                            )
+    from icapy.jobs import get_analyses
+    from icapy.transfer import MB, download_to_file
+    set_cache_enabled(False)
+    
+    results = []
+    pages = math.ceil(args.files / args.page_size)
+    items, elapsed, calls = measure(state, lambda: list(list_files('/listing')))
+    assert len(items) == args.files
+    results.append(('listing', len(items) / elapsed, 'items/s', calls, pages + 1))
+    
+    paths = [f'/resolve/folder_{i % args.folders:03d}/file_{i:06d}.txt'
+             for i in range(args.paths)]
+    (found, _), elapsed, calls = measure(state, lambda: resolve_paths(paths))
+    assert all(len(found[x]) == 1 for x in paths)
+    results.append(('resolve', calls / len(paths), 'calls/path', calls,
+                    2 * min(args.folders, args.paths)))
+    
+    jobs, elapsed, calls = measure(state, lambda: list(get_analyses(max_jobs=args.analyses)))
+    assert len(jobs) == args.analyses
+    results.append(('analyses', len(jobs) / elapsed, 'items/s', calls,
+                    math.ceil(args.analyses / args.page_size) + 1))
+    
+    size = args.size * MB
+    item = state.add_file('/transfer/download.bin', size)
+    local = Path(workdir) / 'download.bin'
+    def download():
+        download_to_file(create_download_url(item['id']), size, local)
+    _, elapsed, calls = measure(state, download)
+    results.append(('download', size / MB / elapsed, 'MB/s', calls, 1))
+    
+    state.add_folder('/upload/')
+    upload = lambda: upload_file(str(local), Path('/upload/upload.bin'))
+    _, elapsed, calls = measure(state, upload)
+    assert state.paths['/upload/upload.bin']['size'] == size
+    results.append(('upload', size / MB / elapsed, 'MB/s', calls, 3))
+    
+    # many concurrent deletes against a server which rejects excess calls,
+    # which should slow down to the server's limit rather than fail
+    paths = [state.add_file(f'/bulk/file_{i:06d}.txt', 10)['path']
+             for i in range(args.deletes)]
+    state.max_concurrency = args.max_concurrency
+    (total, failed), elapsed, calls = measure(state, lambda: delete_files(paths, threads=32))
+    state.max_concurrency = 0
+    assert len(failed) == 0 and total == args.deletes
+    results.append(('bulk delete', total / elapsed, 'items/s', calls,
+                    2 * args.deletes + 1))
+    print(f'bulk delete: {state.rejected} calls rejected with 429')
+    
+    # index the whole project, then refresh it with only the newer data
+    for item in state.objects.values():
+        item['created'] = CREATED
+    folders = sum(x['type'] == 'FOLDER' for x in state.objects.values())
+    total, elapsed, calls = measure(state, lambda: build_index(PROJECT_ID))
+    results.append(('index build', total / elapsed, 'items/s', calls,
+                    folders + math.ceil(len(state.objects) / args.page_size)))
+    state.add_file('/listing/new.txt', 10)
+    total, elapsed, calls = measure(state, lambda: refresh_index(PROJECT_ID))
+    assert total == 1
+    results.append(('index refresh', elapsed * 1000, 'ms', calls, 1))
+    
+    search = lambda: list(get_index().search([PROJECT_ID], '/listing', '*_0001*.txt',
+                                             data_type='FILE', larger=100))
+    found, elapsed, calls = measure(state, search)
+    assert len(found) == 100
+    results.append(('find', elapsed * 1000, 'ms', calls, 0))
+    return results
+
+def main():
+    args = get_args()
+    state = MockICA(args.latency, max_page_size=args.page_size,
+                    error_rate=args.error_rate)
+    for i in range(args.files):
+        state.add_file(f'/listing/file_{i:06d}.txt', 1024)
+    for i in range(args.paths):
+        state.add_file(f'/resolve/folder_{i % args.folders:03d}/file_{i:06d}.txt', 1024)
+    state.add_analyses(args.analyses)
+    
+    server = serve(state)
+    with tempfile.TemporaryDirectory() as workdir:
+        setup(workdir, f'http://127.0.0.1:{server.server_address[1]}/ica/rest/')
+        results = run(args, state, workdir)
+    server.shutdown()
+    
+    failed = False
+    for name, value, unit, calls, max_calls in results:
+        print(f'{name}:\t{value:.1f} {unit}\t({calls} API calls)')
+        if args.check and args.error_rate == 0 and calls > max_calls:
+            print(f'error: {name} made {calls} API calls, expected at most {max_calls}')
+            failed = True
+    
+    if args.output is not None:
+        with open(args.output, 'w') as handle:
+            json.dump([dict(zip(['name', 'value', 'unit', 'calls', 'max_calls'], x))
+                       for x in results], handle, indent=True)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
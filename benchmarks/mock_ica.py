@@ -0,0 +1,359 @@
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import re
+import threading
+import time
+from typing import Any, Dict, List
+from urllib.parse import parse_qs, urlsplit
+
+PROJECT_ID = 'a1b2c3d4-0000-0000-0000-000000000001'
+CREATED = '2024-01-01T00:00:00Z'
+
+# repeated to make the contents of large objects, without holding them in memory
+PATTERN = bytes(random.Random(0).randrange(256) for _ in range(65536))
+
+def object_bytes(size: int, start: int, end: int) -> bytes:
+    ''' get bytes start-end (inclusive) of a generated object of a given size
+    '''
+    end = min(end, size - 1)
+    offset = start % len(PATTERN)
+    repeats = (end - start + 1 + offset) // len(PATTERN) + 1
+    return (PATTERN * repeats)[offset:offset + end - start + 1]
+
+class MockICA:
+    ''' state and settings for a local stand-in for the ICA API
+    
+    This emulates the endpoints the ica CLI uses: tokens, projects, data listing
+    and lookup, file/folder creation, download/upload URLs, and analysis
+    searches. Presigned URLs point back at the server (under /blob/), and
+    support byte ranges.
+    
+    Args:
+        latency: seconds to wait before answering each API call
+        blob_latency: seconds to wait before answering each presigned URL call
+        max_page_size: largest page returned by paginated endpoints
+        error_rate: fraction of API calls answered with a 429 or 503 error
+        max_concurrency: most API calls answered at once (others get a 429),
+            or 0 for no limit
+    '''
+    def __init__(self, latency: float=0.0, blob_latency: float=0.0,
+                 max_page_size: int=1000, error_rate: float=0.0,
+                 max_concurrency: int=0):
+        self.latency = latency
+        self.blob_latency = blob_latency
+        self.max_page_size = max_page_size
+        self.error_rate = error_rate
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+        self.random = random.Random(1)
+        self.objects = {}
+        self.paths = {}
+        self.children = {}
+        self.analyses = []
+        self.calls = 0
+        self.blob_calls = 0
+        self.count = 0
+        self.add_folder('/')
+    
+    def reset_calls(self):
+        with self.lock:
+            self.calls = 0
+            self.blob_calls = 0
+            self.rejected = 0
+    
+    def new_id(self, prefix: str) -> str:
+        with self.lock:
+            self.count += 1
+            return f'{prefix}.{self.count:012x}'
+    
+    def add_folder(self, path: str) -> Dict[str, Any]:
+        ''' add a folder (and any missing parent folders)
+        '''
+        path = path.rstrip('/') + '/'
+        if path in self.paths:
+            return self.paths[path]
+        parent = None
+        if path != '/':
+            parent = self.add_folder(path.rstrip('/').rsplit('/', 1)[0] + '/')['id']
+        return self.add_object(path, 'FOLDER', 0, parent)
+    
+    def add_file(self, path: str, size: int=0) -> Dict[str, Any]:
+        ''' add a file, with generated contents of the given size
+        '''
+        parent = self.add_folder(path.rsplit('/', 1)[0] + '/')
+        return self.add_object(path, 'FILE', size, parent['id'])
+    
+    def add_object(self, path: str, kind: str, size: int, parent: str | None) -> Dict[str, Any]:
+        item = {'id': self.new_id('fil' if kind == 'FILE' else 'fol'),
+                'path': path,
+                'name': path.rstrip('/').rsplit('/', 1)[-1],
+                'type': kind,
+                'size': size,
+                'parent': parent,
+                'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                }
+        with self.lock:
+            self.objects[item['id']] = item
+            self.paths[path] = item
+            self.children.setdefault(parent, []).append(item)
+        return item
+    
+    def remove(self, item: Dict[str, Any]):
+        with self.lock:
+            for x in [x for x in self.objects.values() if x['path'].startswith(item['path'])]:
+                del self.objects[x['id']]
+                del self.paths[x['path']]
+                self.children[x['parent']].remove(x)
+    
+    def add_analyses(self, count: int):
+        ''' add analyses, with a mix of statuses
+        '''
+        statuses = ['SUCCEEDED', 'FAILED', 'IN_PROGRESS', 'QUEUED', 'ABORTED']
+        for i in range(count):
+            self.analyses.append({
+                'id': f'analysis-{i:08d}',
+                'userReference': f'run-{i}',
+                'status': statuses[i % len(statuses)],
+                'pipeline': {'code': f'pipeline-{i % 3}'},
+                'tags': {'userTags': [f'tag-{i % 7}'], 'technicalTags': [],
+                         'referenceTags': []},
+                'timeCreated': f'2024-01-01T00:{i // 60 % 60:02d}:{i % 60:02d}Z',
+                'timeModified': CREATED,
+            })
+    
+    def details(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        ''' format an object like the ICA data endpoints
+        '''
+        return {'data': {'id': item['id'], 'details': {
+            'name': item['name'],
+            'path': item['path'],
+            'timeCreated': item['created'],
+            'timeModified': item['created'],
+            'fileSizeInBytes': item['size'],
+            'dataType': item['type'],
+            'status': item.get('status', 'AVAILABLE'),
+        }}, 'projectId': PROJECT_ID}
+    
+    def page(self, items: List[Any], query: Dict[str, List[str]]) -> Dict[str, Any]:
+        ''' get one page of items, limited by the maximum page size
+        '''
+        offset = int(query.get('pageOffset', ['0'])[0])
+        size = min(int(query.get('pageSize', ['10'])[0]), self.max_page_size)
+        return {'items': items[offset:offset + size], 'totalItemCount': len(items)}
+    
+    def list_data(self, query: Dict[str, List[str]]) -> Dict[str, Any]:
+        if 'parentFolderId' in query:
+            items = self.children.get(query['parentFolderId'][0], [])
+        elif 'parentFolderPath' in query:
+            parent = self.paths.get(query['parentFolderPath'][0])
+            items = self.children.get(parent['id'], []) if parent is not None else []
+        else:
+            # without a folder, everything in the project is listed
+            items = [x for x in self.objects.values() if x['path'] != '/']
+        if 'creationDateAfter' in query:
+            items = [x for x in items if x['created'] > query['creationDateAfter'][0]]
+        names = query.get('filename')
+        if names is not None:
+            if query.get('filenameMatchMode', ['EXACT'])[0] == 'EXACT':
+                items = [x for x in items if x['name'] in names]
+            else:
+                items = [x for x in items if any(n in x['name'] for n in names)]
+        if 'type' in query:
+            items = [x for x in items if x['type'] == query['type'][0]]
+        items = sorted(items, key=lambda x: x['path'])
+        page = self.page(items, query)
+        page['items'] = [self.details(x) for x in page['items']]
+        return page
+    
+    def search_analyses(self, query: Dict[str, List[str]], body: Dict) -> Dict[str, Any]:
+        items = self.analyses
+        if body.get('statuses'):
+            items = [x for x in items if x['status'] in body['statuses']]
+        if body.get('pipelineCodes'):
+            items = [x for x in items if x['pipeline']['code'] in body['pipelineCodes']]
+        items = sorted(items, key=lambda x: x['timeCreated'], reverse=True)
+        return self.page(items, query)
+
+class Handler(BaseHTTPRequestHandler):
+    ''' route requests to the mock ICA endpoints
+    '''
+    protocol_version = 'HTTP/1.1'
+    state: MockICA = None
+    
+    def log_message(self, *args):
+        pass
+    
+    def send(self, status: int, data: Any=None, body: bytes=None,
+             headers: Dict[str, str]=None):
+        if body is None:
+            body = json.dumps(data).encode('utf8') if data is not None else b''
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        if data is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+    
+    def read_body(self) -> bytes:
+        size = int(self.headers.get('Content-Length') or 0)
+        if size > 0:
+            return self.rfile.read(size)
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            chunks = []
+            while True:
+                length = int(self.rfile.readline().strip(), 16)
+                chunks.append(self.rfile.read(length))
+                self.rfile.readline()
+                if length == 0:
+                    return b''.join(chunks)
+        return b''
+    
+    def handle_request(self):
+        state = self.state
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query, keep_blank_values=True)
+        body = self.read_body() if self.command in ('POST', 'PUT') else b''
+        
+        if parts.path.startswith('/blob/'):
+            with state.lock:
+                state.blob_calls += 1
+            time.sleep(state.blob_latency)
+            return self.blob(parts.path.split('/')[2], body)
+        
+        with state.lock:
+            state.calls += 1
+            state.active += 1
+            limited = 0 < state.max_concurrency < state.active
+            state.rejected += limited
+        try:
+            if limited:
+                return self.send(429, {'error': 'too many requests'},
+                                 headers={'Retry-After': '0'})
+            time.sleep(state.latency)
+            return self.api(state, parts, query, body)
+        finally:
+            with state.lock:
+                state.active -= 1
+    
+    def api(self, state: MockICA, parts, query: Dict[str, List[str]], body: bytes):
+        ''' answer a call to an API endpoint
+        '''
+        if state.error_rate > 0 and state.random.random() < state.error_rate:
+            status = state.random.choice([429, 503])
+            return self.send(status, {'error': 'injected'}, headers={'Retry-After': '0'})
+        
+        path = parts.path.split('/ica/rest/', 1)[-1]
+        data = json.loads(body) if body and self.command == 'POST' else {}
+        host = f'http://{self.headers["Host"]}'
+        
+        if path == 'api/tokens':
+            return self.send(200, {'token': 'mock-token'})
+        if path == 'api/projects':
+            projects = [{'id': PROJECT_ID, 'name': 'benchmark'}]
+            return self.send(200, state.page(projects, query))
+        
+        match = re.match(r'api/projects/[^/]+/(.+)$', path)
+        if match is None:
+            return self.send(404, {'error': f'unknown endpoint: {path}'})
+        endpoint = match.group(1)
+        
+        if endpoint == 'data' and self.command == 'GET':
+            return self.send(200, state.list_data(query))
+        if endpoint in ('data:createFile', 'data:createFileWithUploadUrl'):
+            folder = state.objects[data['folderId']]
+            path = folder['path'] + data['name']
+            if path in state.paths:
+                return self.send(409, {'error': 'file exists'})
+            item = state.add_file(path)
+            item['status'] = 'PARTIAL'  # until the data is uploaded
+            return self.send(201, {'uploadUrl': f'{host}/blob/{item["id"]}',
+                                   **state.details(item)})
+        if endpoint == 'data:createFolder':
+            item = state.add_folder(data['folderPath'] + data['name'])
+            return self.send(201, state.details(item))
+        if endpoint == 'analysis:search':
+            return self.send(200, state.search_analyses(query, data))
+        
+        match = re.match(r'analyses/([^/]+)$', endpoint)
+        if match is not None:
+            found = [x for x in state.analyses if x['id'] == match.group(1)]
+            return self.send(200, found[0]) if found else self.send(404, {})
+        
+        match = re.match(r'data/([^/:]+)(:(\w+))?$', endpoint)
+        if match is None or match.group(1) not in state.objects:
+            return self.send(404, {'error': f'unknown endpoint: {endpoint}'})
+        item = state.objects[match.group(1)]
+        action = match.group(3)
+        if action is None:
+            return self.send(200, state.details(item))
+        if action in ('createDownloadUrl', 'createUploadUrl'):
+            return self.send(200, {'url': f'{host}/blob/{item["id"]}'})
+        if action == 'delete':
+            state.remove(item)
+            return self.send(204)
+        return self.send(404, {'error': f'unknown action: {action}'})
+    
+    def blob(self, data_id: str, body: bytes):
+        ''' emulate a presigned URL for an object
+        '''
+        item = self.state.objects.get(data_id)
+        if item is None:
+            return self.send(404, {'error': 'no such object'})
+        if self.command == 'PUT':
+            item['size'] = len(body)
+            item['status'] = 'AVAILABLE'
+            return self.send(200)
+        
+        size = item['size']
+        byte_range = self.headers.get('Range')
+        if byte_range is None:
+            return self.send(200, body=object_bytes(size, 0, size - 1))
+        start, end = byte_range.split('=')[1].split('-')
+        start, end = int(start), min(int(end or size - 1), size - 1)
+        return self.send(206, body=object_bytes(size, start, end),
+                         headers={'Content-Range': f'bytes {start}-{end}/{size}'})
+    
+    def do_GET(self):
+        self.handle_request()
+    
+    def do_HEAD(self):
+        self.handle_request()
+    
+    def do_POST(self):
+        self.handle_request()
+    
+    def do_PUT(self):
+        self.handle_request()
+
+def serve(state: MockICA, port: int=0) -> ThreadingHTTPServer:
+    ''' run a mock ICA server in a background thread
+    
+    The API base URL (e.g. for ICA_BASE_URL) is f'http://127.0.0.1:{port}/ica/rest/'
+    '''
+    handler = type('MockHandler', (Handler, ), {'state': state})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='run a mock ICA server')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--files', type=int, default=100)
+    args = parser.parse_args()
+    state = MockICA(args.latency, error_rate=args.error_rate)
+    for i in range(args.files):
+        state.add_file(f'/data/file_{i:06d}.txt', 1024)
+    server = serve(state, args.port)
+    print(f'ICA_BASE_URL=http://127.0.0.1:{server.server_address[1]}/ica/rest/')
+    threading.Event().wait()
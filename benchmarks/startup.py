@@ -0,0 +1,79 @@
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# modules which `ica --help` should never need to import
+HEAVY_MODULES = ['requests', 'urllib3', 'sqlite3', 'icapy.data', 'icapy.client']
+
+HELP = '''
+import sys
+sys.argv = ['ica', '--help']
+from icapy.cli import CLI
+try:
+    CLI()
+except SystemExit:
+    pass
+'''
+
+CHECK_IMPORTS = HELP + '''
+heavy = [x for x in {heavy} if x in sys.modules]
+sys.stderr.write(','.join(heavy))
+'''
+
+def get_args():
+    parser = argparse.ArgumentParser(description='time startup of the ica CLI')
+    parser.add_argument('--runs', type=int, default=20,
+                        help='number of times to start the CLI (default=20).')
+    parser.add_argument('--max-overhead', type=float, default=100,
+                        help='fail if `ica --help` takes longer than a bare ' \
+                             'python startup by this many ms (default=100).')
+    return parser.parse_args()
+
+def time_command(code: str, runs: int, env) -> float:
+    ''' get the median time (in ms) to run some python code in a new process
+    '''
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+def main():
+    args = get_args()
+    with tempfile.TemporaryDirectory() as home:
+        # use an empty home folder, so nothing can prompt for credentials
+        env = dict(os.environ, HOME=home)
+        baseline = time_command('pass', args.runs, env)
+        cli = time_command(HELP, args.runs, env)
+        check = subprocess.run([sys.executable, '-c',
+                                CHECK_IMPORTS.format(heavy=HEAVY_MODULES)],
+                               env=env, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE, text=True, check=True)
+        config_written = os.path.exists(os.path.join(home, '.config'))
+    
+    overhead = cli - baseline
+    print(f'python startup:\t{baseline:.1f} ms')
+    print(f'ica --help:\t{cli:.1f} ms')
+    print(f'overhead:\t{overhead:.1f} ms')
+    
+    failed = False
+    if check.stderr:
+        print(f'error: heavy modules imported at startup: {check.stderr}')
+        failed = True
+    if config_written:
+        print('error: config folder touched at startup')
+        failed = True
+    if overhead > args.max_overhead:
+        print(f'error: startup overhead above {args.max_overhead} ms')
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
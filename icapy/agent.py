@@ -0,0 +1,308 @@
+
+import json
+import os
+from pathlib import Path
+import signal
+import socket
+import socketserver
+import subprocess
+import sys
+import time
+import traceback
+from typing import Any, Dict, List
+
+from icapy.cli import get_socket_path
+
+# stop the agent after this many seconds without commands
+IDLE_TIMEOUT = 3600
+
+# modules imported before forking, so commands don't pay to import them
+WARM_MODULES = ['icapy.cli', 'icapy.data', 'icapy.jobs', 'icapy.sync',
+                'icapy.projects', 'icapy.region', 'icapy.output', 'icapy.checksum',
+                'icapy.find']
+
+def connect(path: Path, timeout: float=None) -> socket.socket:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(str(path))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+def send_request(sock: socket.socket, request: Dict[str, Any], fds: List[int]=None):
+    ''' send a request (as a JSON line), passing file descriptors alongside
+    '''
+    message = json.dumps(request).encode('utf8') + b'\n'
+    if fds:
+        socket.send_fds(sock, [message], fds)
+    else:
+        sock.sendall(message)
+
+def ask(request: Dict[str, Any]) -> Dict[str, Any] | None:
+    ''' send a control request (e.g. status or stop) to the agent, if running
+    '''
+    try:
+        with connect(get_socket_path(), timeout=5) as sock:
+            send_request(sock, request)
+            return json.loads(sock.makefile('rb').readline() or 'null')
+    except (OSError, ValueError):
+        return None
+
+def forward(argv: List[str]) -> int | None:
+    ''' run a command in the agent, if it is running
+    
+    The agent gets our stdin, stdout and stderr (passed over the socket), the
+    working directory and environment, so commands behave as if run locally.
+    
+    Returns:
+        exit code of the command, or None if the agent can't run it
+    '''
+    path = get_socket_path()
+    if not hasattr(socket, 'send_fds') or not path.exists():
+        return None
+    try:
+        sock = connect(path)
+    except OSError:
+        # the agent stopped without removing its socket
+        return None
+    
+    with sock:
+        request = {'type': 'run', 'argv': argv, 'cwd': os.getcwd(),
+                   'env': dict(os.environ)}
+        try:
+            send_request(sock, request, [0, 1, 2])
+            replies = sock.makefile('rb')
+            started = json.loads(replies.readline() or 'null')
+        except (OSError, ValueError):
+            return None
+        if started is None or started.get('pid') is None:
+            return None
+        
+        while True:
+            try:
+                line = replies.readline()
+                break
+            except KeyboardInterrupt:
+                # pass Ctrl-C on, and wait for the command to finish up
+                os.kill(started['pid'], signal.SIGINT)
+    
+    if not line:
+        sys.stderr.write('ica agent stopped before the command finished\n')
+        return 1
+    return json.loads(line)['exit']
+
+def exit_code(code) -> int:
+    ''' convert a SystemExit code to an exit status, as the interpreter would
+    '''
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    sys.stderr.write(f'{code}\n')
+    return 1
+
+class Handler(socketserver.StreamRequestHandler):
+    ''' handle a request to the agent, in a forked copy of the agent process
+    '''
+    def handle(self):
+        message, fds, _, _ = socket.recv_fds(self.request, 65536, 3)
+        while not message.endswith(b'\n'):
+            chunk = self.request.recv(65536)
+            if not chunk:
+                return
+            message += chunk
+        request = json.loads(message)
+        
+        if request['type'] == 'status':
+            self.reply({'pid': os.getppid(), 'started': self.server.started,
+                        'base_url': self.server.base_url})
+        elif request['type'] == 'stop':
+            self.reply({'pid': os.getppid()})
+            os.kill(os.getppid(), signal.SIGTERM)
+        elif request['type'] == 'run':
+            self.run(request, fds)
+    
+    def reply(self, data: Dict[str, Any]):
+        self.request.sendall(json.dumps(data).encode('utf8') + b'\n')
+    
+    def run(self, request: Dict[str, Any], fds: List[int]):
+        ''' run a CLI command, as if in the caller's process
+        '''
+        from icapy.cli import CLI
+        # the API location is fixed when the client is created, so callers
+        # using a different server need to run commands themselves
+        base_url = request['env'].get('ICA_BASE_URL')
+        if base_url != self.server.env_url or len(fds) != 3:
+            return self.reply({'pid': None})
+        self.reply({'pid': os.getpid()})
+        
+        for fd, target in zip(fds, [0, 1, 2]):
+            os.dup2(fd, target)
+            os.close(fd)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.environ.clear()
+        os.environ.update(request['env'])
+        os.environ['ICA_NO_AGENT'] = '1'
+        sys.argv = ['ica'] + request['argv']
+        
+        code = 0
+        try:
+            os.chdir(request['cwd'])
+            CLI()
+        except SystemExit as err:
+            code = exit_code(err.code)
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        finally:
+            for handle in [sys.stdout, sys.stderr]:
+                try:
+                    handle.flush()
+                except (OSError, ValueError):
+                    pass
+        self.reply({'exit': code})
+
+class AgentServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    ''' unix socket server which runs each command in a fork of a warm process
+    
+    Modules, configuration and API headers are loaded once, before forking.
+    The agent also keeps an open connection to the API, which the next forked
+    command takes over, so that command skips the TCP and TLS handshakes. The
+    agent then drops its copy, and opens a fresh connection for the following
+    command.
+    
+    Args:
+        path: path to the unix socket
+        idle: seconds without commands before the agent exits
+    '''
+    def __init__(self, path: Path | str, idle: float=IDLE_TIMEOUT):
+        from icapy.client import get_client
+        from icapy.config import BASE_URL, get_config_path
+        super().__init__(str(path), Handler)
+        os.chmod(path, 0o600)
+        self.client = get_client()
+        self.base_url = BASE_URL
+        self.env_url = os.environ.get('ICA_BASE_URL')
+        self.config_path = get_config_path()
+        self.config_time = None
+        self.idle = idle
+        self.started = time.time()
+        self.last_used = time.time()
+        self.warm = False
+        self.refresh()
+    
+    def refresh(self):
+        ''' reload the configuration and API headers, if the config changed
+        '''
+        from icapy import config
+        try:
+            mtime = self.config_path.stat().st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self.config_time:
+            return
+        self.config_time = mtime
+        config._CONFIG = None
+        self.client._headers = None
+        # only read the credentials now if that won't prompt for them
+        if 'ica_api_key' in config.load_config():
+            self.client._headers = config.get_headers()
+    
+    def warm_up(self):
+        ''' open a connection to the API, for the next command to use
+        '''
+        import requests
+        try:
+            self.client.session.head(self.base_url, timeout=10)
+        except requests.exceptions.RequestException:
+            pass
+        self.warm = True
+    
+    def process_request(self, request, client_address):
+        self.refresh()
+        self.last_used = time.time()
+        super().process_request(request, client_address)
+        # only the forked command continues past here if it returns, and that
+        # now owns the pooled connections, so stop using them here
+        self.client.session.close()
+        self.warm = False
+    
+    def service_actions(self):
+        super().service_actions()
+        if not self.warm:
+            self.warm_up()
+        if time.time() - self.last_used > self.idle and not self.active_children:
+            raise SystemExit(0)
+
+def run_agent(idle: float=IDLE_TIMEOUT):
+    ''' run the agent in this process, until stopped or idle for too long
+    '''
+    import importlib
+    for module in WARM_MODULES:
+        importlib.import_module(module)
+    
+    path = get_socket_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.unlink(missing_ok=True)
+    server = AgentServer(path, idle)
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    try:
+        server.serve_forever(poll_interval=1)
+    finally:
+        server.server_close()
+        path.unlink(missing_ok=True)
+
+def start_agent(idle: float=IDLE_TIMEOUT, timeout: float=10) -> Dict[str, Any]:
+    ''' start the agent in the background, and wait until it is ready
+    '''
+    status = ask({'type': 'status'})
+    if status is not None:
+        return status
+    subprocess.Popen([sys.executable, '-m', 'icapy.agent', '--idle', str(idle)],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, start_new_session=True)
+    end = time.time() + timeout
+    while time.time() < end:
+        status = ask({'type': 'status'})
+        if status is not None:
+            return status
+        time.sleep(0.05)
+    raise ValueError('ica agent did not start')
+
+def agent_wrapper(args):
+    ''' start, stop or check the agent which runs commands for the ica CLI
+    '''
+    if not hasattr(socket, 'send_fds'):
+        sys.stderr.write('ica agent needs unix sockets, which are unavailable here\n')
+        sys.exit(1)
+    
+    if args.ACTION == 'run':
+        run_agent(args.idle)
+    elif args.ACTION == 'start':
+        try:
+            status = start_agent(args.idle)
+        except ValueError as err:
+            sys.stderr.write(err.args[0] + '\n')
+            sys.exit(1)
+        sys.stderr.write(f'ica agent running (pid {status["pid"]})\n')
+    elif args.ACTION == 'stop':
+        status = ask({'type': 'stop'})
+        if status is None:
+            sys.stderr.write('ica agent is not running\n')
+    elif args.ACTION == 'status':
+        status = ask({'type': 'status'})
+        if status is None:
+            sys.stderr.write('ica agent is not running\n')
+            sys.exit(1)
+        uptime = time.time() - status['started']
+        sys.stdout.write(f'pid\t{status["pid"]}\nuptime\t{uptime:.0f} s\n'
+                         f'api\t{status["base_url"]}\n')
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='run the ica agent')
+    parser.add_argument('--idle', type=float, default=IDLE_TIMEOUT)
+    run_agent(parser.parse_args().idle)
@@ -0,0 +1,39 @@
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import sys
+from typing import Any, Callable, Iterable, List, Tuple
+
+def run_batch(func: Callable[[Any], Any], items: Iterable[Any], threads: int=8,
+              label: Callable[[Any], str]=str) -> List[Tuple[Any, Exception]]:
+    ''' run a function on many items, using a bounded pool of threads
+    
+    A failure for one item is reported to stderr, and doesn't stop the other
+    items from being processed.
+    
+    Args:
+        func: function to call on each item
+        items: items to process
+        threads: maximum number of items to process at once
+        label: function to describe an item in error messages
+    
+    Returns:
+        list of (item, error) tuples for the items which failed
+    '''
+    failed = []
+    with ThreadPoolExecutor(threads) as pool:
+        jobs = {pool.submit(func, item): item for item in items}
+        for job in as_completed(jobs):
+            item = jobs[job]
+            try:
+                job.result()
+            except Exception as err:
+                sys.stderr.write(f'failed: {label(item)}: {err}\n')
+                failed.append((item, err))
+    return failed
+
+def report_batch(total: int, failed: List[Tuple[Any, Exception]], action: str):
+    ''' write a summary of a batch to stderr, and exit with an error on failures
+    '''
+    sys.stderr.write(f'{action} {total - len(failed)} of {total} files\n')
+    if len(failed) > 0:
+        sys.exit(1)
@@ -0,0 +1,135 @@
+
+import json
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List
+
+from icapy.config import get_config_path
+
+# how long (in seconds) cached path details are trusted for
+CACHE_TTL = 3600
+
+def is_settled(item: Dict[str, Any]) -> bool:
+    ''' check if an ICA data item is safe to cache
+    
+    Files which are still uploading change size, status and ETag, so caching
+    those would let later downloads use the wrong size. Folders don't change
+    like that, so are always cached.
+    '''
+    details = item['data']['details']
+    return details.get('status') == 'AVAILABLE' or details.get('dataType') == 'FOLDER'
+
+def normalise(path: Path | str) -> str:
+    ''' convert a path to the form used as a cache key (no trailing slash)
+    '''
+    return str(path).rstrip('/') or '/'
+
+class PathCache:
+    ''' local cache of ICA data details (ID, type etc), keyed by project and path
+    
+    This is stored in a sqlite database, so it persists between runs. Entries
+    expire after a fixed time, and are removed when we delete or replace data.
+    '''
+    def __init__(self, path: Path | str=None, ttl: float=CACHE_TTL):
+        if path is None:
+            path = get_config_path().parent / 'cache.sqlite'
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), timeout=30, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS paths (
+                                project TEXT,
+                                path TEXT,
+                                items TEXT,
+                                created REAL,
+                                PRIMARY KEY (project, path))''')
+            self.db.execute('''CREATE TABLE IF NOT EXISTS projects (
+                                tenant TEXT PRIMARY KEY,
+                                items TEXT,
+                                created REAL)''')
+    
+    def get(self, project: str, path: Path | str) -> List[Dict[str, Any]] | None:
+        ''' get cached items for a path, or None if absent or expired
+        '''
+        with self.lock:
+            row = self.db.execute('SELECT items, created FROM paths '
+                                  'WHERE project = ? AND path = ?',
+                                  (project, normalise(path))).fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        return json.loads(row[0])
+    
+    def put(self, project: str, path: Path | str, items: List[Dict[str, Any]]):
+        ''' store the items matching a single path
+        '''
+        self.put_many(project, [(path, items)])
+    
+    def put_many(self, project: str, entries: Iterable):
+        ''' store items for many paths at once, from (path, items) tuples
+        
+        Paths with any items which could still change (see is_settled) are
+        skipped.
+        '''
+        now = time.time()
+        rows = [(project, normalise(path), json.dumps(items), now)
+                for path, items in entries if all(is_settled(x) for x in items)]
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO paths VALUES (?, ?, ?, ?)', rows)
+    
+    def invalidate(self, project: str, path: Path | str):
+        ''' remove a path, and anything nested within it, from the cache
+        '''
+        path = normalise(path)
+        prefix = path.rstrip('/') + '/'
+        # escape LIKE wildcards, since ICA paths can contain '%' and '_'
+        prefix = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM paths WHERE project = ? AND '
+                            "(path = ? OR path LIKE ? ESCAPE '\\')",
+                            (project, path, prefix + '%'))
+    
+    def get_projects(self, tenant: str, ttl: float) -> List[Dict[str, Any]] | None:
+        ''' get the cached project catalog for a tenant, or None if absent or
+        older than the ttl (in seconds)
+        '''
+        with self.lock:
+            row = self.db.execute('SELECT items, created FROM projects '
+                                  'WHERE tenant = ?', (tenant, )).fetchone()
+        if row is None or time.time() - row[1] > ttl:
+            return None
+        return json.loads(row[0])
+    
+    def put_projects(self, tenant: str, projects: List[Dict[str, Any]]):
+        ''' store the project catalog for a tenant
+        '''
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO projects VALUES (?, ?, ?)',
+                            (tenant, json.dumps(projects), time.time()))
+    
+    def clear(self):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM paths')
+            self.db.execute('DELETE FROM projects')
+
+_CACHE = None
+_CACHE_ENABLED = True
+_CACHE_LOCK = threading.Lock()
+
+def set_cache_enabled(enabled: bool):
+    ''' turn the path cache on or off (e.g. for --no-cache)
+    '''
+    global _CACHE_ENABLED
+    _CACHE_ENABLED = enabled
+
+def get_cache() -> PathCache | None:
+    ''' get the shared path cache, or None if caching is turned off
+    '''
+    global _CACHE
+    if not _CACHE_ENABLED:
+        return None
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = PathCache()
+    return _CACHE
@@ -0,0 +1,279 @@
+
+import hashlib
+import io
+import math
+import os
+from pathlib import Path
+import sqlite3
+import stat
+import threading
+from typing import Dict, List
+
+from icapy.config import get_config_path
+
+MB = 1024 * 1024
+
+# part sizes commonly used by S3 clients for multipart uploads
+COMMON_PART_SIZES = [5 * MB, 8 * MB, 16 * MB, 32 * MB, 64 * MB, 100 * MB,
+                     128 * MB, 256 * MB, 512 * MB]
+
+def clean_etag(etag: str | None) -> str:
+    ''' remove the quotes around an ETag (e.g. '"abc"' -> 'abc')
+    '''
+    return (etag or '').strip('"')
+
+def multipart_etag(digests: List[bytes]) -> str:
+    ''' get the S3 ETag for a multipart upload, from the MD5 digests of its parts
+    '''
+    return hashlib.md5(b''.join(digests)).hexdigest() + f'-{len(digests)}'
+
+def guess_part_sizes(size: int, etag: str, limit: int=3) -> List[int]:
+    ''' find part sizes which could have made a multipart ETag (e.g. 'abc-12')
+    
+    The ETag only gives the number of parts, so this tries the smallest whole
+    number of MB which gives that many parts, and common default part sizes.
+    '''
+    if '-' not in etag:
+        return []
+    parts = int(etag.rsplit('-', 1)[1])
+    smallest = math.ceil(math.ceil(size / parts) / MB) * MB
+    candidates = [smallest] + COMMON_PART_SIZES
+    sizes = []
+    for part_size in candidates:
+        if math.ceil(size / part_size) == parts and part_size not in sizes:
+            sizes.append(part_size)
+    return sizes[:limit]
+
+class StreamHasher:
+    ''' compute the checksums of data as it is transferred, in a separate thread
+    
+    Chunks can be fed in any order (e.g. from concurrent byte ranges). The
+    hashing thread takes chunks in order as soon as they are available, so
+    hashing overlaps the transfer. Out-of-order chunks are held in memory up to
+    a limit. After that they are either read back from the file being written
+    (if given), or feeding waits for the hasher to catch up.
+    
+    Besides the MD5, this computes multipart ETags for the likely part sizes if
+    the expected ETag is from a multipart upload.
+    
+    Args:
+        size: total number of bytes to expect (None if unknown)
+        etag: expected ETag (if known), to check which checksums are needed
+        fd: file descriptor of the file being written, for reading back chunks
+        max_buffer: most bytes to hold in memory while waiting to be hashed
+    '''
+    def __init__(self, size: int | None, etag: str=None, fd: int=None,
+                 max_buffer: int=64 * MB):
+        self.size = size
+        self.fd = fd
+        self.max_buffer = max_buffer
+        self.md5 = hashlib.md5()
+        part_sizes = guess_part_sizes(size, clean_etag(etag)) if size else []
+        self.parts = {x: [] for x in part_sizes}
+        self.current = {x: hashlib.md5() for x in self.parts}
+        self.arrived = {}
+        self.pending = {}
+        self.buffered = 0
+        self.position = 0
+        self.error = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    
+    def feed(self, offset: int, chunk: bytes):
+        ''' pass a chunk of the data, and its position, to the hashing thread
+        '''
+        with self.condition:
+            if self.fd is None:
+                while self.buffered >= self.max_buffer and not self.closed:
+                    self.condition.wait()
+            self.arrived[offset] = len(chunk)
+            if self.fd is None or self.buffered < self.max_buffer:
+                self.pending[offset] = bytes(chunk)
+                self.buffered += len(chunk)
+            self.condition.notify_all()
+    
+    def update(self, data: bytes):
+        ''' add the next data to every checksum
+        '''
+        self.md5.update(data)
+        for part_size, digests in self.parts.items():
+            view = memoryview(data)
+            position = self.position
+            while len(view) > 0:
+                # split the data where parts end
+                take = min(len(view), part_size - position % part_size)
+                self.current[part_size].update(view[:take])
+                view = view[take:]
+                position += take
+                if position % part_size == 0:
+                    digests.append(self.current[part_size].digest())
+                    self.current[part_size] = hashlib.md5()
+    
+    def run(self):
+        try:
+            while self.size is None or self.position < self.size:
+                with self.condition:
+                    while self.position not in self.arrived and not self.closed:
+                        self.condition.wait()
+                    if self.position not in self.arrived:
+                        return
+                    length = self.arrived.pop(self.position)
+                    data = self.pending.pop(self.position, None)
+                    if data is not None:
+                        self.buffered -= len(data)
+                        self.condition.notify_all()
+                if data is None:
+                    data = os.pread(self.fd, length, self.position)
+                self.update(data)
+                self.position += length
+        except Exception as err:
+            self.error = err
+    
+    def close(self):
+        ''' mark the end of the data (or stop early, if the transfer failed)
+        '''
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+    
+    def result(self) -> Dict[str, str]:
+        ''' wait for hashing to finish, and get the checksums
+        
+        Returns:
+            dictionary with the 'md5', and 'etags' (multipart ETags, if any)
+        '''
+        self.close()
+        if self.error is not None:
+            raise self.error
+        if self.size is not None and self.position < self.size:
+            raise ValueError('cannot check an incomplete transfer')
+        etags = []
+        for part_size, digests in self.parts.items():
+            if self.position % part_size != 0:
+                digests = digests + [self.current[part_size].digest()]
+            etags.append(multipart_etag(digests))
+        return {'md5': self.md5.hexdigest(), 'etags': etags}
+
+class HashingReader:
+    ''' wrap a file handle (or bytes) to hash the data as it is read for uploading
+    
+    This has the length of the remaining data (if known), so uploads can still
+    set the Content-Length, and otherwise are sent in chunks.
+    '''
+    def __init__(self, data: bytes | io.BufferedReader, chunk_size: int=MB):
+        if isinstance(data, (bytes, bytearray)):
+            data = io.BytesIO(data)
+        self.handle = data
+        self.chunk_size = chunk_size
+        self.len = get_remaining(data)
+        self.offset = 0
+        self.hasher = StreamHasher(self.len)
+    
+    def read(self, size: int=-1) -> bytes:
+        data = self.handle.read(size)
+        self.hasher.feed(self.offset, data)
+        self.offset += len(data)
+        return data
+    
+    def __iter__(self):
+        return iter(lambda: self.read(self.chunk_size), b'')
+
+def get_remaining(handle) -> int | None:
+    ''' get the number of bytes left to read from a file handle, if known
+    '''
+    if isinstance(handle, io.BytesIO):
+        return handle.getbuffer().nbytes - handle.tell()
+    try:
+        info = os.fstat(handle.fileno())
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+    # pipes (e.g. stdin) have no known size
+    if not stat.S_ISREG(info.st_mode):
+        return None
+    return info.st_size - handle.tell()
+
+def file_checksums(path: Path | str, etag: str=None) -> Dict[str, str]:
+    ''' get the checksums of a local file (see StreamHasher.result)
+    '''
+    hasher = StreamHasher(os.path.getsize(path), etag, max_buffer=4 * MB)
+    with open(path, 'rb') as handle:
+        offset = 0
+        for chunk in iter(lambda: handle.read(MB), b''):
+            hasher.feed(offset, chunk)
+            offset += len(chunk)
+    return hasher.result()
+
+def check_etag(etag: str | None, checksums: Dict[str, str]) -> bool | None:
+    ''' check transferred data against the ETag stored on ICA
+    
+    Returns:
+        True if matching, False if not, or None if the ETag can't be checked
+        (e.g. if unknown, or from a multipart upload with unusual part sizes)
+    '''
+    etag = clean_etag(etag)
+    if etag == '':
+        return None
+    if '-' not in etag:
+        return etag == checksums['md5']
+    if etag in checksums['etags']:
+        return True
+    return None if len(checksums['etags']) == 0 else False
+
+class ChecksumStore:
+    ''' record of checksums for local files which were transferred to/from ICA
+    
+    Files are recorded by path, size and modification time, so the checksums
+    are only used while the file is unchanged. This lets later syncs compare
+    files against the ICA ETag without reading them again.
+    '''
+    def __init__(self, path: Path | str=None):
+        if path is None:
+            path = get_config_path().parent / 'checksums.sqlite'
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), timeout=30, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS checksums (
+                                path TEXT PRIMARY KEY,
+                                size INTEGER,
+                                mtime REAL,
+                                md5 TEXT,
+                                etag TEXT)''')
+    
+    def put(self, path: Path | str, md5: str | None, etag: str | None):
+        ''' record checksums for a local file, as it currently is
+        '''
+        path = Path(path).resolve()
+        stat = path.stat()
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?)',
+                            (str(path), stat.st_size, stat.st_mtime, md5,
+                             clean_etag(etag) or None))
+    
+    def get(self, path: Path | str) -> Dict[str, str] | None:
+        ''' get recorded checksums for a local file, or None if it changed since
+        '''
+        path = Path(path).resolve()
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime, md5, etag FROM checksums '
+                                  'WHERE path = ?', (str(path), )).fetchone()
+        if row is None:
+            return None
+        stat = path.stat()
+        if (stat.st_size, stat.st_mtime) != (row[0], row[1]):
+            return None
+        return {'md5': row[2], 'etag': row[3]}
+
+_STORE = None
+_STORE_LOCK = threading.Lock()
+
+def get_checksum_store() -> ChecksumStore:
+    ''' get the shared record of local file checksums
+    '''
+    global _STORE
+    with _STORE_LOCK:
+        if _STORE is None:
+            _STORE = ChecksumStore()
+    return _STORE
@@ -1,26 +1,43 @@
 
 
 import argparse
+import importlib
 import os
 from pathlib import Path
 import sys
 
-from icapy.data import (ls_wrapper,
-                        download_file,
-                        upload_wrapper,
-                        rm_wrapper,
-                        )
-from icapy.jobs import find_jobs
-from icapy.projects import set_default_project
+def lazy(module: str, name: str):
+    ''' get a command function, without importing its module until it runs
+    
+    Command modules import requests etc, so deferring these imports keeps
+    `ica --help` and argument errors fast.
+    '''
+    def command(args):
+        return getattr(importlib.import_module(module), name)(args)
+    return command
+
+def get_socket_path() -> Path:
+    ''' get the path of the agent's unix socket (without creating any folders)
+    '''
+    default = Path.home() / '.config' / 'ica' / 'agent.sock'
+    return Path(os.environ.get('ICA_AGENT_SOCKET', default))
 
 def CLI():
     ''' small CLI application to run ICA commands
     '''
     parser = argparse.ArgumentParser(description="small CLI application to run ICA commands")
-    subparsers = parser.add_subparsers()
+    parser.add_argument('--no-cache', default=False, action='store_true',
+                        help='look up paths on ICA, rather than using cached IDs')
+    parser.add_argument('--trace', metavar='FILE', default=os.environ.get('ICA_TRACE'),
+                        help='write every API call (endpoint, status, latency, ' \
+                             'bytes, retries) as JSON lines to this file, and ' \
+                             'summarise calls at the end. Also set via ICA_TRACE.')
+    parser.add_argument('--progress', default=False, action='store_true',
+                        help='show transfer progress and speed on stderr')
+    subparsers = parser.add_subparsers(dest='command')
     
     login = subparsers.add_parser('select', help="set default project")
-    login.set_defaults(func=set_default_project)
+    login.set_defaults(func=lazy('icapy.projects', 'set_default_project'))
     
     ls = subparsers.add_parser('ls', help="list file/folder details")
     ls.add_argument('FILE', nargs='?', type=Path, help='path to file/folder')
@@ -29,24 +46,191 @@ def CLI():
                     action='store_true', help='use a long listing format')
     ls.add_argument('-a', '--all', default=False, 
                     action='store_true', help='show hidden files')
-    ls.set_defaults(func=ls_wrapper)
+    ls.add_argument('-R', '--recursive', default=False, action='store_true',
+                    help='list subfolders recursively (--pattern is not used)')
+    ls.add_argument('-j', '--threads', type=int, default=8,
+                    help='number of folders to list concurrently with -R (default=8).')
+    ls.add_argument('--format', choices=['tsv', 'ndjson'], default='tsv',
+                    help='output format (default=tsv). ndjson gives all ' \
+                         'fields unless --fields is used.')
+    ls.add_argument('--fields',
+                    help='comma-separated fields to output, from name, path, ' \
+                         'id, type, size, created_date, modified_date, etag, ' \
+                         'status')
+    ls.add_argument('--project', action='append', metavar='PROJECT',
+                    help='list in this project (name or ID) rather than the ' \
+                         'default project. Can be used more than once, and ' \
+                         'output is tagged with the project.')
+    ls.add_argument('--all-projects', default=False, action='store_true',
+                    help='list in every project at once, with output tagged ' \
+                         'by project.')
+    ls.set_defaults(func=lazy('icapy.data', 'ls_wrapper'))
+    
+    du = subparsers.add_parser('du', help="summarise disk usage of folders")
+    du.add_argument('FILE', nargs='?', type=Path, help='path to file/folder')
+    du.add_argument('-s', '--summarize', default=False, action='store_true',
+                    help='only show a total for the given folder')
+    du.add_argument('-d', '--max-depth', type=int,
+                    help='only show folders at most this far below the given folder')
+    du.add_argument('-b', '--bytes', default=False, action='store_true',
+                    help='show sizes in bytes, rather than human-readable sizes')
+    du.add_argument('-j', '--threads', type=int, default=8,
+                    help='number of folders to list concurrently (default=8).')
+    du.set_defaults(func=lazy('icapy.data', 'du_wrapper'))
+    
+    find = subparsers.add_parser('find', help="search for files/folders via a local index",
+                                 description='search for files/folders via a ' \
+                                     'local index of the project. The index is ' \
+                                     'built on first use, and refreshed with data ' \
+                                     'created since, once it is an hour old.')
+    find.add_argument('PATH', nargs='?', default='/',
+                      help='folder to search within (default=/)')
+    find.add_argument('--name', help='glob pattern for names (quote this), e.g. "*.vcf.gz"')
+    find.add_argument('--iname', help='like --name, but case-insensitive')
+    find.add_argument('--type', choices=['f', 'd'], help='only find files (f) or folders (d)')
+    find.add_argument('--size', action='append',
+                      help='size in bytes, or with units of k, M, G or T. Use ' \
+                           '+ for larger or - for smaller, e.g. --size +1G or ' \
+                           '--size=-10M. Can be used more than once.')
+    find.add_argument('--created-after', metavar='DATE',
+                      help='only find data created after this date, e.g. ' \
+                           '2024-01-31, 2024-01-31T12:00:00, or an age like ' \
+                           '7d (using s, m, h, d or w)')
+    find.add_argument('--created-before', metavar='DATE',
+                      help='only find data created before this date')
+    find.add_argument('--modified-after', metavar='DATE',
+                      help='only find data modified after this date')
+    find.add_argument('--modified-before', metavar='DATE',
+                      help='only find data modified before this date')
+    find.add_argument('-l', default=False,
+                      action='store_true', help='use a long listing format')
+    find.add_argument('--format', choices=['tsv', 'ndjson'], default='tsv',
+                      help='output format (default=tsv). ndjson gives all ' \
+                           'fields unless --fields is used.')
+    find.add_argument('--fields',
+                      help='comma-separated fields to output, from name, path, ' \
+                           'id, type, size, created_date, modified_date, etag, ' \
+                           'status')
+    find.add_argument('--refresh', default=False, action='store_true',
+                      help='fetch data created since the index was refreshed, ' \
+                           'before searching')
+    find.add_argument('--rebuild', default=False, action='store_true',
+                      help='index the whole project again, e.g. to drop data ' \
+                           'deleted outside icapy')
+    find.add_argument('-j', '--threads', type=int, default=8,
+                      help='number of folders to list concurrently when ' \
+                           'indexing (default=8).')
+    find.add_argument('--project', action='append', metavar='PROJECT',
+                      help='search in this project (name or ID) rather than ' \
+                           'the default project. Can be used more than once, ' \
+                           'and output is tagged with the project.')
+    find.add_argument('--all-projects', default=False, action='store_true',
+                      help='search in every project, with output tagged by project.')
+    find.set_defaults(func=lazy('icapy.find', 'find_wrapper'))
     
     download = subparsers.add_parser('download', help="download file")
-    download.add_argument('PATH', type=Path, help='path to file')
-    download.set_defaults(func=download_file)
+    download.add_argument('PATH', nargs='?', type=Path, help='path to file')
+    download.add_argument('-o', '--output', type=Path,
+                          help='path to write to. Writes to stdout if not used. ' \
+                               'With -r or --from-file, the folder to download into.')
+    download.add_argument('--from-file', metavar='MANIFEST',
+                          help='download the files listed in this tab-separated ' \
+                               'file, with an ICA path and (optionally) a local ' \
+                               'path on each line. The status of each file is ' \
+                               'written to stdout.')
+    download.add_argument('-r', '--recursive', default=False, action='store_true',
+                          help='download a folder and its contents')
+    download.add_argument('-j', '--threads', type=int, default=8,
+                          help='number of concurrent connections, or files ' \
+                               'with -r or --from-file (default=8).')
+    download.add_argument('--part-size', type=int, default=32,
+                          help='size of byte ranges to fetch, in MB (default=32).')
+    download.add_argument('--verify', default=False, action='store_true',
+                          help='check the downloaded data against the ICA ETag')
+    download.set_defaults(func=lazy('icapy.data', 'download_file'))
+    
+    view = subparsers.add_parser('view', help="view a genomic region of an indexed file",
+                                 description="Gets records overlapping a region " \
+                                     "from a BAM (as SAM lines), a bgzipped file " \
+                                     "such as VCF (as text lines), or a CRAM (as " \
+                                     "a small CRAM, e.g. to pipe into samtools), " \
+                                     "using the index next to the file on ICA.")
+    view.add_argument('FILE', type=Path, help='path to indexed file')
+    view.add_argument('REGION', help='region to view e.g. chr1:1000-2000')
+    view.add_argument('-H', '--header', default=False, action='store_true',
+                      help='include the file header')
+    view.add_argument('-j', '--threads', type=int, default=8,
+                      help='number of byte ranges to fetch concurrently (default=8).')
+    view.set_defaults(func=lazy('icapy.region', 'view_wrapper'))
     
     upload = subparsers.add_parser('upload', help="upload file")
     upload.add_argument('INFILE', nargs='?', help='path to local file, tries stdin if not used')
     upload.add_argument('--path', type=Path, help='path to destination file (full path or folder)')
     upload.add_argument('-f', '--force', default=False, action='store_true',
                         help='whether to overwrite if detination file exists')
-    upload.set_defaults(func=upload_wrapper)
+    upload.add_argument('-r', '--recursive', default=False, action='store_true',
+                        help='upload a local folder and its contents')
+    upload.add_argument('-j', '--threads', type=int, default=8,
+                        help='number of parts to upload concurrently, or ' \
+                             'files with -r (default=8).')
+    upload.add_argument('--part-size', type=int, default=64,
+                        help='upload files larger than this in parts of this ' \
+                             'size, in MB (default=64). Needs boto3 installed.')
+    upload.add_argument('--verify', default=False, action='store_true',
+                        help='check the uploaded data against the ICA ETag')
+    upload.set_defaults(func=lazy('icapy.data', 'upload_wrapper'))
+    
+    sync = subparsers.add_parser('sync', help="sync a local folder and ICA folder",
+                                 description="Transfers files which are new, " \
+                                             "or differ from the destination")
+    sync.add_argument('DIRECTION', choices=['upload', 'download'],
+                      help='upload (local to ICA) or download (ICA to local)')
+    sync.add_argument('LOCAL', type=Path, help='path to local folder')
+    sync.add_argument('REMOTE', type=Path, help='path to ICA folder')
+    sync.add_argument('-n', '--dry-run', default=False, action='store_true',
+                      help='only show which files would be transferred')
+    sync.add_argument('-c', '--checksum', default=False, action='store_true',
+                      help='compare files by MD5 checksum, rather than modification time')
+    sync.add_argument('-j', '--threads', type=int, default=8,
+                      help='number of files to transfer concurrently (default=8).')
+    sync.add_argument('--part-size', type=int, default=64,
+                      help='part size for large transfers, in MB (default=64).')
+    sync.add_argument('--verify', default=False, action='store_true',
+                      help='check transferred files against their ICA ETags')
+    sync.set_defaults(func=lazy('icapy.sync', 'sync_wrapper'))
+    
+    for command in ['cp', 'mv']:
+        action = 'copy' if command == 'cp' else 'move'
+        copy = subparsers.add_parser(command, help=f"{action} files/folders within ICA",
+                                     description=f"Data is {action}d by ICA, so " \
+                                                 "nothing is downloaded or uploaded")
+        copy.add_argument('SOURCE', nargs='+', type=Path,
+                          help=f'paths to {action}. File names can be glob patterns')
+        copy.add_argument('DEST', type=Path,
+                          help='folder to put data in (created if it does not exist)')
+        copy.add_argument('-f', '--force', default=False, action='store_true',
+                          help='overwrite existing files, otherwise these are skipped')
+        copy.add_argument('--no-wait', default=False, action='store_true',
+                          help=f'exit once the {action} has been submitted')
+        copy.add_argument('--timeout', type=float, default=3600,
+                          help=f'seconds to wait for the {action} to finish ' \
+                               '(default=3600).')
+        if command == 'cp':
+            copy.add_argument('--to-project',
+                              help='name or ID of project to copy into (default: ' \
+                                   'the current project)')
+        copy.set_defaults(func=lazy('icapy.data', 'cp_wrapper'), command=command)
     
     rm = subparsers.add_parser('rm', help="remove (unlink) the FILE(s)")
-    rm.add_argument('PATH', type=Path, help='path to file/folder')
+    rm.add_argument('PATH', nargs='*', type=Path,
+                    help='paths to files/folders. File names can be glob ' \
+                         'patterns (quote these). Reads paths from stdin ' \
+                         '(one per line) if none given, or if the path is "-".')
     rm.add_argument('-r','--recursive', default=False, action='store_true',
                     help='remove directories and their contents')
-    rm.set_defaults(func=rm_wrapper)
+    rm.add_argument('-j', '--threads', type=int, default=8,
+                    help='number of items to delete concurrently (default=8).')
+    rm.set_defaults(func=lazy('icapy.data', 'rm_wrapper'))
     
     jobs = subparsers.add_parser('jobs', 
                                  help="find analyses/jobs",
@@ -59,17 +243,77 @@ def CLI():
                       help='To get details of a specific job. This overrides ' \
                            'any status requirement.')
     jobs.add_argument('--tag', nargs='*', help='tag to filter on.')
+    jobs.add_argument('--pipeline', help='pipeline code to filter on.')
+    jobs.add_argument('--since',
+                      help='only jobs created on or after this date (e.g. 2024-01-31).')
+    jobs.add_argument('--before',
+                      help='only jobs created before this date (e.g. 2024-02-01).')
     jobs.add_argument('--max-jobs', type=int, default=5000,
-                      help='Number of jobs to get (default=5000).')
-    jobs.set_defaults(func=find_jobs)
+                      help='Number of matching jobs to get (default=5000).')
+    jobs.add_argument('--format', choices=['tsv', 'ndjson'], default='tsv',
+                      help='output format (default=tsv). ndjson gives the ' \
+                           'full analysis details unless --fields is used.')
+    jobs.add_argument('--fields',
+                      help='comma-separated analysis fields to output, with ' \
+                           'nested fields joined by "." e.g. pipeline.code,id,status')
+    jobs.add_argument('-w', '--watch', default=False, action='store_true',
+                      help='keep polling, and print jobs when their status ' \
+                           'changes (with the previous status)')
+    jobs.add_argument('--wait-for', nargs='+', metavar='ID',
+                      help='watch these jobs, and exit once all have finished ' \
+                           '(with an error unless all succeeded)')
+    jobs.add_argument('--interval', type=float, default=10,
+                      help='seconds between polls when watching (default=10). ' \
+                           'This backs off while nothing changes.')
+    jobs.add_argument('--max-interval', type=float, default=300,
+                      help='longest time between polls when watching (default=300).')
+    jobs.add_argument('--project', action='append', metavar='PROJECT',
+                      help='search in this project (name or ID) rather than ' \
+                           'the default project. Can be used more than once, ' \
+                           'and output is tagged with the project.')
+    jobs.add_argument('--all-projects', default=False, action='store_true',
+                      help='search in every project at once, with output ' \
+                           'tagged by project.')
+    jobs.set_defaults(func=lazy('icapy.jobs', 'find_jobs'))
+    
+    agent = subparsers.add_parser('agent', help="run commands in a background agent",
+                                  description="The agent keeps modules, " \
+                                              "credentials and API connections " \
+                                              "warm, and ica commands are run " \
+                                              "by it while it is running. Set " \
+                                              "ICA_NO_AGENT=1 to bypass it.")
+    agent.add_argument('ACTION', choices=['start', 'stop', 'status', 'run'],
+                       help='start (in the background), stop, check the ' \
+                            'status, or run in the foreground')
+    agent.add_argument('--idle', type=float, default=3600,
+                       help='stop after this many seconds without commands ' \
+                            '(default=3600).')
+    agent.set_defaults(func=lazy('icapy.agent', 'agent_wrapper'))
     
     args = parser.parse_args()
     if not hasattr(args, 'func'):
         parser.print_help()
-    else:
-        try:
-            args.func(args)
-        except (KeyboardInterrupt, BrokenPipeError):
-            devnull = os.open(os.devnull, os.O_WRONLY)
-            os.dup2(devnull, sys.stdout.fileno())
-            sys.exit(0)
+        return
+    
+    # hand the command to the agent (see `ica agent`) if it is running. Only
+    # check for its socket here, as importing the agent module is slow.
+    if os.environ.get('ICA_NO_AGENT') is None and args.command != 'agent' \
+            and get_socket_path().exists():
+        from icapy.agent import forward
+        code = forward(sys.argv[1:])
+        if code is not None:
+            sys.exit(code)
+    
+    from icapy.cache import set_cache_enabled
+    from icapy.trace import start_tracing, stop_tracing
+    set_cache_enabled(not args.no_cache)
+    if args.trace is not None or args.progress:
+        start_tracing(args.trace, args.progress)
+    try:
+        args.func(args)
+    except (KeyboardInterrupt, BrokenPipeError):
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        sys.exit(0)
+    finally:
+        stop_tracing()
@@ -0,0 +1,230 @@
+
+from email.utils import parsedate_to_datetime
+import threading
+import time
+from typing import Dict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from icapy.config import (BASE_URL,
+                          get_headers,
+                          )
+from icapy.throttle import get_throttle
+from icapy.trace import api_endpoint, get_tracer
+
+# statuses worth retrying: rate limiting, and server side errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# statuses which mean the request was not processed, so that even POSTs (which
+# may create or delete data) are safe to send again
+NOT_PROCESSED = (429, 503)
+
+# methods which can be sent again without repeating their effect
+IDEMPOTENT_METHODS = Retry.DEFAULT_ALLOWED_METHODS
+
+# methods urllib3 retries by itself for presigned URLs. PUTs carry a body, which
+# urllib3 can't always rewind, so those are retried in Client.send instead
+URL_RETRY_METHODS = IDEMPOTENT_METHODS - {'PUT'}
+
+def get_retry_after(r: requests.Response) -> float | None:
+    ''' get the seconds to wait from a Retry-After header (if any)
+    '''
+    value = r.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+def get_body_position(data) -> int | None:
+    ''' get where a request body starts, so it can be sent again on a retry
+    
+    Returns:
+        0 for bodies held in memory, the offset of a seekable file, or None if
+        the body can only be read once (e.g. stdin, or a HashingReader)
+    '''
+    if data is None or isinstance(data, (bytes, bytearray, str, dict, list, tuple)):
+        return 0
+    try:
+        if data.seekable():
+            return data.tell()
+    except (AttributeError, OSError, ValueError):
+        pass
+    return None
+
+class Client:
+    ''' HTTP client for the ICA API, which reuses keep-alive connections
+    
+    All requests go through a single requests.Session, so repeated calls to the
+    API (e.g. paging through a folder listing, or deleting many files) share
+    a connection pool rather than paying for a new TCP+TLS handshake each time.
+    
+    API calls pass through the process-wide throttle (see icapy.throttle), so
+    concurrent operations share one rate and concurrency limit. Rate-limited
+    (429) and server error (5xx) API responses are retried here with
+    exponential backoff, honouring any Retry-After header, so the throttle
+    sees every response. Other URLs (e.g. presigned URLs) are retried by
+    urllib3 instead, apart from PUTs.
+    
+    A 500, 502 or 504 may come after the server acted on the request, so only
+    idempotent methods are retried on those, and POSTs only on 429 and 503.
+    Requests with a body which can't be rewound (e.g. a stream) are never
+    retried, as they would be resent empty or truncated.
+    '''
+    def __init__(self, headers: Dict[str, str]=None, base_url: str=BASE_URL,
+                 retries: int=5, backoff: float=0.5, pool_size: int=32):
+        self.base_url = base_url
+        self.retries = retries
+        self.backoff = backoff
+        self._headers = headers
+        
+        self.session = requests.Session()
+        for prefix, statuses in [('https://', RETRY_STATUSES),
+                                 ('http://', RETRY_STATUSES),
+                                 (base_url, ())]:
+            retry = Retry(total=retries,
+                          backoff_factor=backoff,
+                          status_forcelist=statuses,
+                          allowed_methods=URL_RETRY_METHODS if statuses else IDEMPOTENT_METHODS,
+                          # urllib3 would otherwise retry a 429 with Retry-After
+                          respect_retry_after_header=len(statuses) > 0,
+                          raise_on_status=False,
+                          )
+            adapter = HTTPAdapter(pool_connections=pool_size,
+                                  pool_maxsize=pool_size,
+                                  max_retries=retry)
+            self.session.mount(prefix, adapter)
+    
+    @property
+    def headers(self) -> Dict[str, str]:
+        ''' API headers, only resolved (reading credentials) on first use
+        '''
+        if self._headers is None:
+            self._headers = get_headers()
+        return self._headers
+    
+    def request(self, method: str, ext: str, headers: Dict[str, str]=None,
+                **kwargs) -> requests.Response:
+        ''' make a request to an ICA API endpoint
+        
+        Args:
+            method: HTTP method e.g. 'GET' or 'POST'
+            ext: endpoint, relative to the base URL e.g. 'api/projects'
+            headers: extra headers, which override the default API headers
+            kwargs: passed on to requests e.g. params, data, stream
+        
+        Returns:
+            response, after checking for an error status
+        '''
+        header = dict(self.headers)
+        if headers is not None:
+            header.update(headers)
+        r = self.send(method, self.base_url + ext, headers=header, **kwargs)
+        r.raise_for_status()
+        return r
+    
+    def get(self, ext: str, **kwargs) -> requests.Response:
+        return self.request('GET', ext, **kwargs)
+    
+    def post(self, ext: str, **kwargs) -> requests.Response:
+        return self.request('POST', ext, **kwargs)
+    
+    def fetch(self, method: str, url: str, **kwargs) -> requests.Response:
+        ''' make a request to a full URL, such as a presigned download URL
+        
+        This doesn't add the API headers, but still uses the connection pool.
+        '''
+        r = self.send(method, url, api=False, **kwargs)
+        r.raise_for_status()
+        return r
+    
+    def send(self, method: str, url: str, api: bool=True, **kwargs) -> requests.Response:
+        ''' send a request through the session, recording it if tracing is on
+        
+        API calls wait for the throttle, and are retried on rate limiting and
+        server errors, as are PUTs to other URLs (see Client for which).
+        '''
+        throttle = get_throttle() if api else None
+        method = method.upper()
+        endpoint = f'{method} {api_endpoint(url)}' if api else None
+        retried = api or method not in URL_RETRY_METHODS
+        position = get_body_position(kwargs.get('data'))
+        attempt = 0
+        while True:
+            if throttle is not None:
+                throttle.acquire()
+            start = time.perf_counter()
+            try:
+                r = self.session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException:
+                latency = time.perf_counter() - start
+                if throttle is not None:
+                    throttle.release(None, latency, endpoint=endpoint)
+                self.record(method, url, None, latency, attempt, api, kwargs)
+                raise
+            latency = time.perf_counter() - start
+            
+            wait = None
+            if retried and self.can_retry(method, r.status_code, position) \
+                    and attempt < self.retries:
+                wait = get_retry_after(r)
+                if wait is None:
+                    wait = self.backoff * 2 ** attempt
+            if throttle is not None:
+                throttle.release(r.status_code, latency, wait, endpoint)
+            self.record(method, url, r, latency, attempt, api, kwargs)
+            if wait is None:
+                return r
+            
+            r.close()
+            if hasattr(kwargs.get('data'), 'seek'):
+                kwargs['data'].seek(position)
+            if throttle is None or r.status_code not in NOT_PROCESSED:
+                # rate limits pause every call in the throttle, other errors
+                # only delay this call
+                time.sleep(wait)
+            attempt += 1
+    
+    def can_retry(self, method: str, status: int, position: int | None) -> bool:
+        ''' check if a response can be retried, without repeating its effect
+        '''
+        if position is None or status not in RETRY_STATUSES:
+            return False
+        return status in NOT_PROCESSED or method in IDEMPOTENT_METHODS
+    
+    def record(self, method: str, url: str, r: requests.Response | None,
+               latency: float, attempt: int, api: bool, kwargs: Dict):
+        ''' record a request in the trace, if tracing is on
+        '''
+        tracer = get_tracer()
+        if tracer is None:
+            return
+        if r is None:
+            tracer.record(method, url, None, latency, retries=attempt, api=api)
+            return
+        sent = int(r.request.headers.get('Content-Length') or 0)
+        received = r.headers.get('Content-Length')
+        if received is None:
+            received = 0 if kwargs.get('stream') else len(r.content)
+        history = getattr(getattr(r.raw, 'retries', None), 'history', ())
+        tracer.record(method, url, r.status_code, latency, sent, int(received),
+                      attempt + len(history), api)
+
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+def get_client() -> Client:
+    ''' get the client shared by every module (created on first use)
+    '''
+    global _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            _CLIENT = Client()
+    return _CLIENT
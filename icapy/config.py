@@ -7,9 +7,12 @@ from pathlib import Path
 import stat
 from typing import Dict
 
-import requests
 
-BASE_URL = 'https://ica.illumina.com/ica/rest/'
+# the API location can be changed e.g. to point at a local mock server
+BASE_URL = os.environ.get('ICA_BASE_URL', 'https://ica.illumina.com/ica/rest/')
+
+# configuration is read from disk once per process, then kept here
+_CONFIG = None
 
 def get_config_path() -> Path:
     config_folder = Path.home() / ".config" / "ica"
@@ -17,20 +20,26 @@ def get_config_path() -> Path:
     return config_folder / "config.json"
 
 def load_config() -> Dict[str, str]:
-    ''' load configuration data
+    ''' load configuration data (only read from disk on the first call)
     '''
-    config_path = get_config_path()
-    if config_path.exists():
-        return json.load(open(config_path))
-    else:
-        return {}
+    global _CONFIG
+    if _CONFIG is None:
+        config_path = get_config_path()
+        if config_path.exists():
+            _CONFIG = json.load(open(config_path))
+        else:
+            _CONFIG = {}
+    # return a copy, as callers can modify this before calling write_config
+    return dict(_CONFIG)
 
 def write_config(config: Dict[str, str]):
     ''' write configuration data to disk
     '''
+    global _CONFIG
     config_path = get_config_path()
     with open(config_path, 'wt') as handle:
         json.dump(config, handle, indent=True)
+    _CONFIG = dict(config)
     
     # ensure user only read/write
     os.chmod(config_path, stat.S_IRUSR | stat.S_IWUSR)
@@ -66,10 +75,14 @@ def get_token() -> str:
         'X-API-Key': api_key,
         'accept': 'application/vnd.illumina.v3+json'
     }
-    r = requests.post(BASE_URL + ext, headers=headers, params=params, stream=True)
-    r.raise_for_status()
+    # imported here, since the client module imports from this module
+    from icapy.client import get_client
+    r = get_client().post(ext, headers=headers, params=params, stream=True)
     return r.json()['token']
 
-if "_ICA_HEADERS" not in globals():
-    _ICA_HEADERS = {'x-api-key': get_ica_key(),
-                'Content-Type': 'application/json'}
+def get_headers() -> Dict[str, str]:
+    ''' get headers for API requests. This prompts for the API key if unknown,
+    so is only called once a command needs to make a request.
+    '''
+    return {'x-api-key': get_ica_key(),
+            'Content-Type': 'application/json'}
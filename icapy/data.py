@@ -1,23 +1,67 @@
 
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from fnmatch import fnmatchcase
 import io
+import itertools
 import json
 import os
 from pathlib import Path
 import sys
-from typing import Any, Dict, Iterable, Union, Tuple
+import tempfile
+import time
+from typing import Any, Dict, Iterable, List, Union, Tuple
 
 import requests
 
-from icapy.config import (BASE_URL,
-                          _ICA_HEADERS,
-                          )
-from icapy.projects import get_project_id
+from icapy.batch import report_batch, run_batch
+from icapy.cache import get_cache
+from icapy.checksum import (HashingReader,
+                            StreamHasher,
+                            check_etag,
+                            clean_etag,
+                            get_checksum_store,
+                            get_remaining,
+                            )
+from icapy.client import get_client
+from icapy.index import get_index
+from icapy.output import parse_fields, write_records
+from icapy.paging import paginate
+from icapy.projects import (fan_out,
+                            find_project,
+                            get_project_id,
+                            select_projects,
+                            )
+from icapy.trace import get_tracer
+from icapy.transfer import (MB,
+                            MAX_SINGLE_UPLOAD,
+                            PART_GROWTH_INTERVAL,
+                            download_to_file,
+                            get_part_size,
+                            iter_parts,
+                            multipart_available,
+                            multipart_upload,
+                            read_part,
+                            stream_ranges,
+                            )
 
-def get_data(path: Path | str) -> Iterable[Union[str, None]]:
-    ''' get a data ID matching a given path in a project
+def get_data(path: Path | str, project_id: str=None,
+             cached=True) -> Iterable[Union[str, None]]:
+    ''' get a data ID matching a given path in a project (default project if None)
+    
+    Args:
+        path: path to look up
+        project_id: project to look in (the default project if None)
+        cached: whether to use the path cache, otherwise this always asks ICA
     '''
-    project_id = get_project_id()
+    project_id = project_id or get_project_id()
+    cache = get_cache()
+    if cache is not None and cached:
+        cached = cache.get(project_id, path)
+        if cached is not None:
+            yield from cached
+            return
+    
     ext = f'api/projects/{project_id}/data'
     
     params = {}
@@ -32,70 +76,361 @@ def get_data(path: Path | str) -> Iterable[Union[str, None]]:
         params['filename'] = name
         params['filenameMatchMode'] = 'EXACT'
     
-    r = requests.get(BASE_URL + ext, params=params, headers=_ICA_HEADERS)
-    r.raise_for_status()
+    r = get_client().get(ext, params=params)
     data = r.json()['items']
     if len(data) == 0:
         raise ValueError(f'unknown path: {path}')
     
-    for item in data:
-        if item['data']['details']['path'].rstrip('/') == str(path).rstrip('/'):
-            yield item
+    matched = [x for x in data
+               if x['data']['details']['path'].rstrip('/') == str(path).rstrip('/')]
+    if cache is not None and len(matched) > 0:
+        cache.put(project_id, path, matched)
+    yield from matched
+
+def get_details(data_id: str, project_id: str=None) -> Dict[str, Any]:
+    ''' get current details for a data ID from ICA (see get_object_details)
+    
+    Cached details can be out of date, so this is used for the size and ETag
+    of data before downloading or checking it.
+    '''
+    project_id = project_id or get_project_id()
+    r = get_client().get(f'api/projects/{project_id}/data/{data_id}')
+    return get_object_details(r.json())
+
+def delete_item(item: Dict[str, Any], recursive=False):
+    ''' delete a file or folder, given the object details
+    '''
+    if item['type'] == 'FOLDER' and not recursive:
+        raise ValueError(f"cannot remove '{item['path']}': Is a directory")
+    
+    project_id = get_project_id()
+    ext = f'api/projects/{project_id}/data/{item["id"]}:delete'
+    get_client().post(ext)
+    
+    cache = get_cache()
+    if cache is not None:
+        cache.invalidate(project_id, item['path'])
+    index = get_index(create=False)
+    if index is not None:
+        index.remove(project_id, item['path'])
 
 def delete_file(path: str, recursive=False):
     ''' delete a file object
     '''
     if path is None:
         raise ValueError('cannot delete files without supplying a path')
-    elif path == '/':
+    elif str(path) == '/':
         raise ValueError('cannot delete root directory')
     
-    project_id = get_project_id()
     for item in get_data(path):
-        data_id = item['data']['id']
-        if item['data']['details']['dataType'] == 'FOLDER' and not recursive:
+        try:
+            delete_item(get_object_details(item), recursive)
+        except ValueError:
             sys.stderr.write(f"cannot remove '{path}': Is a directory\n")
             sys.exit(1)
-        
-        ext = f'api/projects/{project_id}/data/{data_id}:delete'
-        # sys.stdout.write(f'will remove {path} via {ext}')
-        r = requests.post(BASE_URL + ext, headers=_ICA_HEADERS)
-        r.raise_for_status()
+
+def delete_files(paths: Iterable[str], recursive=False, threads: int=8):
+    ''' delete many files (or folders), concurrently
+    
+    Paths are resolved with one listing per parent folder, and can include
+    glob patterns in the file name (e.g. /run/*.bam).
+    
+    Returns:
+        tuple of (number of items, list of (item or path, error) for failures)
+    '''
+    paths = [str(x) for x in paths]
+    if any(x.rstrip('/') == '' for x in paths):
+        raise ValueError('cannot delete root directory')
+    for path in paths:
+        if not path.startswith('/'):
+            raise ValueError(f'filepath must begin with "/": {path}')
+    
+    found, missing = resolve_paths(paths, threads)
+    # paths can overlap (e.g. /a/*.bam and /a/x.bam), so only delete each once
+    items = {x['id']: x for matches in found.values() for x in matches}
+    items = list(items.values())
+    if recursive:
+        # and items inside folders being deleted go with their folder
+        folders = [x['path'].rstrip('/') + '/' for x in items if x['type'] == 'FOLDER']
+        items = [x for x in items if not any(x['path'] != y and x['path'].startswith(y)
+                                             for y in folders)]
+    failed = [(x, ValueError(f"cannot remove '{x}': No such file or directory"))
+              for x in missing]
+    for path, err in failed:
+        sys.stderr.write(f'{err}\n')
+    
+    failed += run_batch(lambda x: delete_item(x, recursive), items, threads,
+                        label=lambda x: x['path'])
+    return len(items) + len(missing), failed
 
 def rm_wrapper(args):
     ''' converts CLI arguments into fucntion call for deleting file/folder
+    
+    Paths can be given as arguments, or one per line via stdin (if no paths
+    are given, or the path is '-').
     '''
+    paths = [str(x) for x in args.PATH]
+    if len(paths) == 0 or paths == ['-']:
+        paths = [x.strip() for x in sys.stdin]
+        paths = [x for x in paths if x != '']
+    
     try:
-        delete_file(args.PATH, args.recursive)
+        total, failed = delete_files(paths, args.recursive, args.threads)
     except ValueError as err:
         sys.stderr.write(err.args[0] + '\n')
         sys.exit(1)
+    
+    if total > 1 or len(failed) > 0:
+        sys.stderr.write(f'removed {total - len(failed)} of {total} items\n')
+    if len(failed) > 0:
+        sys.exit(1)
+
+# statuses for a finished copy or move batch
+BATCH_DONE = {'SUCCEEDED', 'PARTIALLY_SUCCEEDED', 'FAILED', 'STOPPED', 'ABORTED'}
+
+# statuses for a copy or move batch which is still to finish
+BATCH_RUNNING = {'INITIALIZED', 'WAITING_FOR_RESOURCES', 'QUEUED', 'RUNNING',
+                 'IN_PROGRESS'}
+
+def submit_batch(items: List[Dict[str, Any]], folder_id: str, project_id: str,
+                 move=False, overwrite=False) -> str:
+    ''' ask ICA to copy (or move) data items into a folder, on the server side
+    
+    Args:
+        items: object details (see get_object_details) for files/folders
+        folder_id: ID of the destination folder
+        project_id: project containing the destination folder
+        move: whether to move the data, rather than copy it
+        overwrite: whether to overwrite existing data, or skip it
+    
+    Returns:
+        ID of the batch job
+    '''
+    action = 'dataMoveBatch' if move else 'dataCopyBatch'
+    body = {'items': [{'dataId': x['id']} for x in items],
+            'destinationFolderId': folder_id,
+            'actionOnExist': 'OVERWRITE' if overwrite else 'SKIP',
+            }
+    if not move:
+        body['copyUserTags'] = True
+        body['copyTechnicalTags'] = True
+        body['copyInstrumentInfo'] = True
+    
+    ext = f'api/projects/{project_id}/{action}'
+    return get_client().post(ext, data=json.dumps(body)).json()['id']
+
+def wait_for_batch(batch_id: str, project_id: str, move=False,
+                   max_wait: float=30, timeout: float=3600) -> str:
+    ''' poll a copy or move batch until it finishes, and return the final status
+    
+    Args:
+        batch_id: ID of the batch job
+        project_id: project the batch was submitted to
+        move: whether this is a move batch, rather than a copy batch
+        max_wait: longest time (in seconds) between polls
+        timeout: give up if the batch hasn't finished after this many seconds
+    
+    Raises:
+        ValueError if the batch has an unknown status, or takes too long
+    '''
+    action = 'dataMoveBatch' if move else 'dataCopyBatch'
+    ext = f'api/projects/{project_id}/{action}/{batch_id}'
+    client = get_client()
+    end = time.monotonic() + timeout
+    delay = 0.5
+    while True:
+        res = client.get(ext).json()
+        status = str(res.get('job', res).get('status') or '').upper()
+        if status in BATCH_DONE:
+            return status
+        if status not in BATCH_RUNNING:
+            raise ValueError(f'unknown status for batch {batch_id}: {status or None}')
+        if time.monotonic() + delay > end:
+            raise ValueError(f'batch {batch_id} did not finish within {timeout:.0f} '
+                             f'seconds (last status: {status.lower()})')
+        time.sleep(delay)
+        delay = min(delay * 2, max_wait)
+
+def copy_data(paths: Iterable[str], destination: str, move=False,
+              overwrite=False, project_id: str=None, wait=True,
+              batch_size: int=1000, threads: int=8,
+              timeout: float=3600) -> List[Tuple[str, str]]:
+    ''' copy or move files/folders into an ICA folder, without downloading them
+    
+    The copies are done by ICA itself, with many items per request, so no data
+    passes through this machine.
+    
+    Args:
+        paths: paths to files or folders in the default project. File names can
+            be glob patterns.
+        destination: path to destination folder. This is created if it does not
+            exist, but the parent folder must exist.
+        move: whether to move the data, rather than copy it
+        overwrite: whether to overwrite data which exists at the destination
+        project_id: project to copy into, if not the default project
+        wait: whether to wait for the batches to complete
+        batch_size: maximum number of items per request
+        threads: number of folders to list concurrently when resolving paths
+        timeout: seconds to wait for each batch to complete
+    
+    Returns:
+        list of (batch ID, status) for each batch submitted. The status is
+        None if not waiting for the batches to complete.
+    '''
+    action = 'move' if move else 'copy'
+    paths = [str(x) for x in paths]
+    if any(x.rstrip('/') == '' for x in paths):
+        raise ValueError(f'cannot {action} root directory')
+    for path in paths:
+        if not path.startswith('/'):
+            raise ValueError(f'filepath must begin with "/": {path}')
+    
+    found, missing = resolve_paths(paths, threads)
+    if len(missing) > 0:
+        raise ValueError(f'cannot access {missing[0]}: No such file or directory')
+    items = [x for matches in found.values() for x in matches]
+    
+    dest_project = project_id or get_project_id()
+    folder_id, folder_path = make_folder(str(destination).rstrip('/') or '/', dest_project)
+    
+    batches = []
+    for i in range(0, len(items), batch_size):
+        batch = items[i:i + batch_size]
+        batches.append((submit_batch(batch, folder_id, dest_project, move, overwrite), batch))
+    
+    # copies and moves change the data at these paths
+    cache = get_cache()
+    if cache is not None:
+        for item in items:
+            name = item['path'].rstrip('/').rsplit('/', 1)[1]
+            cache.invalidate(dest_project, f'{folder_path}{name}')
+            if move:
+                cache.invalidate(get_project_id(), item['path'])
+    
+    # moves change paths without changing creation times, so incremental
+    # refreshes of the index wouldn't find the moved data
+    index = get_index(create=False) if move else None
+    source_project = get_project_id()
+    if not wait:
+        if index is not None:
+            index.expire(source_project)
+            index.expire(dest_project)
+        return [(x, None) for x, _ in batches]
+    
+    results = []
+    for batch_id, batch in batches:
+        try:
+            status = wait_for_batch(batch_id, dest_project, move, timeout=timeout)
+        except ValueError:
+            if index is not None:
+                index.expire(source_project)
+                index.expire(dest_project)
+            raise
+        results.append((batch_id, status))
+        if index is None:
+            continue
+        if status != 'SUCCEEDED':
+            # we can't tell which items were moved
+            index.expire(source_project)
+            index.expire(dest_project)
+            continue
+        for item in batch:
+            name = item['path'].rstrip('/').rsplit('/', 1)[1]
+            if dest_project == source_project:
+                index.move(dest_project, item['path'], f'{folder_path}{name}')
+            else:
+                # the moved data (and anything nested within it) is only found
+                # in the other project by rebuilding its index
+                index.remove(source_project, item['path'])
+                index.expire(dest_project)
+    return results
 
 def mv(old_path: str, new_path: str):
-    raise NotImplementedError
+    ''' move a file or folder into another folder, on the ICA server side
+    '''
+    return copy_data([old_path], new_path, move=True)
+
+def cp(old_path: str, new_path: str):
+    ''' copy a file or folder into another folder, on the ICA server side
+    '''
+    return copy_data([old_path], new_path)
+
+def cp_wrapper(args):
+    ''' converts CLI arguments into a function call for copying (or moving) data
+    '''
+    move = args.command == 'mv'
+    try:
+        project_id = None
+        if getattr(args, 'to_project', None) is not None:
+            project_id = find_project(args.to_project)['id']
+        batches = copy_data(args.SOURCE, str(args.DEST), move,
+                            args.force, project_id, not args.no_wait,
+                            timeout=args.timeout)
+    except ValueError as err:
+        sys.stderr.write(err.args[0] + '\n')
+        sys.exit(1)
+    
+    failed = False
+    for batch_id, status in batches:
+        sys.stderr.write(f'{batch_id}\t{(status or "submitted").lower()}\n')
+        failed |= status is not None and status != 'SUCCEEDED'
+    if failed:
+        sys.exit(1)
 
 def get_object_details(item: Dict[str, Any]):
     ''' get details of an object
     '''
+    details = item['data']['details']
     return {
-        'name': item['data']['details']['name'],
-        'path': item['data']['details']['path'],
-        'created_date': item['data']['details']['timeCreated'],
-        'size': item['data']['details']['fileSizeInBytes'],
+        'name': details['name'],
+        'path': details['path'],
+        'created_date': details['timeCreated'],
+        'modified_date': details.get('timeModified'),
+        'size': details['fileSizeInBytes'],
         'id': item['data']['id'],
+        'type': details['dataType'],
+        'etag': details.get('objectETag'),
+        'status': details.get('status'),
     }
 
-def list_files(path: str, pattern: str=None) -> Iterable[Dict[str, Any]]:
-    ''' list details for file or folder contents
+def list_folder(folder_id: str | None, pattern: str=None,
+                project_id: str=None) -> Iterable[Dict[str, Any]]:
+    ''' list details for the contents of a folder (given by ID, or None for root)
     '''
-    
-    project_id = get_project_id()
+    project_id = project_id or get_project_id()
+    client = get_client()
     pagesize = 1000
-    header = {k: v for k, v in _ICA_HEADERS.items()}
     
+    params = {'pageSize': pagesize}
+    if folder_id is None:
+        params['parentFolderPath'] = '/'
+    else:
+        params['parentFolderId'] = folder_id
+    
+    if pattern is not None:
+        params['filename'] = pattern
+        params['filenameMatchMode'] = 'FUZZY'
+    
+    ext = f'api/projects/{project_id}/data'
+    cache = get_cache()
+    
+    def fetch(offset):
+        res = client.get(ext, params={**params, 'pageOffset': offset}).json()
+        # remember the listed items, so later lookups of these paths are quick
+        if cache is not None:
+            cache.put_many(project_id, [(x['data']['details']['path'], [x])
+                                        for x in res['items']])
+        return res
+    
+    for item in paginate(fetch, pagesize):
+        yield get_object_details(item)
+
+def list_files(path: str, pattern: str=None, project_id: str=None) -> Iterable[Dict[str, Any]]:
+    ''' list details for file or folder contents
+    '''
     data = [{'data': {'id': None, 'details': {'dataType': None}}}]
     if str(path) != '/' and path is not None:
-        data = get_data(path)
+        data = get_data(path, project_id)
     
     for item in data:
         if item['data']['details']['dataType'] == 'FILE':
@@ -104,32 +439,131 @@ def list_files(path: str, pattern: str=None) -> Iterable[Dict[str, Any]]:
             yield get_object_details(item)
             continue
         
-        data_id = item['data']['id']
-        params = {'pageOffset': 0, 'pageSize': pagesize}
-        if data_id is None:
-            params['parentFolderPath'] = '/'
-        else:
-            params['parentFolderId'] = data_id
+        yield from list_folder(item['data']['id'], pattern, project_id)
+
+def walk(path: str, threads: int=8, project_id: str=None) -> Iterable[Dict[str, Any]]:
+    ''' list details for every file and folder nested within a folder
+    
+    Subfolders are listed by ID, so only the top level path needs resolving.
+    Folders are listed concurrently (breadth first) on a bounded pool of
+    threads, and items are yielded as each folder listing completes, so the
+    items are not in any particular order.
+    '''
+    def listing(folder_id):
+        return list(list_folder(folder_id, project_id=project_id))
+    
+    folders = []
+    for item in list_files(path, project_id=project_id):
+        yield item
+        if item['type'] == 'FOLDER':
+            folders.append(item['id'])
+    
+    with ThreadPoolExecutor(threads) as pool:
+        pending = {pool.submit(listing, x) for x in folders}
+        try:
+            while len(pending) > 0:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for job in done:
+                    for item in job.result():
+                        yield item
+                        if item['type'] == 'FOLDER':
+                            pending.add(pool.submit(listing, item['id']))
+        finally:
+            for job in pending:
+                job.cancel()
+
+def disk_usage(path: str, threads: int=8) -> Dict[str, int]:
+    ''' get the total size of files within each folder nested inside a folder
+    
+    Sizes are summed as the folder listings come in, so only the per-folder
+    totals are kept in memory.
+    
+    Returns:
+        dictionary of total size in bytes, indexed by folder path (or by file
+        path, if the path is for a single file)
+    '''
+    root = str(path or '/').rstrip('/') + '/'
+    totals = {root: 0}
+    for item in walk(path, threads):
+        if item['type'] == 'FOLDER':
+            totals.setdefault(item['path'], 0)
+            continue
         
-        if pattern is not None:
-            params['filename'] = pattern
-            params['filenameMatchMode'] = 'FUZZY'
+        size = item['size'] or 0
+        if not item['path'].startswith(root):
+            # the path was for a single file
+            return {item['path']: size}
         
-        ext = f'api/projects/{project_id}/data'
-        r = requests.get(BASE_URL + ext, params=params, headers=header)
-        r.raise_for_status()
-        res = r.json()
+        # add the file size to every folder between the file and the root
+        folder = item['path'].rsplit('/', 1)[0] + '/'
+        while True:
+            totals[folder] = totals.get(folder, 0) + size
+            if folder == root:
+                break
+            folder = folder[:-1].rsplit('/', 1)[0] + '/'
+    return totals
+
+def resolve_paths(paths: Iterable[str], threads: int=8, project_id: str=None,
+                  cached=True) -> Tuple[Dict[str, List[Dict[str, Any]]], List[str]]:
+    ''' find the ICA objects matching many paths, grouped by parent folder
+    
+    Rather than looking up each path separately, each parent folder is listed
+    once and matched against all the requested names in that folder. Folders
+    are listed concurrently. A path on its own in a folder is looked up
+    directly instead (which can also use the path cache).
+    
+    Args:
+        paths: paths to find. The file name can be a glob pattern e.g. *.bam
+        threads: number of folders to list concurrently
+        project_id: project to look in (the default project if None)
+        cached: whether paths looked up directly can use the path cache
+    
+    Returns:
+        tuple of (dictionary of object details by path, list of paths without
+        any match)
+    '''
+    groups = {}
+    for path in paths:
+        path = str(path).rstrip('/')
+        parent, name = path.rsplit('/', 1)
+        groups.setdefault(parent + '/', set()).add(name)
+    
+    def is_glob(name):
+        return any(x in name for x in '*?[')
+    
+    def resolve(parent, names):
+        if len(names) == 1 and not is_glob(next(iter(names))):
+            path = parent + next(iter(names))
+            try:
+                items = get_data(path, project_id, cached)
+                return {path: [get_object_details(x) for x in items]}
+            except ValueError:
+                return {path: []}
         
-        for item in res['items']:
-            yield get_object_details(item)
+        found = {parent + x: [] for x in names}
+        try:
+            folder_id = None
+            if parent != '/':
+                folder_id = next(get_data(parent, project_id))['data']['id']
+            contents = list_folder(folder_id, project_id=project_id)
+        except (ValueError, StopIteration):
+            return found
         
-        while len(res['items']) >= pagesize:
-            params['pageOffset'] += pagesize
-            r = requests.get(BASE_URL + ext, headers=header, params=params)
-            r.raise_for_status()
-            res = r.json()
-            for item in res['items']:
-                yield get_object_details(item)
+        for item in contents:
+            name = item['path'].rstrip('/').rsplit('/', 1)[1]
+            for x in names:
+                if name == x or (is_glob(x) and fnmatchcase(name, x)):
+                    found[parent + x].append(item)
+        return found
+    
+    found = {}
+    with ThreadPoolExecutor(threads) as pool:
+        for res in pool.map(lambda x: resolve(*x), groups.items()):
+            found.update(res)
+    
+    missing = [x for x, matches in found.items() if len(matches) == 0]
+    found = {x: matches for x, matches in found.items() if len(matches) > 0}
+    return found, missing
 
 def format_size(size):
     ''' convert filesize in bytes to human-readable form (e.g. 3.5G)
@@ -153,49 +587,351 @@ def ls_wrapper(args):
         sys.stderr.write(f'filepath must begin with "/": {args.FILE}')
         sys.exit(1)
     
+    fields, convert = parse_fields(args.fields), None
+    if fields is None and (args.format == 'tsv' or args.l):
+        fields = ['path']
+        if args.l:
+            fields += ['id', 'size', 'created_date']
+            convert = {'id': str.lower, 'size': format_size}
+    
+    accessible = set()
+    def listing(project_id):
+        if args.recursive:
+            items = walk(args.FILE, args.threads, project_id)
+        else:
+            items = list_files(args.FILE, args.pattern, project_id)
+        for item in items:
+            if args.all or not item['name'].startswith('.'):
+                yield item
+        # only reached if the path exists in the project
+        accessible.add(project_id)
+    
+    if args.project or args.all_projects:
+        # list in each project at once, with the project name on each item
+        try:
+            projects = select_projects(args.project, args.all_projects)
+        except ValueError as err:
+            sys.stderr.write(err.args[0] + '\n')
+            sys.exit(1)
+        if fields is not None:
+            fields = ['project'] + fields
+        items = fan_out(listing, projects, args.threads, ignore=ValueError)
+        write_records(items, fields, args.format, convert)
+        if len(accessible) == 0:
+            sys.stderr.write(f'cannot access {args.FILE} in any project\n')
+            sys.exit(1)
+        return
+    
     try:
-        for item in list_files(args.FILE, args.pattern):
-            if not args.all and item["name"].startswith('.'):
-                continue
-            line = [item["path"]]
-            if args.l:
-                line += [item["id"].lower(), format_size(item["size"]), item['created_date']]
-            sys.stdout.write('\t'.join(line) + '\n')
+        write_records(listing(None), fields, args.format, convert)
     except ValueError:
         # only raises ValueError if the file/folder does not exist. If you look
         # for an empty folder, this will not be used.
         sys.stderr.write(f'cannot access {args.FILE}: No such file or directory')
         sys.exit(1)
 
-def get_file(path: str):
-    ''' get a file contents (streamed in chunks of 1600 bytes)
+def du_wrapper(args):
+    ''' converts the CLI args to a function call for summarising folder sizes
+    '''
+    if args.FILE is not None and not str(args.FILE).startswith('/'):
+        sys.stderr.write(f'filepath must begin with "/": {args.FILE}\n')
+        sys.exit(1)
+    
+    try:
+        totals = disk_usage(args.FILE, args.threads)
+    except ValueError:
+        sys.stderr.write(f'cannot access {args.FILE}: No such file or directory\n')
+        sys.exit(1)
+    
+    max_depth = 0 if args.summarize else args.max_depth
+    root_depth = min(x.rstrip('/').count('/') for x in totals)
+    for folder in sorted(totals):
+        depth = folder.rstrip('/').count('/') - root_depth
+        if max_depth is not None and depth > max_depth:
+            continue
+        size = totals[folder] if args.bytes else format_size(totals[folder])
+        sys.stdout.write(f'{size}\t{folder}\n')
+
+def get_download_item(path: str) -> Dict[str, Any]:
+    ''' get the details of a single file to download
     '''
-    project_id = get_project_id()
     data = get_data(path)
     if data is None:
         raise ValueError(f'cannot access data at {path}')
     data = list(data)
     if len(data) > 1:
         raise ValueError(f'too many matches at {path}')
+    # the cached size could be out of date (e.g. if listed while uploading)
+    return get_details(data[0]['data']['id'])
+
+def get_download_url(path: str) -> Tuple[str, int]:
+    ''' get a presigned URL to download a file, along with the file size
+    '''
+    item = get_download_item(path)
+    return create_download_url(item['id']), item['size']
+
+def create_download_url(data_id: str, project_id: str=None) -> str:
+    ''' get a presigned URL to download a file, given the file ID
+    '''
+    project_id = project_id or get_project_id()
+    ext = f'api/projects/{project_id}/data/{data_id}:createDownloadUrl'
+    return get_client().post(ext).json()['url']
+
+# most download URLs to request in one call
+URL_BATCH_SIZE = 100
+_BATCH_URLS = True
+
+def create_download_urls(data_ids: List[str], project_id: str=None,
+                         threads: int=8) -> Dict[str, str]:
+    ''' get presigned URLs to download many files, given the file IDs
     
-    data_id = data[0]['data']['id']
+    URLs are requested in a single call, or one call per file (made
+    concurrently) if the batch endpoint is unavailable.
     
-    ext = f'api/projects/{project_id}/data/{data_id}:createDownloadUrl'
-    r = requests.post(BASE_URL + ext, headers=_ICA_HEADERS)
-    r.raise_for_status()
+    Returns:
+        dictionary of URLs by file ID
+    '''
+    global _BATCH_URLS
+    project_id = project_id or get_project_id()
+    if _BATCH_URLS and len(data_ids) > 1:
+        ext = f'api/projects/{project_id}/data:createDownloadUrls'
+        body = json.dumps({'dataIds': list(data_ids)})
+        try:
+            items = get_client().post(ext, data=body).json()['items']
+            return {x['dataId']: x['url'] for x in items}
+        except requests.exceptions.HTTPError as err:
+            if err.response is None or err.response.status_code not in (400, 404, 405):
+                raise
+            # don't try the batch endpoint again in this process
+            _BATCH_URLS = False
+    
+    with ThreadPoolExecutor(threads) as pool:
+        urls = pool.map(lambda x: create_download_url(x, project_id), data_ids)
+        return dict(zip(data_ids, urls))
+
+def get_file(path: str, chunk_size: int=MB):
+    ''' get a file contents (streamed in chunks of 1 MB)
+    '''
+    url, _ = get_download_url(path)
+    r = get_client().fetch('GET', url, stream=True)
+    return r.iter_content(chunk_size)
+
+def verify_transfer(name: str, etag: str | None, checksums: Dict[str, str],
+                    local: Path | str=None):
+    ''' check the checksums of transferred data against the ETag on ICA
+    
+    Args:
+        name: name of the transferred file, for messages
+        etag: ETag of the file on ICA
+        checksums: checksums of the transferred data (from StreamHasher.result)
+        local: path to the local copy, to record its checksums for later syncs
+    '''
+    matched = check_etag(etag, checksums)
+    if matched is False:
+        raise ValueError(f'checksum mismatch for {name}: ICA has ETag '
+                         f'{clean_etag(etag)}, but the data has MD5 {checksums["md5"]}')
+    if matched is None:
+        sys.stderr.write(f'cannot verify {name}, ICA has no usable checksum\n')
+    if local is not None:
+        get_checksum_store().put(local, checksums['md5'], etag if matched else None)
+
+def download_folder(path: Path | str, outdir: Path | str, threads: int=8,
+                    part_size: int=32 * MB, verify=False):
+    ''' download every file within an ICA folder, mirroring the folder structure
+    
+    The folder is recreated inside the output directory, and files are
+    downloaded concurrently.
+    
+    Args:
+        path: path to ICA folder
+        outdir: local directory to download into
+        threads: number of files to download concurrently
+        part_size: size of byte ranges to fetch
+        verify: whether to check each file against its ETag on ICA
+    
+    Returns:
+        tuple of (number of files, list of (item, error) for failed downloads)
+    '''
+    root = Path(str(path).rstrip('/') or '/').parent
+    outdir = Path(outdir)
+    
+    files = []
+    for item in walk(path):
+        local = outdir / Path(item['path']).relative_to(root)
+        if item['type'] == 'FOLDER':
+            local.mkdir(parents=True, exist_ok=True)
+        else:
+            files.append((item, local))
+    
+    def download(entry):
+        item, local = entry
+        local.parent.mkdir(parents=True, exist_ok=True)
+        url = create_download_url(item['id'])
+        checksums = download_to_file(url, item['size'], local, 1, part_size,
+                                     verify, item['etag'])
+        if verify:
+            verify_transfer(item['path'], item['etag'], checksums, local)
+    
+    failed = run_batch(download, files, threads, label=lambda x: x[0]['path'])
+    return len(files), failed
+
+def read_manifest(path: Path | str, outdir: Path | str='.') -> List[Tuple[str, Path]]:
+    ''' read (ICA path, local path) pairs from a tab-separated manifest
+    
+    Each line has an ICA path, and optionally a local path to download to.
+    Files without a local path (or with a local folder ending in "/") are put
+    in the output folder (or the given folder) under their own name. Blank
+    lines, and lines starting with "#" are skipped.
+    '''
+    outdir = Path(outdir)
+    entries = []
+    with open(path, 'rt') as handle:
+        for line in handle:
+            line = line.rstrip('\r\n')
+            if line.strip() == '' or line.startswith('#'):
+                continue
+            source, _, local = line.partition('\t')
+            source = '/' + source.strip().lstrip('/')
+            name = source.rstrip('/').rsplit('/', 1)[-1]
+            if local.strip() == '':
+                local = outdir / name
+            elif local.endswith('/') or os.path.isdir(local):
+                local = Path(local) / name
+            else:
+                local = Path(local)
+            entries.append((source, local))
+    return entries
+
+def download_manifest(entries: List[Tuple[str, Path]], threads: int=8,
+                      part_size: int=32 * MB, verify=False):
+    ''' download many files, listed as (ICA path, local path) pairs
+    
+    Paths are resolved by listing each parent folder once, download URLs are
+    requested in batches, and files are downloaded concurrently in a bounded
+    pool. The status of each file is written to stdout as it finishes, as
+    tab-separated lines of status, ICA path and local path.
+    
+    Repeated entries are only downloaded once. Different ICA files with the
+    same local path (e.g. /s1/aligned.cram and /s2/aligned.cram, both without
+    a local path) fail, rather than being written into one file at once.
+    
+    Args:
+        entries: list of (ICA path, local path) tuples
+        threads: number of files to download concurrently
+        part_size: size of byte ranges to fetch
+        verify: whether to check each file against its ETag on ICA
+    
+    Returns:
+        tuple of (number of files, list of ((path, local), error) for failed
+        downloads)
+    '''
+    unique = {}
+    for source, local in entries:
+        unique.setdefault((str(source).rstrip('/'), os.path.abspath(local)), (source, local))
+    entries = list(unique.values())
+    
+    # sizes and ETags need to be current, so don't use cached details
+    found, missing = resolve_paths([x for x, _ in entries], threads, cached=False)
+    failed = [(x, ValueError('no such file')) for x in entries
+              if str(x[0]).rstrip('/') in missing]
+    
+    # find local paths wanted by more than one ICA file
+    sources = {}
+    for source, local in unique:
+        if source in found:
+            sources.setdefault(local, set()).add(source)
+    
+    files = []
+    for source, local in entries:
+        matches = found.get(str(source).rstrip('/'), [])
+        if len(matches) == 0:
+            continue
+        elif len(sources[os.path.abspath(local)]) > 1:
+            failed.append(((source, local), ValueError('local path is used by another file')))
+        elif len(matches) > 1:
+            failed.append(((source, local), ValueError('too many matches')))
+        elif len(matches) == 1 and matches[0]['type'] == 'FOLDER':
+            failed.append(((source, local), ValueError('is a folder')))
+        elif len(matches) == 1:
+            files.append((source, local, matches[0]))
+    
+    for (source, local), err in failed:
+        sys.stderr.write(f'failed: {source}: {err}\n')
+        sys.stdout.write(f'failed\t{source}\t{local}\n')
     
-    url = r.json()['url']
-    r = requests.get(url, stream=True)
-    r.raise_for_status()
-    return r.iter_content(1600)
+    urls = {}
+    def download(entry):
+        source, local, item = entry
+        local.parent.mkdir(parents=True, exist_ok=True)
+        checksums = download_to_file(urls[item['id']], item['size'], local, 1,
+                                     part_size, verify, item['etag'])
+        if verify:
+            verify_transfer(source, item['etag'], checksums, local)
+        sys.stdout.write(f'done\t{source}\t{local}\n')
+    
+    # get URLs shortly before they are used, as presigned URLs expire
+    for i in range(0, len(files), URL_BATCH_SIZE):
+        batch = files[i:i + URL_BATCH_SIZE]
+        urls = create_download_urls([x[2]['id'] for x in batch], threads=threads)
+        errors = run_batch(download, batch, threads, label=lambda x: x[0])
+        for (source, local, _), err in errors:
+            sys.stdout.write(f'failed\t{source}\t{local}\n')
+            failed.append(((source, local), err))
+    sys.stdout.flush()
+    return len(entries), failed
 
 def download_file(args):
     ''' download a file from ICA storage
+    
+    Byte ranges of the file are fetched over several concurrent connections.
+    These are either written directly into place in the output file, or
+    reassembled in order and written to stdout. With --verify, the data is
+    hashed while it downloads, then checked against the ETag on ICA.
     '''
+    if args.from_file is not None:
+        try:
+            entries = read_manifest(args.from_file, args.output or '.')
+            total, failed = download_manifest(entries, args.threads,
+                                              args.part_size * MB, args.verify)
+        except (OSError, ValueError) as err:
+            sys.stderr.write(f'{err}\n')
+            sys.exit(1)
+        report_batch(total, failed, 'downloaded')
+        return
+    
+    if args.PATH is None:
+        sys.stderr.write('a path to download is needed, or use --from-file\n')
+        sys.exit(1)
+    
+    if args.recursive:
+        try:
+            total, failed = download_folder(args.PATH, args.output or '.',
+                                            args.threads, args.part_size * MB,
+                                            args.verify)
+        except ValueError as err:
+            sys.stderr.write(err.args[0] + '\n')
+            sys.exit(1)
+        report_batch(total, failed, 'downloaded')
+        return
+    
     try:
-        # get_file returns a stream of bytes, which we simply write to stdout
-        for x in get_file(args.PATH):
-            sys.stdout.buffer.write(x)
+        item = get_download_item(args.PATH)
+        url, size = create_download_url(item['id']), item['size']
+        part_size = args.part_size * MB
+        if args.output is not None:
+            checksums = download_to_file(url, size, args.output, args.threads,
+                                         part_size, args.verify, item['etag'])
+        else:
+            hasher = StreamHasher(size, item['etag']) if args.verify else None
+            offset = 0
+            for x in stream_ranges(url, size, args.threads, part_size):
+                sys.stdout.buffer.write(x)
+                if hasher is not None:
+                    hasher.feed(offset, x)
+                    offset += len(x)
+            checksums = hasher.result() if hasher is not None else None
+        if args.verify:
+            verify_transfer(str(args.PATH), item['etag'], checksums, args.output)
     except ValueError as err:
         sys.stderr.write(err.args[0] + '\n')
         sys.exit(1)
@@ -262,7 +998,188 @@ def get_upload_name(infile, destination: Path | str, folder: Path | str):
     else:
         raise ValueError(f'cannot determine filename to save as from --path ({destination})')
 
-def upload_file(infile: str | io.BufferedReader | bytes, destination: Path, overwrite=False):
+def new_file(name: str, folder_id: str, folder_path: str, overwrite=False,
+             with_upload_url=True) -> Dict[str, Any]:
+    ''' create a file record on ICA, which data can then be uploaded into
+    
+    Args:
+        name: name for the file
+        folder_id: ID of the folder to create the file in
+        folder_path: path to the folder to create the file in
+        overwrite: whether to overwrite if file exists already
+        with_upload_url: whether to also request a URL to upload data into
+    
+    Returns:
+        JSON response from ICA. This contains an 'uploadUrl' entry if
+        with_upload_url is True, otherwise the new file details under 'data'.
+    '''
+    project_id = get_project_id()
+    body = {'name': name,
+            'folderId': folder_id
+            }
+    body = json.dumps(body)
+    
+    client = get_client()
+    action = 'createFileWithUploadUrl' if with_upload_url else 'createFile'
+    ext = f'api/projects/{project_id}/data:{action}'
+    try:
+        r = client.post(ext, data=body)
+    except requests.exceptions.HTTPError as e:
+        if e.response.status_code != 409:
+            raise e
+        if not overwrite:
+            raise ValueError(f'error: file already exists at {folder_path}{name}')
+        delete_file(f'{folder_path}{name}')
+        r = client.post(ext, data=body)
+    
+    cache = get_cache()
+    if cache is not None:
+        cache.invalidate(project_id, f'{folder_path}{name}')
+    return r.json()
+
+def make_folder(path: Path | str, project_id: str=None) -> Tuple[str, str]:
+    ''' find a folder on ICA, and create it if it doesn't exist yet
+    
+    The parent folder must already exist.
+    
+    Returns:
+        a tuple of (folder_id, folder_path)
+    '''
+    path = Path(path)
+    try:
+        data = next(get_data(path, project_id))
+    except (ValueError, StopIteration):
+        project_id = project_id or get_project_id()
+        body = {'name': path.name,
+                'folderPath': str(path.parent).rstrip('/') + '/',
+                }
+        ext = f'api/projects/{project_id}/data:createFolder'
+        data = get_client().post(ext, data=json.dumps(body)).json()
+    
+    if data['data']['details']['dataType'] != 'FOLDER':
+        raise ValueError(f'not a folder: {path}')
+    return data['data']['id'], data['data']['details']['path']
+
+def get_upload_credentials(data_id: str) -> Dict[str, str]:
+    ''' get temporary AWS credentials for uploading to a file
+    '''
+    project_id = get_project_id()
+    ext = f'api/projects/{project_id}/data/{data_id}:createTemporaryCredentials'
+    return get_client().post(ext).json()['awsTempCredentials']
+
+# most of a stream to hold in memory, when it can't be uploaded in parts
+SPOOL_SIZE = 64 * MB
+
+def buffer_stream(handle: io.IOBase, part_size: int=None,
+                  max_memory: int=SPOOL_SIZE) -> Tuple[Any, Iterable[bytes] | None]:
+    ''' prepare a file handle (e.g. stdin) for uploading with bounded memory
+    
+    Short streams are read into memory, and uploaded in one request. Longer
+    streams are uploaded in parts as they are read, if multipart uploads are
+    possible, with parts growing as the stream goes on if its length is
+    unknown. Otherwise, streams of unknown length are spilled to a temporary
+    file, since single uploads to S3 need to know the length up front. Single
+    uploads are limited to 5 GB, so this fails once a stream passes that.
+    
+    Args:
+        handle: file handle to read from
+        part_size: size of parts for multipart uploads, or None if unavailable
+        max_memory: most bytes to hold in memory if multipart uploads aren't used
+    
+    Returns:
+        tuple of (data for a single upload, or parts for a multipart upload)
+    '''
+    size = get_remaining(handle)
+    if part_size is not None:
+        part_size = get_part_size(size or 0, part_size)
+    if size is not None and (part_size is None or size <= part_size):
+        # regular files which fit in one part can be streamed as they are
+        return handle, None
+    
+    first = read_part(handle, part_size or max_memory)
+    if len(first) < (part_size or max_memory):
+        return first, None
+    elif part_size is not None:
+        grow_every = PART_GROWTH_INTERVAL if size is None else None
+        return None, itertools.chain([first], iter_parts(handle, part_size, grow_every))
+    
+    spilled = tempfile.TemporaryFile()
+    spilled.write(first)
+    del first
+    for chunk in iter(lambda: handle.read(MB), b''):
+        if spilled.tell() + len(chunk) > MAX_SINGLE_UPLOAD:
+            spilled.close()
+            raise ValueError('streams over 5 GB need multipart uploads, try: '
+                             'pip install icacli[multipart]')
+        spilled.write(chunk)
+    spilled.seek(0)
+    return spilled, None
+
+def upload_to_folder(infile: str | io.BufferedReader | bytes, name: str,
+                     folder_id: str, folder_path: str, overwrite=False,
+                     part_size: int=None, threads: int=8, verify=False):
+    ''' upload a file into a known ICA folder (see upload_file for arguments)
+    '''
+    local = infile if type(infile) == str else None
+    parts = None
+    handle = None  # file opened here, which needs closing after uploading
+    if isinstance(infile, io.IOBase):
+        stream = infile
+        infile, parts = buffer_stream(stream, part_size)
+        if infile is not stream and isinstance(infile, io.IOBase):
+            handle = infile  # a temporary file the stream was spilled to
+    
+    if part_size is not None and (parts is not None or (local is not None \
+            and os.path.getsize(infile) > part_size)):
+        data = new_file(name, folder_id, folder_path, overwrite, with_upload_url=False)
+        credentials = get_upload_credentials(data['data']['id'])
+        # multipart uploads are always checked, as each part is hashed anyway
+        etag = multipart_upload(parts or infile, credentials, part_size, threads)
+        if verify and local is not None:
+            get_checksum_store().put(local, None, etag)
+        return
+    
+    data = new_file(name, folder_id, folder_path, overwrite)
+    url = data['uploadUrl']
+    
+    if local is not None:
+        handle = infile = open(infile, 'rb')
+    
+    try:
+        if verify:
+            # hash the data as requests reads it, rather than reading it twice
+            infile = HashingReader(infile)
+        
+        client = get_client()
+        try:
+            r = client.fetch('PUT', url, data=infile, stream=True, headers=client.headers)
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code == 409:
+                raise ValueError
+            raise e
+        
+        tracer = get_tracer()
+        if tracer is not None:
+            tracer.add_bytes(int(r.request.headers.get('Content-Length') or 0))
+        
+        if verify:
+            # S3 gives the MD5 as the ETag for single uploads, and ICA's record of
+            # the ETag is the fallback if the upload response lacks it
+            etag = r.headers.get('ETag')
+            if r.headers.get('x-amz-server-side-encryption') == 'aws:kms':
+                # objects encrypted with KMS keys have ETags which aren't MD5-based
+                etag = None
+            elif not etag:
+                url = f'api/projects/{get_project_id()}/data/{data["data"]["id"]}'
+                etag = get_object_details(client.get(url).json())['etag']
+            verify_transfer(name, etag, infile.hasher.result(), local)
+    finally:
+        if handle is not None:
+            handle.close()
+
+def upload_file(infile: str | io.BufferedReader | bytes, destination: Path,
+                overwrite=False, part_size: int=None, threads: int=8,
+                verify=False):
     ''' upload a file to ICA
     
     Args:
@@ -272,57 +1189,80 @@ def upload_file(infile: str | io.BufferedReader | bytes, destination: Path, over
             which case the written file uses have the infile name), or a 
             complete file path.
         overwrite: whether to overwrite if file exists already
+        part_size: if given, local files larger than this are uploaded in
+            parts of this size (in bytes), otherwise uploads use one stream.
+        threads: number of parts to upload concurrently in multipart uploads
+        verify: whether to hash the data while uploading, and check it against
+            the ETag of the uploaded file
     '''
-    project_id = get_project_id()
     folder_id, folder_path = get_upload_folder(destination, overwrite)
     upload_name = get_upload_name(infile, destination, folder_path)
+    upload_to_folder(infile, upload_name, folder_id, folder_path, overwrite,
+                     part_size, threads, verify)
+
+def upload_folder(local: Path | str, destination: Path | str | None,
+                  overwrite=False, threads: int=8, part_size: int=None,
+                  verify=False):
+    ''' upload a local folder into an ICA folder, mirroring the folder structure
     
-    body = {'name': upload_name,
-            'folderId': folder_id
-            }
-    body = json.dumps(body)
+    Remote folders are created first, then files are uploaded concurrently.
     
-    ext = f'api/projects/{project_id}/data:createFileWithUploadUrl'
-    try:
-        r = requests.post(BASE_URL + ext, data=body, headers=_ICA_HEADERS)
-        r.raise_for_status()
-    except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 409:
-            if overwrite:
-                delete_file(upload_name)
-                r = requests.post(BASE_URL + ext, data=body, headers=_ICA_HEADERS)
-                r.raise_for_status()
-            else:
-                raise ValueError(f'error: file already exists at {folder_path}{upload_name}')
-        raise e
+    Args:
+        local: path to local folder
+        destination: ICA folder to upload into (None for the root folder). The
+            local folder is recreated inside this folder.
+        overwrite: whether to overwrite files which exist already
+        threads: number of files to upload concurrently
+        part_size: if given, files larger than this are uploaded in parts
+        verify: whether to check each file against its ETag after uploading
     
-    if type(infile) == str:
-        infile = open(infile, 'rb')
-
-    url = r.json()['uploadUrl']
-    try:
-        r = requests.put(url, data=infile, stream=True, headers=_ICA_HEADERS)
-        r.raise_for_status()
-    except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 409:
-            raise ValueError
-        raise e
+    Returns:
+        tuple of (number of files, list of (file, error) for failed uploads)
+    '''
+    local = Path(local)
+    top = str(destination or '').rstrip('/') + '/' + local.resolve().name
+    
+    files = []
+    for dirpath, _, filenames in os.walk(local):
+        relative = Path(dirpath).relative_to(local)
+        remote = top if str(relative) == '.' else f'{top}/{relative}'
+        folder = make_folder(remote)
+        files += [(os.path.join(dirpath, x), folder) for x in sorted(filenames)]
+    
+    def upload(entry):
+        infile, (folder_id, folder_path) = entry
+        upload_to_folder(infile, Path(infile).name, folder_id, folder_path,
+                         overwrite, part_size, threads=1, verify=verify)
+    
+    failed = run_batch(upload, files, threads, label=lambda x: x[0])
+    return len(files), failed
 
 def upload_wrapper(args):
     ''' upload a file to ICA storage
     '''
     infile = args.INFILE
+    part_size = args.part_size * MB if multipart_available() else None
+    if args.recursive:
+        if infile is None or not os.path.isdir(infile):
+            sys.stderr.write('a local folder is needed for recursive uploads\n')
+            sys.exit(1)
+        try:
+            total, failed = upload_folder(infile, args.path, args.force,
+                                          args.threads, part_size, args.verify)
+        except ValueError as err:
+            sys.stderr.write(err.args[0] + '\n')
+            sys.exit(1)
+        report_batch(total, failed, 'uploaded')
+        return
+    
     if infile is None:
-        # read stdin into memory. This might use too much memory with large inputs.
-        # TODO: figure out how to use sys.stdin directly, upload stdin directly
-        # TODO: via stream. Currently using sys.stdin raises an error. Fixing this
-        # TODO: would permit simple moving/coping of files by downloading and 
-        # TODO: re-uploading.
-        infile = sys.stdin.buffer.read()
+        # stdin is uploaded as it is read (see buffer_stream)
+        infile = sys.stdin.buffer
     
     try:
         # get_file returns a stream of bytes, which we simply write to stdout
-        upload_file(infile, args.path, args.force)
+        upload_file(infile, args.path, args.force, part_size, args.threads,
+                    args.verify)
     except ValueError as err:
         sys.stderr.write(err.args[0] + '\n')
         sys.exit(1)
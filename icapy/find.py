@@ -0,0 +1,222 @@
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import re
+import sys
+import time
+from typing import Any, Dict, Iterable, Tuple
+
+import requests
+
+from icapy.client import get_client
+from icapy.data import format_size, get_object_details, walk
+from icapy.index import get_index
+from icapy.output import parse_fields, write_records
+from icapy.paging import paginate
+from icapy.projects import select_projects
+from icapy.sync import parse_time
+
+# refresh indexes older than this many seconds before searching them
+REFRESH_AGE = 3600
+
+# how far before the last refresh to look for new data, to allow for clocks
+# differing between here and ICA, and for data which is slow to be listed
+REFRESH_OVERLAP = 600
+
+# fully rebuild indexes which were built more than this many seconds ago, since
+# refreshes find new data, but not data deleted elsewhere
+REBUILD_AGE = 7 * 86400
+
+def format_time(epoch: float) -> str:
+    ''' convert epoch seconds to an ICA timestamp (e.g. 2024-01-02T03:04:05Z)
+    '''
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def index_record(item: Dict[str, Any]) -> Dict[str, Any]:
+    ''' add epoch times to item details, for searching by date
+    '''
+    created, modified = item['created_date'], item['modified_date']
+    return {**item, 'created': parse_time(created) if created else None,
+            'modified': parse_time(modified) if modified else None}
+
+def store(items: Iterable[Dict[str, Any]], project_id: str, indexed: float,
+          batch_size: int=1000) -> int:
+    ''' add items to the index in batches, and get the number of items added
+    '''
+    index = get_index()
+    batch, total = [], 0
+    for item in items:
+        batch.append(index_record(item))
+        if len(batch) >= batch_size:
+            index.put(project_id, batch, indexed)
+            total += len(batch)
+            batch = []
+    index.put(project_id, batch, indexed)
+    return total + len(batch)
+
+def list_created_since(since: float, project_id: str) -> Iterable[Dict[str, Any]]:
+    ''' list details for all data in a project created after a given time
+    '''
+    client = get_client()
+    pagesize = 1000
+    ext = f'api/projects/{project_id}/data'
+    params = {'pageSize': pagesize, 'creationDateAfter': format_time(since)}
+    fetch = lambda offset: client.get(ext, params={**params, 'pageOffset': offset}).json()
+    for item in paginate(fetch, pagesize):
+        yield get_object_details(item)
+
+def get_item(data_id: str, project_id: str) -> Dict[str, Any] | None:
+    ''' get details for a data ID, or None if it no longer exists
+    '''
+    try:
+        r = get_client().get(f'api/projects/{project_id}/data/{data_id}')
+    except requests.exceptions.HTTPError as e:
+        if e.response.status_code in (404, 410):
+            return None
+        raise e
+    return get_object_details(r.json())
+
+def build_index(project_id: str, threads: int=8) -> int:
+    ''' index every file and folder in a project, replacing any earlier index
+    
+    The old entries are kept until the new ones are stored, so the index stays
+    usable if building is interrupted.
+    
+    Returns:
+        number of items indexed
+    '''
+    started = time.time()
+    total = store(walk('/', threads, project_id), project_id, started)
+    index = get_index()
+    index.prune(project_id, started)
+    index.set_build(project_id, started, started)
+    return total
+
+def refresh_index(project_id: str, threads: int=8, rebuild=False) -> int:
+    ''' bring the index of a project up to date
+    
+    Only data created since the last refresh is fetched (usually a single
+    call), plus any indexed data which could have changed since (e.g. files
+    which were still uploading). Data deleted by icapy is removed from the
+    index directly, but data deleted elsewhere is only dropped on rebuilding,
+    so indexes are rebuilt once they are REBUILD_AGE old.
+    
+    Args:
+        project_id: ID of project to index
+        threads: number of folders to list (or items to check) concurrently
+        rebuild: whether to build the index from scratch
+    
+    Returns:
+        number of items fetched
+    '''
+    index = get_index()
+    build = index.get_build(project_id)
+    if rebuild or build is None or time.time() - build['built'] > REBUILD_AGE:
+        return build_index(project_id, threads)
+    
+    started = time.time()
+    since = build['refreshed'] - REFRESH_OVERLAP
+    try:
+        total = store(list_created_since(since, project_id), project_id, started)
+    except requests.exceptions.HTTPError as e:
+        if e.response.status_code != 400:
+            raise e
+        # ICA doesn't support filtering by date here, so index everything
+        return build_index(project_id, threads)
+    
+    unsettled = index.unsettled(project_id)
+    with ThreadPoolExecutor(threads) as pool:
+        items = list(pool.map(lambda x: get_item(x, project_id), unsettled))
+    index.remove_ids(project_id, [x for x, item in zip(unsettled, items) if item is None])
+    total += store([x for x in items if x is not None], project_id, started)
+    index.set_build(project_id, build['built'], started)
+    return total
+
+UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+def parse_size(text: str) -> Tuple[int | None, int | None]:
+    ''' convert a size condition to (larger than, smaller than) in bytes
+    
+    Sizes can have units (k, M, G, T, in powers of 1024), and start with '+'
+    for larger than, '-' for smaller than, or neither for an exact size,
+    e.g. +1G for larger than 1 GB.
+    '''
+    match = re.fullmatch(r'([+-]?)(\d+(?:\.\d+)?)([kmgt]?)b?', text.strip().lower())
+    if match is None:
+        raise ValueError(f'cannot parse size: {text}')
+    sign, number, unit = match.groups()
+    size = int(float(number) * UNITS[unit])
+    if sign == '+':
+        return size, None
+    elif sign == '-':
+        return None, size
+    return size - 1, size + 1
+
+AGES = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+def parse_date(text: str) -> float:
+    ''' convert a date to epoch seconds
+    
+    Dates can be ISO dates or times (e.g. 2024-01-02, or 2024-01-02T03:04:05,
+    in local time unless a timezone is given), or ages, like 7d for 7 days ago
+    (using s, m, h, d or w).
+    '''
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([smhdw])', text.strip())
+    if match is not None:
+        return time.time() - float(match.group(1)) * AGES[match.group(2)]
+    try:
+        return datetime.fromisoformat(text.replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        raise ValueError(f'cannot parse date: {text}')
+
+def find_wrapper(args):
+    ''' search for data via the local index of each project
+    '''
+    if not args.PATH.startswith('/'):
+        sys.stderr.write(f'filepath must begin with "/": {args.PATH}\n')
+        sys.exit(1)
+    
+    try:
+        projects = select_projects(args.project, args.all_projects)
+        # combine size conditions, e.g. --size +1G --size -10G
+        bounds = [parse_size(x) for x in args.size or []]
+        larger = max([x for x, _ in bounds if x is not None], default=None)
+        smaller = min([x for _, x in bounds if x is not None], default=None)
+        dates = {x: parse_date(getattr(args, x)) for x in ['created_after',
+                 'created_before', 'modified_after', 'modified_before']
+                 if getattr(args, x) is not None}
+    except ValueError as err:
+        sys.stderr.write(err.args[0] + '\n')
+        sys.exit(1)
+    
+    index = get_index()
+    for project in projects:
+        build = index.get_build(project['id'])
+        if build is None or args.rebuild:
+            sys.stderr.write(f'indexing project {project["name"] or project["id"]}\n')
+        elif not args.refresh and time.time() - build['refreshed'] < REFRESH_AGE:
+            continue
+        refresh_index(project['id'], args.threads, args.rebuild)
+    
+    name = args.iname if args.iname is not None else args.name
+    data_type = {'f': 'FILE', 'd': 'FOLDER', None: None}[args.type]
+    items = index.search([x['id'] for x in projects], args.PATH, name,
+                         args.iname is not None, data_type, larger, smaller,
+                         **dates)
+    
+    fields, convert = parse_fields(args.fields), None
+    if fields is None and (args.format == 'tsv' or args.l):
+        fields = ['path']
+        if args.l:
+            fields += ['id', 'size', 'created_date']
+            convert = {'id': str.lower, 'size': format_size}
+    
+    names = {x['id']: x['name'] for x in projects}
+    if args.project or args.all_projects:
+        # tag each item with the project name, as ls does
+        items = ({**x, 'project': names[x['project']]} for x in items)
+        if fields is not None:
+            fields = ['project'] + fields
+    else:
+        items = ({k: v for k, v in x.items() if k != 'project'} for x in items)
+    write_records(items, fields, args.format, convert)
@@ -0,0 +1,145 @@
+
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+from fsspec import AbstractFileSystem
+from fsspec.spec import AbstractBufferedFile
+import requests
+
+from icapy.data import (create_download_url,
+                        get_data,
+                        get_details,
+                        get_object_details,
+                        list_files,
+                        )
+from icapy.projects import find_project
+from icapy.transfer import MB, fetch_range
+
+# presigned URLs are reused for this long (in seconds) before getting a new one
+URL_TTL = 600
+
+class ICAFileSystem(AbstractFileSystem):
+    ''' read-only fsspec filesystem for ICA data
+    
+    Paths look like ica://project/path/to/file, where the project is a name or
+    ID, or ica:///path/to/file for the default project. Files are read with
+    HTTP range requests against presigned URLs, so only the parts which are
+    read are downloaded e.g.
+    
+        import fsspec
+        with fsspec.open('ica://project/folder/file.parquet') as handle:
+            ...
+    
+    Args:
+        block_size: size of the byte ranges to fetch when reading files
+        cache_type: fsspec cache for file reads e.g. readahead, blockcache, bytes
+        url_ttl: seconds to reuse a presigned URL before getting a new one
+    '''
+    protocol = 'ica'
+    root_marker = ''
+    
+    def __init__(self, block_size: int=4 * MB, cache_type: str='readahead',
+                 url_ttl: float=URL_TTL, **kwargs):
+        super().__init__(**kwargs)
+        self.block_size = block_size
+        self.cache_type = cache_type
+        self.url_ttl = url_ttl
+        self.projects = {}
+        self.urls = {}
+        self.lock = threading.Lock()
+    
+    def split_path(self, path: str) -> Tuple[str, str | None, str]:
+        ''' split a path into (project part of path, project ID, path in project)
+        '''
+        path = self._strip_protocol(path)
+        if path == '' or path.startswith('/'):
+            return '', None, path or '/'
+        project, _, path = path.partition('/')
+        with self.lock:
+            if project not in self.projects:
+                try:
+                    self.projects[project] = find_project(project)['id']
+                except ValueError:
+                    raise FileNotFoundError(f'unknown project: {project}')
+        return project, self.projects[project], '/' + path
+    
+    def get_url(self, data_id: str, project_id: str | None, refresh: bool=False) -> str:
+        ''' get a presigned URL for a file, reusing recent URLs
+        '''
+        key = (project_id, data_id)
+        with self.lock:
+            url, created = self.urls.get(key, (None, 0))
+        if refresh or url is None or time.time() - created > self.url_ttl:
+            url = create_download_url(data_id, project_id)
+            with self.lock:
+                self.urls[key] = (url, time.time())
+        return url
+    
+    def to_info(self, project: str, details: Dict[str, Any]) -> Dict[str, Any]:
+        ''' convert ICA object details to an fsspec info dictionary
+        '''
+        name = details['path'].rstrip('/')
+        return {**details,
+                'name': f'{project}{name}',
+                'size': details['size'] or 0,
+                'type': 'directory' if details['type'] == 'FOLDER' else 'file',
+                }
+    
+    def ls(self, path: str, detail: bool=True, **kwargs) -> List[Dict[str, Any]] | List[str]:
+        project, project_id, ica_path = self.split_path(path)
+        try:
+            items = [self.to_info(project, x) for x in list_files(ica_path, project_id=project_id)]
+        except ValueError:
+            raise FileNotFoundError(path)
+        if detail:
+            return items
+        return [x['name'] for x in items]
+    
+    def info(self, path: str, **kwargs) -> Dict[str, Any]:
+        project, project_id, ica_path = self.split_path(path)
+        if ica_path == '/':
+            return {'name': project or '/', 'size': 0, 'type': 'directory'}
+        try:
+            items = list(get_data(ica_path, project_id))
+        except ValueError:
+            items = []
+        if len(items) == 0:
+            raise FileNotFoundError(path)
+        return self.to_info(project, get_object_details(items[0]))
+    
+    def _open(self, path: str, mode: str='rb', block_size: int=None,
+              cache_type: str=None, cache_options: Dict=None, **kwargs):
+        if mode != 'rb':
+            raise NotImplementedError('ICA files can only be opened for reading')
+        return ICAFile(self, path, mode,
+                       block_size=block_size or self.block_size,
+                       cache_type=cache_type or self.cache_type,
+                       cache_options=cache_options, **kwargs)
+
+class ICAFile(AbstractBufferedFile):
+    ''' file object for reading from ICA, using byte range requests
+    '''
+    def __init__(self, fs: ICAFileSystem, path: str, mode: str='rb', **kwargs):
+        details = fs.info(path)
+        if details['type'] != 'file':
+            raise IsADirectoryError(path)
+        _, self.project_id, _ = fs.split_path(path)
+        self.data_id = details['id']
+        # info can come from the path cache, so get the current size to read
+        size = get_details(self.data_id, self.project_id)['size']
+        super().__init__(fs, path, mode, size=size, **kwargs)
+    
+    def _fetch_range(self, start: int, end: int) -> bytes:
+        end = min(end, self.size)
+        if start >= end:
+            return b''
+        url = self.fs.get_url(self.data_id, self.project_id)
+        try:
+            return bytes(fetch_range(url, start, end - 1, self.size))
+        except requests.exceptions.HTTPError as err:
+            # presigned URLs can expire early, so get a new one and try again
+            if err.response is None or err.response.status_code not in (400, 403):
+                raise
+            url = self.fs.get_url(self.data_id, self.project_id, refresh=True)
+            return bytes(fetch_range(url, start, end - 1, self.size))
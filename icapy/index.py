@@ -0,0 +1,206 @@
+
+from fnmatch import fnmatchcase
+from pathlib import Path
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, List
+
+from icapy.config import get_config_path
+
+# fields of each indexed item, in the order of the table columns
+FIELDS = ['id', 'path', 'name', 'type', 'size', 'created', 'modified',
+          'created_date', 'modified_date', 'etag', 'status']
+
+# statuses of data which won't change without a new creation time
+SETTLED = ('AVAILABLE', 'ARCHIVED')
+
+def escape_like(text: str) -> str:
+    ''' escape LIKE wildcards, since ICA paths can contain '%' and '_'
+    '''
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def glob_match(pattern: str, name: str, ignore_case: int) -> bool:
+    if ignore_case:
+        pattern, name = pattern.lower(), name.lower()
+    return fnmatchcase(name, pattern)
+
+class DataIndex:
+    ''' local index of the data in ICA projects, for searching without API calls
+    
+    Each item is stored with its path, ID, type, size and times, keyed by
+    project and ID, in a sqlite database. Times are stored as epoch seconds
+    (created, modified) for searching, and as ICA gives them for output. Each
+    project records when it was last fully built and last refreshed, so later
+    refreshes only need to fetch data created since then.
+    '''
+    def __init__(self, path: Path | str=None):
+        if path is None:
+            path = get_index_path()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), timeout=30, check_same_thread=False)
+        self.db.create_function('glob_match', 3, glob_match, deterministic=True)
+        with self.lock, self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS items (
+                                project TEXT,
+                                id TEXT,
+                                path TEXT,
+                                name TEXT,
+                                type TEXT,
+                                size INTEGER,
+                                created REAL,
+                                modified REAL,
+                                created_date TEXT,
+                                modified_date TEXT,
+                                etag TEXT,
+                                status TEXT,
+                                indexed REAL,
+                                PRIMARY KEY (project, id))''')
+            self.db.execute('CREATE INDEX IF NOT EXISTS items_path ON items (project, path)')
+            self.db.execute('''CREATE TABLE IF NOT EXISTS builds (
+                                project TEXT PRIMARY KEY,
+                                built REAL,
+                                refreshed REAL)''')
+    
+    def put(self, project: str, items: Iterable[Dict[str, Any]], indexed: float):
+        ''' store items (from get_object_details, with epoch 'created' and
+        'modified' times), noting when they were seen
+        '''
+        rows = [(project, *[x.get(k) for k in FIELDS], indexed) for x in items]
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO items VALUES '
+                                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    
+    def prune(self, project: str, before: float):
+        ''' remove items which weren't seen since a given time (e.g. after a
+        full rebuild, the items which no longer exist)
+        '''
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM items WHERE project = ? AND indexed < ?',
+                            (project, before))
+    
+    def remove(self, project: str, path: str):
+        ''' remove a path, and anything nested within it, from the index
+        '''
+        path = path.rstrip('/')
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM items WHERE project = ? AND '
+                            "(path IN (?, ?) OR path LIKE ? ESCAPE '\\')",
+                            (project, path, path + '/', escape_like(path) + '/%'))
+    
+    def remove_ids(self, project: str, ids: Iterable[str]):
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM items WHERE project = ? AND id = ?',
+                                [(project, x) for x in ids])
+    
+    def move(self, project: str, old: str, new: str):
+        ''' change the path of an item, and anything nested within it
+        '''
+        old, new = old.rstrip('/'), new.rstrip('/')
+        with self.lock, self.db:
+            self.db.execute('UPDATE items SET path = ? || substr(path, ?), '
+                            "name = CASE WHEN path IN (?, ?) THEN ? ELSE name END "
+                            'WHERE project = ? AND (path IN (?, ?) OR '
+                            "path LIKE ? ESCAPE '\\')",
+                            (new, len(old) + 1, old, old + '/', new.rsplit('/', 1)[-1],
+                             project, old, old + '/', escape_like(old) + '/%'))
+    
+    def unsettled(self, project: str) -> List[str]:
+        ''' get IDs of items which could still change (e.g. partial uploads)
+        '''
+        with self.lock:
+            rows = self.db.execute('SELECT id FROM items WHERE project = ? AND '
+                                   f'status NOT IN {SETTLED}', (project, )).fetchall()
+        return [x[0] for x in rows]
+    
+    def get_build(self, project: str) -> Dict[str, float] | None:
+        ''' get when a project was last fully built and last refreshed, or None
+        if the project was never indexed
+        '''
+        with self.lock:
+            row = self.db.execute('SELECT built, refreshed FROM builds '
+                                  'WHERE project = ?', (project, )).fetchone()
+        if row is None:
+            return None
+        return {'built': row[0], 'refreshed': row[1]}
+    
+    def expire(self, project: str):
+        ''' mark the index of a project as out of date, so it is rebuilt on
+        next use (e.g. after changes which refreshes wouldn't find)
+        '''
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM builds WHERE project = ?', (project, ))
+    
+    def set_build(self, project: str, built: float, refreshed: float):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO builds VALUES (?, ?, ?)',
+                            (project, built, refreshed))
+    
+    def search(self, projects: List[str], folder: str='/', name: str=None,
+               ignore_case=False, data_type: str=None, larger: int=None,
+               smaller: int=None, created_after: float=None,
+               created_before: float=None, modified_after: float=None,
+               modified_before: float=None) -> Iterable[Dict[str, Any]]:
+        ''' find indexed items matching every given condition, in path order
+        
+        Args:
+            projects: IDs of projects to search in
+            folder: only find items nested within this folder
+            name: glob pattern for item names (e.g. '*.vcf.gz')
+            ignore_case: whether to match names regardless of case
+            data_type: FILE or FOLDER
+            larger: only find items larger than this (in bytes)
+            smaller: only find items smaller than this (in bytes)
+            created_after: only find items created after this (epoch seconds)
+            created_before: only find items created before this
+            modified_after: only find items modified after this
+            modified_before: only find items modified before this
+        '''
+        conditions = [f'project IN ({", ".join("?" * len(projects))})']
+        values = list(projects)
+        folder = folder.rstrip('/') + '/'
+        if folder != '/':
+            conditions.append("path LIKE ? ESCAPE '\\' AND path != ?")
+            values += [escape_like(folder) + '%', folder]
+        for condition, value in [('type = ?', data_type),
+                                 ('size > ?', larger),
+                                 ('size < ?', smaller),
+                                 ('created > ?', created_after),
+                                 ('created < ?', created_before),
+                                 ('modified > ?', modified_after),
+                                 ('modified < ?', modified_before),
+                                 ('glob_match(?, name, ?)', name)]:
+            if value is not None:
+                conditions.append(condition)
+                values.append(value)
+        if name is not None:
+            values.append(int(ignore_case))
+        
+        columns = ['project', 'name', 'path', 'created_date', 'modified_date',
+                   'size', 'id', 'type', 'etag', 'status']
+        query = f'SELECT {", ".join(columns)} FROM items ' \
+                f'WHERE {" AND ".join(conditions)} ORDER BY project, path'
+        with self.lock:
+            rows = self.db.execute(query, values).fetchall()
+        for row in rows:
+            yield dict(zip(columns, row))
+
+def get_index_path() -> Path:
+    return get_config_path().parent / 'index.sqlite'
+
+_INDEX = None
+_INDEX_LOCK = threading.Lock()
+
+def get_index(create=True) -> DataIndex | None:
+    ''' get the shared data index
+    
+    Args:
+        create: whether to create the index if it doesn't exist yet, otherwise
+            this gives None, so other commands don't make an unused index
+    '''
+    global _INDEX
+    with _INDEX_LOCK:
+        if _INDEX is None:
+            if not create and not get_index_path().exists():
+                return None
+            _INDEX = DataIndex()
+    return _INDEX
@@ -1,96 +1,273 @@
 
+from itertools import islice
+import json
 import sys
-from typing import Dict, Iterable
+import time
+from typing import Dict, Iterable, List, Tuple
 
 import requests
 
-from icapy.config import (BASE_URL,
-                          _ICA_HEADERS,
-                          )
-from icapy.projects import get_project_id
+from icapy.client import get_client
+from icapy.output import parse_fields, write_records
+from icapy.paging import paginate
+from icapy.projects import fan_out, get_project_id, select_projects
 
-def get_analyses(status: str=None, max_jobs: int=5000) -> Iterable[Dict]:
-    ''' find all analyses, possibly filtered by job state
+# merge some statuses, since they represent stages of the same state
+STATES = {
+    'aborted': ['aborted', 'aborting'],
+    'running': ['in_progress',
+                'initializing',
+                'preparing_inputs',
+                'queued'],
+    'failed': ['failed'],
+    'requested': ['requested'],
+    'succeeded': ['succeeded'],
+}
+
+# job states which won't change any more
+TERMINAL = {'aborted', 'failed', 'succeeded'}
+
+def get_state(job: Dict) -> str:
+    ''' get the merged job state (e.g. running) for an analysis
     '''
-    project_id = get_project_id()
-    ext = f'api/projects/{project_id}/analysis:search'
-    pagesize = 1000
-    params = {'pageOffset': 0, 'pageSize': pagesize}
-    r = requests.post(BASE_URL + ext, headers=_ICA_HEADERS, params=params)
-    r.raise_for_status()
-    res = r.json()
-    
-    # merge some statuses, since they represent stages of the same state
-    states = {
-        'aborted': ['aborted', 'aborting'],
-        'running': ['in_progress',
-                    'initializing',
-                    'preparing_inputs',
-                    'queued'],
-        'failed': ['failed'],
-        'requested': ['requested'],
-        'succeeded': ['succeeded'],
-    }
+    status = job['status'].lower()
+    for state, statuses in STATES.items():
+        if status in statuses:
+            return state
+    return status
+
+def job_matches(job: Dict, status: str=None, tags: List[str]=None,
+                pipeline: str=None, since: str=None, before: str=None,
+                modified_since: str=None) -> bool:
+    ''' check if an analysis passes the job filters (see get_analyses)
+    '''
+    if modified_since is not None and job.get('timeModified', modified_since) < modified_since:
+        return False
+    if status is not None and job['status'].lower() not in STATES[status]:
+        return False
+    if tags is not None:
+        # look for any match between the supplied tags and the job tags
+        if not any(bool(set(v) & set(tags)) for v in job['tags'].values()):
+            return False
+    if pipeline is not None and job['pipeline']['code'] != pipeline:
+        return False
+    if since is not None and job['timeCreated'] < since:
+        return False
+    if before is not None and job['timeCreated'] >= before:
+        return False
+    return True
+
+def get_analyses(status: str=None, max_jobs: int=5000, tags: List[str]=None,
+                 pipeline: str=None, since: str=None, before: str=None,
+                 modified_since: str=None, project_id: str=None) -> Iterable[Dict]:
+    ''' find analyses (most recently created first), possibly filtered
+    
+    The filters are sent with the search request, so the server only needs to
+    return matching analyses, and sorts them. Each analysis is checked here
+    too, so results stay correct if the server ignores a filter.
+    
+    Args:
+        status: job state, one of aborted, running, failed, requested, succeeded
+        max_jobs: stop after this many matching analyses
+        tags: only include analyses with any of these tags
+        pipeline: only include analyses for this pipeline code
+        since: only include analyses created on/after this time (ISO format,
+            e.g. 2024-01-31 or 2024-01-31T12:00:00Z)
+        before: only include analyses created before this time (ISO format)
+        modified_since: only include analyses modified on/after this time
+        project_id: project to search (the default project if None)
+    '''
+    if status is not None:
+        assert status in STATES
     
+    criteria = {}
     if status is not None:
-        assert status in states
+        criteria['statuses'] = [x.upper() for x in STATES[status]]
+    if tags is not None:
+        criteria['tags'] = tags
+    if pipeline is not None:
+        criteria['pipelineCodes'] = [pipeline]
+    if since is not None:
+        criteria['timeCreatedAfter'] = since
+    if before is not None:
+        criteria['timeCreatedBefore'] = before
+    if modified_since is not None:
+        criteria['timeModifiedAfter'] = modified_since
+    body = json.dumps(criteria)
     
-    i = 0
-    for item in res['items']:
-        i += 1
-        if status is not None and item['status'].lower() not in states[status]:
+    if max_jobs <= 0:
+        return
+    
+    project_id = project_id or get_project_id()
+    ext = f'api/projects/{project_id}/analysis:search'
+    # don't fetch more than needed if only a few jobs are wanted, but keep pages
+    # large enough in case the server ignores the filters, and few jobs match
+    pagesize = max(100, min(1000, max_jobs))
+    prefetch = 1 if max_jobs <= pagesize else 4
+    client = get_client()
+    
+    def fetch(offset):
+        params = {'pageOffset': offset,
+                  'pageSize': pagesize,
+                  'sort': 'timeCreated desc',
+                  }
+        return client.post(ext, params=params, data=body).json()
+    
+    found = 0
+    for item in paginate(fetch, pagesize, prefetch):
+        if not job_matches(item, status, tags, pipeline, since, before, modified_since):
             continue
         yield item
-        if i > max_jobs:
+        found += 1
+        if found >= max_jobs:
+            # stop here, which also cancels any pages being prefetched
             break
-    
-    while len(res['items']) >= pagesize and i < max_jobs:
-        params['pageOffset'] += pagesize
-        r = requests.post(BASE_URL + ext, headers=_ICA_HEADERS, params=params)
-        r.raise_for_status()
-        res = r.json()
-        for item in res['items']:
-            i += 1
-            if status is not None and item['status'].lower() not in states[status]:
-                continue
-            yield item
 
-def get_analysis(analysis_id: str) -> Dict:
+def get_analysis(analysis_id: str, project_id: str=None) -> Dict:
     ''' get details for a single analysis job
     '''
-    header = {k:v for k, v in _ICA_HEADERS.items()}
-    header['accept'] = 'application/vnd.illumina.v4+json'
-    project_id = get_project_id()
+    header = {'accept': 'application/vnd.illumina.v4+json'}
+    project_id = project_id or get_project_id()
     ext = f'api/projects/{project_id}/analyses/{analysis_id}'
-    r = requests.get(BASE_URL + ext, headers=header)
-    r.raise_for_status()
-    return r.json()
+    return get_client().get(ext, headers=header).json()
+
+def format_job(job: Dict) -> List[str]:
+    ''' get the fields to show for a job
+    '''
+    # jobname, job_id, time_submitted, status
+    return [job["pipeline"]["code"], 
+            job["userReference"],
+            job["id"],
+            job['timeCreated'],
+            job["status"].lower(),
+            ]
+
+def poll_jobs(status: str=None, tags: List[str]=None, pipeline: str=None,
+              ids: List[str]=None, interval: float=10,
+              max_interval: float=300, project_id: str=None,
+              known: Dict[str, str]=None) -> Iterable[Tuple[Dict, str]]:
+    ''' watch analyses, and yield (analysis, previous status) when a job changes
+    
+    The first poll gets the current jobs (or the jobs for the given IDs). After
+    that, only analyses modified since the latest change seen are requested,
+    and compared against the known statuses. The polling interval doubles
+    (up to max_interval) while nothing changes, and resets once a job changes.
+    
+    Args:
+        status: only report jobs moving into or out of this state
+        tags: only include analyses with any of these tags
+        pipeline: only include analyses for this pipeline code
+        ids: only watch these analyses (ignoring tags and pipeline), and stop
+            once all have finished
+        interval: initial seconds between polls
+        max_interval: longest time between polls
+        project_id: project to watch (the default project if None)
+        known: dictionary to keep the latest status of each job in, by ID,
+            including jobs which aren't yielded as they don't match the status
+    '''
+    known = {} if known is None else known
+    watermark = None
+    delay = interval
+    while True:
+        if ids is not None:
+            jobs = [get_analysis(x, project_id) for x in ids]
+        elif watermark is None:
+            jobs = get_analyses(status, tags=tags, pipeline=pipeline,
+                                project_id=project_id)
+        else:
+            # don't filter by status, since we need jobs which leave a state
+            jobs = get_analyses(None, max_jobs=2 ** 31, tags=tags,
+                                pipeline=pipeline, modified_since=watermark,
+                                project_id=project_id)
+        
+        changed = False
+        for job in jobs:
+            modified = job.get('timeModified', job['timeCreated'])
+            watermark = max(watermark or modified, modified)
+            previous = known.get(job['id'])
+            known[job['id']] = job['status'].lower()
+            if previous == known[job['id']]:
+                continue
+            changed = True
+            if status is None or status in (get_state(job), previous and get_state({'status': previous})):
+                yield job, previous
+        
+        if ids is not None and all(get_state({'status': known.get(x, '')}) in TERMINAL for x in ids):
+            return
+        
+        delay = interval if changed else min(delay * 2, max_interval)
+        time.sleep(delay)
+
+def watch_jobs(args, project_id: str=None):
+    ''' command to print job status changes to stdout, as they happen
+    '''
+    ids = args.wait_for
+    if args.id is not None:
+        ids = [args.id] + (ids or [])
+    
+    # the latest status of every job, whether or not it matches --status
+    known = {}
+    for job, previous in poll_jobs(args.status, args.tag, args.pipeline, ids,
+                                   args.interval, args.max_interval, project_id,
+                                   known):
+        line = format_job(job)
+        line.insert(-1, previous or '-')
+        sys.stdout.write('\t'.join(line) + '\n')
+        sys.stdout.flush()
+    
+    # if waiting for jobs, exit with an error unless they all succeeded
+    if ids is not None and any(get_state({'status': known.get(x, '')}) != 'succeeded'
+                               for x in ids):
+        sys.exit(1)
 
 def find_jobs(args):
     ''' command to print job info to stdout (possibly for a single status)
+    
+    With --project or --all-projects, the projects are searched concurrently,
+    and each job is tagged with its project.
     '''
     statuses = ['aborted', 'running', 'failed', 'requested', 'succeeded', None]
     if args.status not in statuses:
         sys.stderr.write(f'status must be one of: {statuses}\n')
         sys.exit(1)
-
-    if args.id is None:
-        jobs = get_analyses(args.status, args.max_jobs)
-    else:
-        jobs = [get_analysis(args.id)]
-    
-    for job in jobs:
-        if args.tag is not None:
-            tags = set(args.tag)
-            # look for any match between the supplied tags and the job tags
-            if not any(bool(set(v) & tags) for v in job['tags'].values()):
-                continue
-            
-        # jobname, job_id, time_submitted, status
-        line = [job["pipeline"]["code"], 
-                job["userReference"],
-                job["id"],
-                job['timeCreated'],
-                job["status"].lower(),
-                ]
-        sys.stdout.write('\t'.join(line) + '\n')
+    
+    projects = None
+    if args.project or args.all_projects:
+        try:
+            projects = select_projects(args.project, args.all_projects)
+        except ValueError as err:
+            sys.stderr.write(err.args[0] + '\n')
+            sys.exit(1)
+    
+    if args.watch or args.wait_for is not None:
+        if projects is not None and len(projects) > 1:
+            sys.stderr.write('jobs can only be watched in one project at a time\n')
+            sys.exit(1)
+        return watch_jobs(args, projects[0]['id'] if projects else None)
+    
+    def search(project_id):
+        if args.id is None:
+            return get_analyses(args.status, args.max_jobs, args.tag,
+                                args.pipeline, args.since, args.before,
+                                project_id=project_id)
+        job = get_analysis(args.id, project_id)
+        return [job] if job_matches(job, tags=args.tag) else []
+    
+    fields, convert = parse_fields(args.fields), None
+    if fields is None and args.format == 'tsv':
+        fields = ['pipeline.code', 'userReference', 'id', 'timeCreated', 'status']
+        convert = {'status': str.lower}
+    
+    if projects is None:
+        write_records(search(None), fields, args.format, convert)
+        return
+    
+    if fields is not None:
+        fields = ['project'] + fields
+    # a job ID only exists in one project, so the others give errors
+    ignore = requests.exceptions.HTTPError if args.id is not None else ()
+    merged = fan_out(search, projects, ignore=ignore)
+    try:
+        write_records(islice(merged, args.max_jobs), fields, args.format, convert)
+    finally:
+        merged.close()
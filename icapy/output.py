@@ -0,0 +1,101 @@
+
+import json
+import sys
+from typing import Any, Callable, Dict, Iterable, List
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# output formats for listings
+FORMATS = ['tsv', 'ndjson']
+
+def encode_json(value: Any) -> bytes:
+    ''' encode a value as compact JSON, using orjson if it is installed
+    '''
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(',', ':')).encode('utf8')
+
+def parse_fields(fields: str | None) -> List[str] | None:
+    ''' split a comma-separated list of field names (e.g. from --fields)
+    '''
+    if fields is None:
+        return None
+    return [x.strip() for x in fields.split(',') if x.strip() != '']
+
+def field_getter(field: str) -> Callable[[Dict[str, Any]], Any]:
+    ''' make a function to get a field from a record. Nested fields are
+    separated by '.', e.g. pipeline.code, and missing fields give None.
+    '''
+    keys = field.split('.')
+    if len(keys) == 1:
+        return lambda record: record.get(field)
+    
+    def get(record):
+        for key in keys:
+            if not isinstance(record, dict):
+                return None
+            record = record.get(key)
+        return record
+    return get
+
+def to_text(value: Any) -> str:
+    ''' convert a value to text for a TSV column
+    '''
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        return encode_json(value).decode('utf8')
+    return str(value)
+
+def write_records(records: Iterable[Dict[str, Any]], fields: List[str]=None,
+                  fmt: str='tsv', convert: Dict[str, Callable[[Any], str]]=None,
+                  batch_size: int=1000):
+    ''' write records to stdout as TSV or newline-delimited JSON
+    
+    Only the requested fields are taken from each record, and lines are
+    written in batches, so long listings aren't slowed down by formatting.
+    
+    Args:
+        records: dictionaries to write out
+        fields: field names to write (in order). If None, ndjson output has
+            whole records (TSV output needs fields).
+        fmt: output format, either 'tsv' or 'ndjson'
+        convert: optional functions to format values of some fields for TSV
+        batch_size: number of lines to collect before each write
+    '''
+    if fmt not in FORMATS:
+        raise ValueError(f'unknown output format: {fmt}')
+    if fields is None and fmt == 'tsv':
+        raise ValueError('TSV output needs a list of fields')
+    
+    convert = convert or {}
+    getters = [field_getter(x) for x in fields] if fields is not None else None
+    if fmt == 'ndjson':
+        if getters is None:
+            format_line = encode_json
+        else:
+            def format_line(record):
+                return encode_json({k: get(record) for k, get in zip(fields, getters)})
+    else:
+        getters = [(field_getter(x), convert.get(x, to_text)) for x in fields]
+        def format_line(record):
+            return '\t'.join([text(get(record)) for get, text in getters]).encode('utf8')
+    
+    # write bytes directly, after anything already written as text
+    sys.stdout.flush()
+    out = sys.stdout.buffer
+    lines = []
+    try:
+        for record in records:
+            lines.append(format_line(record))
+            if len(lines) >= batch_size:
+                out.write(b'\n'.join(lines) + b'\n')
+                lines = []
+    finally:
+        # write what we have, even if listing fails partway
+        if len(lines) > 0:
+            out.write(b'\n'.join(lines) + b'\n')
+        out.flush()
@@ -0,0 +1,56 @@
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable
+
+def paginate(fetch: Callable[[int], Dict[str, Any]], pagesize: int,
+             prefetch: int=4) -> Iterable[Dict[str, Any]]:
+    ''' yield items from a paginated API endpoint, fetching pages in the background
+    
+    Pages are requested ahead of the consumer. If the first page reports the
+    total number of items, up to `prefetch` pages are requested concurrently,
+    otherwise only the next page is fetched while the current page is used.
+    Items are always yielded in order, and at most `prefetch` pages are
+    fetched ahead, which bounds memory use.
+    
+    Args:
+        fetch: function which gets the JSON response for a page offset
+        pagesize: number of items per page
+        prefetch: maximum number of pages to fetch ahead of the consumer
+    '''
+    res = fetch(0)
+    total = res.get('totalItemCount')
+    if total is not None and 0 < len(res['items']) < min(pagesize, total):
+        # the server gave a smaller page than requested, so step by its size
+        pagesize = len(res['items'])
+    if len(res['items']) < pagesize:
+        yield from res['items']
+        return
+    
+    depth = max(prefetch, 1) if total is not None else 1
+    offsets = iter(range(pagesize, total if total is not None else 2 ** 63, pagesize))
+    
+    with ThreadPoolExecutor(depth) as pool:
+        pending = deque()
+        
+        def fill():
+            for offset in offsets:
+                pending.append(pool.submit(fetch, offset))
+                if len(pending) >= depth:
+                    break
+        
+        try:
+            while True:
+                # request upcoming pages before handing over the current page
+                fill()
+                yield from res['items']
+                if len(pending) == 0:
+                    return
+                res = pending.popleft().result()
+                if len(res['items']) < pagesize:
+                    yield from res['items']
+                    return
+        finally:
+            # stop fetching if the consumer exits early, or we reached the end
+            for job in pending:
+                job.cancel()
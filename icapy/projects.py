@@ -1,38 +1,129 @@
 
 
+from concurrent.futures import ThreadPoolExecutor
+import queue
 import sys
-from typing import Dict, Iterable
+import threading
+from typing import Callable, Dict, Iterable, List
 
-import requests
-
-from icapy.config import (BASE_URL,
-                          load_config,
+from icapy.config import (load_config,
                           write_config,
                           get_ica_key,
                           get_tenant,
-                          _ICA_HEADERS,
                           )
+from icapy.cache import get_cache
+from icapy.client import get_client
+from icapy.paging import paginate
+
+# how long (in seconds) the cached list of projects is used for
+PROJECT_TTL = 86400
 
 def get_projects() -> Iterable[Dict]:
     ''' find all projects
     '''
     ext = 'api/projects'
-    pagesize = 10
-    params = {'pageOffset': 0, 'pageSize': pagesize}
-    r = requests.get(BASE_URL + ext, headers=_ICA_HEADERS, params=params)
-    r.raise_for_status()
-    res = r.json()
-    
-    for item in res['items']:
-        yield item
+    pagesize = 1000
+    client = get_client()
+    
+    def fetch(offset):
+        params = {'pageOffset': offset, 'pageSize': pagesize}
+        return client.get(ext, params=params).json()
+    
+    yield from paginate(fetch, pagesize)
 
-    while len(res['items']) >= pagesize:
-        params['pageOffset'] += pagesize
-        r = requests.get(BASE_URL + ext, headers=_ICA_HEADERS, params=params)
-        r.raise_for_status()
-        res = r.json()
-        for item in res['items']:
-            yield item
+def get_project_catalog(refresh=False) -> List[Dict[str, str]]:
+    ''' get the ID and name of every project, from the local cache if recent
+    
+    The catalog is cached for PROJECT_TTL seconds, since projects change rarely
+    but listing them all takes a few calls.
+    
+    Args:
+        refresh: whether to fetch the projects from ICA, even if cached
+    '''
+    cache = get_cache()
+    key = get_client().base_url + load_config().get('tenant', '')
+    if cache is not None and not refresh:
+        projects = cache.get_projects(key, PROJECT_TTL)
+        if projects is not None:
+            return projects
+    
+    projects = [{'id': x['id'], 'name': x['name']} for x in get_projects()]
+    if cache is not None:
+        cache.put_projects(key, projects)
+    return projects
+
+def select_projects(names: List[str]=None, all_projects=False) -> List[Dict[str, str]]:
+    ''' get the projects for the --project and --all-projects options
+    
+    Args:
+        names: project names or IDs
+        all_projects: whether to use every project
+    
+    Returns:
+        list of project details (ID and name), or the default project if no
+        projects were requested
+    '''
+    if all_projects:
+        return get_project_catalog()
+    if not names:
+        config = load_config()
+        return [{'id': get_project_id(), 'name': config.get('ica_project_name', '')}]
+    return [find_project(x) for x in names]
+
+def fan_out(func: Callable[[str], Iterable[Dict]], projects: List[Dict[str, str]],
+            threads: int=8, ignore=()) -> Iterable[Dict]:
+    ''' run a query in many projects concurrently, and merge the results
+    
+    Results are yielded as they arrive from each project, with the project
+    name added under 'project'. Projects where the query fails are reported to
+    stderr (unless the error is one of the ignored types) and skipped.
+    
+    Args:
+        func: function which takes a project ID, and yields results
+        projects: projects to query (from select_projects)
+        threads: number of projects to query at once
+        ignore: exception types to skip silently, e.g. for paths which don't
+            exist in every project
+    '''
+    results = queue.Queue(maxsize=1000)
+    stop = threading.Event()
+    finished = object()
+    
+    def put(value):
+        # don't block forever if the consumer stopped early
+        while not stop.is_set():
+            try:
+                return results.put(value, timeout=0.1)
+            except queue.Full:
+                pass
+    
+    def run(project):
+        try:
+            for item in func(project['id']):
+                if stop.is_set():
+                    return
+                put({'project': project['name'], **item})
+        except ignore:
+            pass
+        except Exception as err:
+            sys.stderr.write(f'failed: project {project["name"]}: {err}\n')
+        finally:
+            put(finished)
+    
+    pool = ThreadPoolExecutor(threads)
+    try:
+        for project in projects:
+            pool.submit(run, project)
+        remaining = len(projects)
+        while remaining > 0:
+            item = results.get()
+            if item is finished:
+                remaining -= 1
+            else:
+                yield item
+    finally:
+        stop.set()
+        pool.shutdown(cancel_futures=True)
 
 def list_projects(*args):
     ''' command to list projects to stdout
@@ -47,12 +138,12 @@ def list_projects(*args):
 def set_default_project(*args):
     ''' set the default project
     '''
-    projects = [(x['name'], x['id']) for x in get_projects()]
+    projects = [(x['name'], x['id']) for x in get_project_catalog(refresh=True)]
     names, ids = zip(*projects)
     if len(names) == 0:
         sys.stderr.write('no projects available to select from\n')
         sys.exit(1)
-        
+    
     if len(names) == 1:
         sys.stderr.write(f'one project available, setting as default ({names[0]})')
         selection = 0
@@ -89,12 +180,12 @@ def set_default_project(*args):
 def set_default_project(*args):
     ''' set the default project
     '''
-    projects = [(x['name'], x['id']) for x in get_projects()]
+    projects = [(x['name'], x['id']) for x in get_project_catalog(refresh=True)]
     names, ids = zip(*projects)
     if len(names) == 0:
         sys.stderr.write('no projects available to select from\n')
         sys.exit(1)
-        
+    
     if len(names) == 1:
         sys.stderr.write(f'one project available, setting as default ({names[0]})')
         selection = 0
@@ -128,6 +219,18 @@ def set_default_project(*args):
     
     write_config(config)
 
+def find_project(project: str) -> Dict:
+    ''' find a project (ID and name) by its name or ID
+    
+    This checks the cached project catalog first, and only fetches the
+    projects from ICA if the project isn't in the catalog (e.g. if new).
+    '''
+    for refresh in [False, True]:
+        for item in get_project_catalog(refresh):
+            if project in (item['id'], item['name']):
+                return item
+    raise ValueError(f'unknown project: {project}')
+
 def get_project_id() -> str:
     config = load_config()
     if 'ica_project_id' not in config:
@@ -0,0 +1,620 @@
+
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import hashlib
+import os
+import re
+import struct
+import sys
+import zlib
+from typing import Any, Dict, Iterable, List, Tuple
+
+from icapy.client import get_client
+from icapy.config import get_config_path
+from icapy.data import create_download_url, get_data, get_details, get_object_details
+from icapy.transfer import fetch_range
+
+# compressed BGZF blocks are at most 64 KB
+MAX_BLOCK_SIZE = 65536
+
+# fetch byte ranges separated by less than this as a single range
+GAP = 64 * 1024
+
+# index suffixes to look for, by data file suffix (in order of preference)
+INDEXES = {
+    '.bam': ['.bai', '.csi'],
+    '.cram': ['.crai'],
+    '.gz': ['.tbi', '.csi'],
+    '.bgz': ['.tbi', '.csi'],
+}
+
+# size of the EOF container at the end of CRAM files, by major version
+CRAM_EOF_SIZE = {2: 30, 3: 38}
+
+# tabix file formats
+TABIX_VCF = 2
+TABIX_ZERO_BASED = 0x10000
+
+CIGAR_OPS = 'MIDNSHP=X'
+SEQ_CODES = '=ACMGRSVTWYHKDBN'
+# bases for each byte of packed BAM sequence, and quality score characters
+SEQ_PAIRS = [x + y for x in SEQ_CODES for y in SEQ_CODES]
+QUAL_CHARS = bytes(min(x + 33, 126) for x in range(256))
+TAG_TYPES = {'c': 'b', 'C': 'B', 's': 'h', 'S': 'H', 'i': 'i', 'I': 'I', 'f': 'f'}
+
+def parse_region(region: str) -> Tuple[str, int, int]:
+    ''' convert a region (e.g. chr1:1,000-2,000) to a sequence name, and 0-based
+    start and end positions (end exclusive). The positions are optional.
+    '''
+    match = re.match(r'^(?P<name>[^:]+)(:(?P<start>[\d,]+)?(-(?P<end>[\d,]+))?)?$', region)
+    if match is None:
+        raise ValueError(f'cannot parse region: {region}')
+    start = int((match.group('start') or '1').replace(',', ''))
+    end = int((match.group('end') or str(2 ** 31 - 1)).replace(',', ''))
+    return match.group('name'), max(start - 1, 0), end
+
+def coalesce(ranges: Iterable[Tuple[int, int]], gap: int=GAP) -> List[Tuple[int, int]]:
+    ''' merge byte ranges (with inclusive ends) which overlap, or are close
+    '''
+    merged = []
+    for start, end in sorted(ranges):
+        if len(merged) > 0 and start <= merged[-1][1] + gap:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def fetch_ranges(url: str, ranges: Iterable[Tuple[int, int]], gap: int=GAP,
+                 threads: int=8) -> List[Tuple[int, bytearray]]:
+    ''' fetch byte ranges concurrently, after merging nearby ranges
+    
+    Returns:
+        list of (start, data) for the merged ranges, sorted by start
+    '''
+    merged = coalesce(ranges, gap)
+    with ThreadPoolExecutor(threads) as pool:
+        data = pool.map(lambda x: fetch_range(url, *x), merged)
+        return list(zip([x[0] for x in merged], data))
+
+def slice_ranges(fetched: List[Tuple[int, bytearray]], start: int, end: int) -> memoryview:
+    ''' get the bytes from start to end (inclusive) out of fetched ranges
+    '''
+    for offset, data in fetched:
+        if offset <= start and start + 1 <= offset + len(data):
+            return memoryview(data)[start - offset:end + 1 - offset]
+    raise ValueError(f'byte range {start}-{end} was not fetched')
+
+def inflate_blocks(data: bytes, offset: int=0) -> Iterable[Tuple[int, int, bytes]]:
+    ''' decompress consecutive BGZF blocks, stopping at an incomplete block
+    
+    Args:
+        data: compressed data, starting at the beginning of a block
+        offset: position of the data within the file
+    
+    Returns:
+        iterator of (block offset, next block offset, decompressed data)
+    '''
+    data = memoryview(data)
+    pos = 0
+    while pos + 18 <= len(data):
+        xlen, = struct.unpack_from('<H', data, pos + 10)
+        bsize, extra = None, pos + 12
+        while extra < pos + 12 + xlen:
+            si1, si2, slen = struct.unpack_from('<BBH', data, extra)
+            if si1 == 66 and si2 == 67:
+                bsize, = struct.unpack_from('<H', data, extra + 4)
+            extra += 4 + slen
+        if bsize is None:
+            raise ValueError('data is not BGZF compressed')
+        end = pos + bsize + 1
+        if end > len(data):
+            return
+        yield offset + pos, offset + end, zlib.decompress(data[pos + 12 + xlen:end - 8], -15)
+        pos = end
+
+def read_chunk(data: bytes, start: int, vbeg: int, vend: int) -> bytes:
+    ''' decompress the data between two BGZF virtual offsets
+    
+    Args:
+        data: fetched bytes, which include the blocks for the chunk
+        start: position of the fetched bytes in the file
+        vbeg: virtual offset for the start of the chunk
+        vend: virtual offset for the end of the chunk
+    '''
+    first, last = vbeg >> 16, vend >> 16
+    parts = []
+    for offset, _, block in inflate_blocks(memoryview(data)[first - start:], first):
+        lower = vbeg & 0xffff if offset == first else 0
+        if offset == last:
+            parts.append(block[lower:vend & 0xffff])
+            break
+        parts.append(block[lower:])
+    return b''.join(parts)
+
+def stream_blocks(url: str, size: int, step: int=4 * MAX_BLOCK_SIZE) -> Iterable[bytes]:
+    ''' yield decompressed BGZF blocks from the start of a file, fetching more as needed
+    '''
+    buffer, pos = b'', 0
+    while pos < size:
+        start = pos + len(buffer)
+        if start >= size:
+            # the file ends with an incomplete block
+            return
+        buffer += bytes(fetch_range(url, start, min(start + step, size) - 1))
+        used = 0
+        for _, after, block in inflate_blocks(buffer, pos):
+            used = after - pos
+            yield block
+        buffer, pos = buffer[used:], pos + used
+
+class BlockReader:
+    ''' read bytes from decompressed blocks, as if from a file
+    '''
+    def __init__(self, blocks: Iterable[bytes]):
+        self.blocks = iter(blocks)
+        self.buffer = b''
+    
+    def read(self, n: int) -> bytes:
+        while len(self.buffer) < n:
+            block = next(self.blocks, None)
+            if block is None:
+                raise ValueError('unexpected end of file')
+            self.buffer += block
+        data, self.buffer = self.buffer[:n], self.buffer[n:]
+        return data
+
+def reg2bins(beg: int, end: int, min_shift: int=14, depth: int=5) -> List[int]:
+    ''' find the bins which could hold data overlapping a 0-based region
+    '''
+    bins, first, shift = [], 0, min_shift + depth * 3
+    end -= 1
+    for level in range(depth + 1):
+        bins.extend(range(first + (beg >> shift), first + (end >> shift) + 1))
+        shift -= 3
+        first += 1 << (level * 3)
+    return bins
+
+def parse_bins(data: bytes, pos: int, csi: bool=False) -> Tuple[Dict[str, Any], int]:
+    ''' parse the bins (and linear index) for one reference sequence of an index
+    '''
+    n_bin, = struct.unpack_from('<i', data, pos)
+    pos += 4
+    bins = {}
+    for _ in range(n_bin):
+        if csi:
+            bin, _, n_chunk = struct.unpack_from('<IQi', data, pos)
+            pos += 16
+        else:
+            bin, n_chunk = struct.unpack_from('<Ii', data, pos)
+            pos += 8
+        chunks = struct.unpack_from(f'<{n_chunk * 2}Q', data, pos)
+        pos += n_chunk * 16
+        bins[bin] = list(zip(chunks[::2], chunks[1::2]))
+    
+    linear = ()
+    if not csi:
+        n_intv, = struct.unpack_from('<i', data, pos)
+        linear = struct.unpack_from(f'<{n_intv}Q', data, pos + 4)
+        pos += 4 + n_intv * 8
+    return {'bins': bins, 'linear': linear}, pos
+
+def parse_tabix_meta(data: bytes, pos: int) -> Tuple[Dict[str, Any], int]:
+    ''' parse the column definitions and sequence names in a tabix index
+    '''
+    keys = ['format', 'col_seq', 'col_beg', 'col_end', 'meta', 'skip', 'l_nm']
+    meta = dict(zip(keys, struct.unpack_from('<7i', data, pos)))
+    pos += 28
+    names = bytes(data[pos:pos + meta['l_nm']]).rstrip(b'\0').split(b'\0')
+    meta['names'] = [x.decode('utf8') for x in names]
+    return meta, pos + meta['l_nm']
+
+def parse_index(data: bytes) -> Dict[str, Any]:
+    ''' parse a BAI, TBI or CSI index
+    
+    Returns:
+        dictionary with bins per reference sequence, the binning scheme, and
+        tabix details (for indexes of compressed text files)
+    '''
+    if data[:2] == b'\x1f\x8b':
+        data = gzip.decompress(data)
+    magic = bytes(data[:4])
+    index = {'min_shift': 14, 'depth': 5, 'tabix': None, 'refs': []}
+    if magic == b'BAI\1':
+        n_ref, = struct.unpack_from('<i', data, 4)
+        pos = 8
+    elif magic == b'TBI\1':
+        n_ref, = struct.unpack_from('<i', data, 4)
+        index['tabix'], pos = parse_tabix_meta(data, 8)
+    elif magic == b'CSI\1':
+        index['min_shift'], index['depth'], l_aux = struct.unpack_from('<3i', data, 4)
+        if l_aux >= 28:
+            index['tabix'], _ = parse_tabix_meta(data, 16)
+        n_ref, = struct.unpack_from('<i', data, 16 + l_aux)
+        pos = 20 + l_aux
+    else:
+        raise ValueError('unknown index format')
+    
+    for _ in range(n_ref):
+        ref, pos = parse_bins(data, pos, csi=magic == b'CSI\1')
+        index['refs'].append(ref)
+    return index
+
+def query_chunks(index: Dict[str, Any], ref_id: int, beg: int, end: int) -> List[Tuple[int, int]]:
+    ''' find the chunks (as virtual offsets) with data overlapping a region
+    '''
+    ref = index['refs'][ref_id]
+    bins = reg2bins(beg, end, index['min_shift'], index['depth'])
+    chunks = [x for bin in bins for x in ref['bins'].get(bin, [])]
+    
+    # skip chunks which end before the first data in the region's window
+    linear = ref['linear']
+    if len(linear) > 0:
+        min_offset = linear[min(beg >> index['min_shift'], len(linear) - 1)]
+        chunks = [x for x in chunks if x[1] > min_offset]
+    
+    merged = []
+    for vbeg, vend in sorted(chunks):
+        if len(merged) > 0 and vbeg <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], vend))
+        else:
+            merged.append((vbeg, vend))
+    return merged
+
+def find_ref(names: List[str], name: str) -> int:
+    ''' find the index of a sequence name, allowing for a missing 'chr' prefix
+    '''
+    for x in [name, 'chr' + name, name[3:] if name.startswith('chr') else None]:
+        if x in names:
+            return names.index(x)
+    raise ValueError(f'unknown sequence: {name}')
+
+def read_bam_header(reader: BlockReader) -> Tuple[str, List[str]]:
+    ''' get the header text and reference sequence names from the start of a BAM
+    '''
+    if reader.read(4) != b'BAM\1':
+        raise ValueError('not a BAM file')
+    l_text, = struct.unpack('<i', reader.read(4))
+    text = reader.read(l_text).rstrip(b'\0').decode('utf8')
+    n_ref, = struct.unpack('<i', reader.read(4))
+    names = []
+    for _ in range(n_ref):
+        l_name, = struct.unpack('<i', reader.read(4))
+        names.append(reader.read(l_name).rstrip(b'\0').decode('utf8'))
+        reader.read(4)
+    return text, names
+
+def format_tags(rec: bytes, pos: int) -> List[str]:
+    ''' convert the optional fields of a BAM record to SAM text
+    '''
+    tags = []
+    while pos < len(rec):
+        tag, kind = rec[pos:pos + 2].decode('ascii'), chr(rec[pos + 2])
+        pos += 3
+        if kind == 'A':
+            tags.append(f'{tag}:A:{chr(rec[pos])}')
+            pos += 1
+        elif kind in TAG_TYPES:
+            fmt = TAG_TYPES[kind]
+            value, = struct.unpack_from('<' + fmt, rec, pos)
+            pos += struct.calcsize(fmt)
+            tags.append(f'{tag}:f:{value:g}' if kind == 'f' else f'{tag}:i:{value}')
+        elif kind in 'ZH':
+            end = rec.index(0, pos)
+            tags.append(f'{tag}:{kind}:{rec[pos:end].decode("utf8")}')
+            pos = end + 1
+        elif kind == 'B':
+            sub = chr(rec[pos])
+            count, = struct.unpack_from('<i', rec, pos + 1)
+            values = struct.unpack_from(f'<{count}{TAG_TYPES[sub]}', rec, pos + 5)
+            pos += 5 + count * struct.calcsize(TAG_TYPES[sub])
+            values = [f'{x:g}' if sub == 'f' else str(x) for x in values]
+            tags.append(f'{tag}:B:' + ','.join([sub] + values))
+        else:
+            raise ValueError(f'unknown BAM tag type: {kind}')
+    return tags
+
+def bam_records(data: bytes, names: List[str], ref_id: int, beg: int,
+                end: int) -> Iterable[str]:
+    ''' convert the BAM records overlapping a region to SAM lines
+    '''
+    pos = 0
+    while pos + 4 <= len(data):
+        size, = struct.unpack_from('<i', data, pos)
+        rec = data[pos + 4:pos + 4 + size]
+        pos += 4 + size
+        (ref, start, l_name, mapq, _, n_cigar, flag, l_seq, next_ref, next_pos,
+            tlen) = struct.unpack_from('<iiBBHHHiiii', rec, 0)
+        if ref != ref_id:
+            continue
+        if start >= end:
+            break
+        
+        offset = 32 + l_name
+        cigar = struct.unpack_from(f'<{n_cigar}I', rec, offset)
+        offset += n_cigar * 4
+        length = sum(x >> 4 for x in cigar if CIGAR_OPS[x & 0xf] in 'MDN=X')
+        if start + max(length, 1) <= beg:
+            continue
+        
+        packed = rec[offset:offset + (l_seq + 1) // 2]
+        seq = ''.join([SEQ_PAIRS[x] for x in packed])[:l_seq]
+        offset += len(packed)
+        qual = rec[offset:offset + l_seq]
+        offset += l_seq
+        
+        if next_ref == -1:
+            rnext = '*'
+        elif next_ref == ref:
+            rnext = '='
+        else:
+            rnext = names[next_ref]
+        line = [rec[32:32 + l_name - 1].decode('utf8'),
+                str(flag),
+                names[ref],
+                str(start + 1),
+                str(mapq),
+                ''.join(f'{x >> 4}{CIGAR_OPS[x & 0xf]}' for x in cigar) or '*',
+                rnext,
+                str(next_pos + 1),
+                str(tlen),
+                seq or '*',
+                '*' if l_seq == 0 or qual[0] == 0xff else qual.translate(QUAL_CHARS).decode('ascii'),
+                ] + format_tags(rec, offset)
+        yield '\t'.join(line)
+
+def tabix_records(data: bytes, meta: Dict[str, Any], name: str, beg: int,
+                  end: int) -> Iterable[bytes]:
+    ''' find the lines of a tabix-indexed file which overlap a region
+    '''
+    name = name.encode('utf8')
+    fmt = meta['format'] & 0xffff
+    offset = 0 if meta['format'] & TABIX_ZERO_BASED else 1
+    for line in data.split(b'\n'):
+        if line == b'' or line[0] == meta['meta']:
+            continue
+        cols = line.split(b'\t')
+        if cols[meta['col_seq'] - 1] != name:
+            continue
+        start = int(cols[meta['col_beg'] - 1]) - offset
+        if fmt == TABIX_VCF:
+            stop = start + len(cols[3])
+        elif meta['col_end'] > 0:
+            stop = int(cols[meta['col_end'] - 1])
+        else:
+            stop = start + 1
+        if start >= end:
+            break
+        if stop > beg:
+            yield line
+
+def tabix_header(url: str, size: int, meta: Dict[str, Any]) -> Iterable[bytes]:
+    ''' get the header lines from the start of a tabix-indexed file
+    '''
+    buffer, count = b'', 0
+    for block in stream_blocks(url, size):
+        lines = (buffer + block).split(b'\n')
+        buffer = lines.pop()
+        for line in lines:
+            if line[:1] != bytes([meta['meta']]) and count >= meta['skip']:
+                return
+            count += 1
+            yield line
+
+def get_cached_index(item: Dict[str, Any]) -> bytes:
+    ''' get the contents of an index file, downloading it if not cached locally
+    
+    Indexes are cached by ID and ETag (or modification time), so a replaced
+    index is downloaded again.
+    '''
+    folder = get_config_path().parent / 'indexes'
+    folder.mkdir(exist_ok=True)
+    key = f"{item['id']}:{item.get('etag') or item.get('modified_date')}"
+    path = folder / (hashlib.md5(key.encode('utf8')).hexdigest() + os.path.splitext(item['name'])[1])
+    if path.exists():
+        return path.read_bytes()
+    
+    url = create_download_url(item['id'])
+    data = get_client().fetch('GET', url).content
+    temp = path.with_name(path.name + f'.{os.getpid()}.tmp')
+    temp.write_bytes(data)
+    temp.replace(path)
+    return data
+
+def lookup(path: str) -> Dict[str, Any] | None:
+    ''' get the details for a path on ICA, or None if nothing is there
+    '''
+    try:
+        return next((get_object_details(x) for x in get_data(path)), None)
+    except ValueError:
+        return None
+
+def find_index(path: str) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    ''' find the details for a data file and its index on ICA
+    
+    Each candidate index is looked up by its exact name, rather than listing
+    the folder, which could hold many thousands of files.
+    
+    Returns:
+        tuple of (data file details, index file details)
+    '''
+    path = str(path)
+    suffix = next((x for x in INDEXES if path.endswith(x)), None)
+    if suffix is None:
+        raise ValueError(f'unknown file type (no index expected) for {path}')
+    stem = path[:-len(suffix)]
+    # prefer indexes named like file.bam.bai over file.bai
+    candidates = [path + x for x in INDEXES[suffix]] + [stem + x for x in INDEXES[suffix]]
+    
+    data = lookup(path)
+    if data is None:
+        raise ValueError(f'cannot access data at {path}')
+    for candidate in candidates:
+        index = lookup(candidate)
+        if index is not None:
+            # sizes and ETags are used for fetching, so get current details
+            return get_details(data['id']), get_details(index['id'])
+    raise ValueError(f'cannot find an index for {path}')
+
+def view_bgzf(url: str, size: int, index: Dict[str, Any], region: str,
+              names: List[str]=None, gap: int=GAP, threads: int=8) -> Iterable[bytes]:
+    ''' get the records overlapping a region from a BGZF file (BAM or tabix)
+    '''
+    name, beg, end = parse_region(region)
+    names = index['tabix']['names'] if index['tabix'] is not None else names
+    ref_id = find_ref(names, name)
+    chunks = query_chunks(index, ref_id, beg, end)
+    
+    ranges = [(x >> 16, min((y >> 16) + MAX_BLOCK_SIZE, size) - 1) for x, y in chunks]
+    fetched = fetch_ranges(url, ranges, gap, threads)
+    for vbeg, vend in chunks:
+        start, data = next((x, y) for x, y in reversed(fetched) if x <= vbeg >> 16)
+        data = read_chunk(data, start, vbeg, vend)
+        if index['tabix'] is not None:
+            lines = tabix_records(data, index['tabix'], names[ref_id], beg, end)
+        else:
+            lines = (x.encode('utf8') for x in bam_records(data, names, ref_id, beg, end))
+        lines = list(lines)
+        if len(lines) > 0:
+            yield b'\n'.join(lines) + b'\n'
+
+def read_itf8(data: bytes, pos: int) -> Tuple[int, int]:
+    ''' read a CRAM ITF-8 encoded integer, returning (value, next position)
+    '''
+    first = data[pos]
+    n = 0
+    while n < 4 and first & (0x80 >> n):
+        n += 1
+    if n == 4:
+        value = ((first & 0x0f) << 28) | (data[pos + 1] << 20) | (data[pos + 2] << 12) \
+            | (data[pos + 3] << 4) | (data[pos + 4] & 0x0f)
+        return value, pos + 5
+    value = first & (0xff >> (n + 1))
+    for i in range(n):
+        value = (value << 8) | data[pos + 1 + i]
+    return value, pos + n + 1
+
+def read_ltf8(data: bytes, pos: int) -> Tuple[int, int]:
+    ''' read a CRAM LTF-8 encoded integer, returning (value, next position)
+    '''
+    first = data[pos]
+    n = 0
+    while n < 8 and first & (0x80 >> n):
+        n += 1
+    value = first & (0xff >> (n + 1))
+    for i in range(n):
+        value = (value << 8) | data[pos + 1 + i]
+    return value, pos + n + 1
+
+def read_cram_names(data: bytes) -> List[str]:
+    ''' get the reference sequence names from the header container of a CRAM
+    '''
+    major = data[4]
+    pos = 26 + 4  # skip the file definition, and container length
+    for _ in range(4):
+        _, pos = read_itf8(data, pos)
+    for _ in range(2):
+        _, pos = read_ltf8(data, pos)
+    _, pos = read_itf8(data, pos)
+    n_landmarks, pos = read_itf8(data, pos)
+    for _ in range(n_landmarks):
+        _, pos = read_itf8(data, pos)
+    pos += 4 if major >= 3 else 0
+    
+    # the first block holds the SAM header
+    method = data[pos]
+    pos += 2
+    _, pos = read_itf8(data, pos)
+    compressed, pos = read_itf8(data, pos)
+    _, pos = read_itf8(data, pos)
+    block = bytes(data[pos:pos + compressed])
+    if method == 1:
+        block = gzip.decompress(block)
+    elif method != 0:
+        raise ValueError('cannot read compressed CRAM header')
+    l_text, = struct.unpack_from('<i', block, 0)
+    text = block[4:4 + l_text].decode('utf8')
+    return [field[3:] for line in text.splitlines() if line.startswith('@SQ')
+            for field in line.split('\t') if field.startswith('SN:')]
+
+def view_cram(url: str, size: int, crai: bytes, region: str, gap: int=GAP,
+              threads: int=8) -> Iterable[bytes]:
+    ''' get a CRAM with only the containers which overlap a region
+    
+    CRAM records can't be decoded without the reference sequence, so this
+    gives the file header, the overlapping containers, and the EOF container,
+    which together make a valid (small) CRAM file for samtools etc.
+    '''
+    name, beg, end = parse_region(region)
+    entries = [[int(x) for x in line.split('\t')]
+               for line in gzip.decompress(crai).decode('utf8').splitlines() if line]
+    starts = sorted({x[3] for x in entries})
+    if len(starts) == 0:
+        raise ValueError('CRAM index has no containers')
+    
+    header = fetch_range(url, 0, starts[0] - 1)
+    eof_size = CRAM_EOF_SIZE[min(max(header[4], 2), 3)]
+    ends = dict(zip(starts, starts[1:] + [size - eof_size]))
+    ref_id = find_ref(read_cram_names(header), name)
+    # slices spanning multiple references (-2) might hold the region too
+    wanted = sorted({x[3] for x in entries if x[0] == -2 or
+                     (x[0] == ref_id and x[1] - 1 < end and x[1] - 1 + x[2] > beg)})
+    
+    ranges = [(x, ends[x] - 1) for x in wanted] + [(size - eof_size, size - 1)]
+    fetched = fetch_ranges(url, ranges, gap, threads)
+    yield bytes(header)
+    for start, stop in ranges:
+        yield bytes(slice_ranges(fetched, start, stop))
+
+def view(path: str, region: str, header: bool=False, gap: int=GAP,
+         threads: int=8) -> Iterable[bytes]:
+    ''' get the data overlapping a genomic region, from an indexed file on ICA
+    
+    This uses the index next to the file (.bai, .csi, .crai or .tbi) to find
+    which compressed blocks hold the region, and only fetches those byte ranges.
+    Indexes are cached locally.
+    
+    Args:
+        path: path to a BAM, CRAM or bgzipped text file (e.g. VCF) on ICA
+        region: region to get e.g. chr1:1000-2000 (1-based, inclusive)
+        header: whether to include the file header (always included for CRAM)
+        gap: fetch byte ranges closer than this as a single range
+        threads: number of ranges to fetch concurrently
+    
+    Returns:
+        iterator of chunks of output (SAM or text lines, or a CRAM file)
+    '''
+    item, index_item = find_index(path)
+    url = create_download_url(item['id'])
+    size = item['size']
+    data = get_cached_index(index_item)
+    
+    if index_item['name'].endswith('.crai'):
+        yield from view_cram(url, size, data, region, gap, threads)
+        return
+    
+    index = parse_index(data)
+    names = None
+    if index['tabix'] is None:
+        text, names = read_bam_header(BlockReader(stream_blocks(url, size)))
+        if header and text != '':
+            yield text.rstrip('\n').encode('utf8') + b'\n'
+    elif header:
+        yield b''.join(x + b'\n' for x in tabix_header(url, size, index['tabix']))
+    yield from view_bgzf(url, size, index, region, names, gap, threads)
+
+def view_wrapper(args):
+    ''' converts the CLI args to a function call to view a region of a file
+    '''
+    if not str(args.FILE).startswith('/'):
+        sys.stderr.write(f'filepath must begin with "/": {args.FILE}\n')
+        sys.exit(1)
+    
+    out = sys.stdout.buffer
+    try:
+        for chunk in view(str(args.FILE), args.REGION, args.header,
+                          threads=args.threads):
+            out.write(chunk)
+    except ValueError as err:
+        sys.stderr.write(err.args[0] + '\n')
+        sys.exit(1)
+    out.flush()
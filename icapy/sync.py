@@ -0,0 +1,217 @@
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import os
+from pathlib import Path
+import sys
+from typing import Any, Dict, List, Tuple
+
+from icapy.batch import report_batch, run_batch
+from icapy.checksum import (check_etag,
+                            clean_etag,
+                            file_checksums,
+                            get_checksum_store,
+                            )
+from icapy.data import (create_download_url,
+                        make_folder,
+                        upload_to_folder,
+                        verify_transfer,
+                        walk,
+                        )
+from icapy.transfer import (MB,
+                            download_to_file,
+                            multipart_available,
+                            )
+
+def parse_time(value: str) -> float:
+    ''' convert an ICA timestamp (e.g. 2024-01-02T03:04:05.678Z) to epoch seconds
+    '''
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+def list_local(folder: Path | str) -> Dict[str, os.stat_result]:
+    ''' get stat details for every file in a local folder, by relative path
+    '''
+    folder = Path(folder)
+    files = {}
+    for dirpath, _, filenames in os.walk(folder):
+        for name in filenames:
+            path = Path(dirpath) / name
+            files[path.relative_to(folder).as_posix()] = path.stat()
+    return files
+
+def list_remote(folder: str, threads: int=8) -> Tuple[Dict[str, Dict[str, Any]],
+                                                     Dict[str, str]]:
+    ''' get details for every file and folder in an ICA folder, by relative path
+    
+    Returns:
+        tuple of (file details, folder IDs), both indexed by relative path
+    '''
+    root = folder.rstrip('/') + '/'
+    files, folders = {}, {}
+    try:
+        for item in walk(folder, threads):
+            relative = item['path'][len(root):].rstrip('/')
+            if item['type'] == 'FOLDER':
+                folders[relative] = item['id']
+            else:
+                files[relative] = item
+    except ValueError:
+        # the remote folder doesn't exist yet
+        pass
+    return files, folders
+
+def is_changed(local_path: Path, local: os.stat_result | None,
+               remote: Dict[str, Any] | None, upload: bool, checksum: bool) -> bool:
+    ''' check whether a file needs transferring to bring the destination up to date
+    
+    Files differ if they only exist on one side, or the sizes differ. Otherwise
+    the checksums are compared against the remote ETag (if requested, and
+    the ETag can be checked), or we check if the source is newer.
+    
+    Checksums recorded by earlier transfers are reused while the local file is
+    unchanged, so files are only read if they weren't transferred before.
+    '''
+    if local is None or remote is None:
+        return True
+    if local.st_size != remote['size']:
+        return True
+    
+    etag = clean_etag(remote.get('etag'))
+    if checksum and etag != '':
+        store = get_checksum_store()
+        recorded = store.get(local_path)
+        if recorded is not None and recorded['etag'] == etag:
+            return False
+        if recorded is not None and recorded['md5'] and '-' not in etag:
+            return recorded['md5'] != etag
+        checksums = file_checksums(local_path, etag)
+        matched = check_etag(etag, checksums)
+        if matched is not None:
+            store.put(local_path, checksums['md5'], etag if matched else None)
+            return not matched
+    
+    remote_time = parse_time(remote['modified_date'] or remote['created_date'])
+    if upload:
+        return local.st_mtime > remote_time
+    return remote_time > local.st_mtime
+
+def plan_sync(local: Path | str, remote: str, upload: bool, checksum: bool=False,
+              threads: int=8) -> Tuple[List[str], Dict[str, os.stat_result],
+                                        Dict[str, Dict[str, Any]], Dict[str, str]]:
+    ''' find which files need transferring to sync a local and ICA folder
+    
+    Returns:
+        tuple of (relative paths to transfer, local file details, remote file
+        details, remote folder IDs)
+    '''
+    local = Path(local)
+    local_files = list_local(local) if local.exists() else {}
+    remote_files, remote_folders = list_remote(remote, threads)
+    
+    source = local_files if upload else remote_files
+    def check(relative):
+        return is_changed(local / relative, local_files.get(relative),
+                          remote_files.get(relative), upload, checksum)
+    
+    candidates = sorted(source)
+    with ThreadPoolExecutor(threads) as pool:
+        changed = [x for x, c in zip(candidates, pool.map(check, candidates)) if c]
+    return changed, local_files, remote_files, remote_folders
+
+def sync(local: Path | str, remote: str, upload: bool, dry_run: bool=False,
+         checksum: bool=False, threads: int=8, part_size: int=None,
+         verify: bool=False):
+    ''' bring a local folder and an ICA folder in step, in one direction
+    
+    Only files which are new, or differ from the destination are transferred.
+    
+    Args:
+        local: path to local folder
+        remote: path to ICA folder
+        upload: True to upload from local to ICA, False to download from ICA
+        dry_run: only print which files would be transferred
+        checksum: compare MD5 checksums of files of the same size, instead of
+            modification times
+        threads: number of files to transfer concurrently
+        part_size: size of parts for large uploads, and byte ranges for downloads
+        verify: whether to check transferred files against their ICA ETags
+    
+    Returns:
+        tuple of (number of files to transfer, list of failed transfers)
+    '''
+    local = Path(local)
+    remote = remote.rstrip('/') or '/'
+    root = remote.rstrip('/') + '/'
+    changed, _, remote_files, remote_folders = plan_sync(local, remote, upload,
+                                                         checksum, threads)
+    
+    action = 'upload' if upload else 'download'
+    if dry_run:
+        for relative in changed:
+            sys.stdout.write(f'{action}\t{relative}\n')
+        return len(changed), []
+    
+    if upload:
+        # create any missing remote folders (parents first) before uploading
+        folders = {}
+        needed = {str(Path(x).parent) for x in changed}
+        needed = {str(p) for x in needed for p in [Path(x), *Path(x).parents]}
+        for relative in sorted(needed, key=lambda x: (x.count('/'), x)):
+            if relative in remote_folders:
+                folders[relative] = (remote_folders[relative], f'{root}{relative}/')
+            else:
+                folders[relative] = make_folder(remote if relative == '.' else root + relative)
+        
+        def transfer(relative):
+            folder_id, folder_path = folders[str(Path(relative).parent)]
+            upload_to_folder(str(local / relative), Path(relative).name,
+                             folder_id, folder_path, overwrite=True,
+                             part_size=part_size, threads=1, verify=verify)
+    else:
+        def transfer(relative):
+            item = remote_files[relative]
+            path = local / relative
+            path.parent.mkdir(parents=True, exist_ok=True)
+            url = create_download_url(item['id'])
+            checksums = download_to_file(url, item['size'], path, 1,
+                                         part_size or 32 * MB, verify, item['etag'])
+            if verify:
+                verify_transfer(item['path'], item['etag'], checksums)
+            # match the remote time, so later syncs see the files as the same
+            mtime = parse_time(item['modified_date'] or item['created_date'])
+            os.utime(path, (mtime, mtime))
+            if verify:
+                # recorded after setting the time, which the record depends on
+                store = get_checksum_store()
+                matched = check_etag(item['etag'], checksums)
+                store.put(path, checksums['md5'], item['etag'] if matched else None)
+    
+    failed = run_batch(transfer, changed, threads)
+    return len(changed), failed
+
+def sync_wrapper(args):
+    ''' converts the CLI args to a function call for syncing folders
+    '''
+    if not str(args.REMOTE).startswith('/'):
+        sys.stderr.write(f'remote path must begin with "/": {args.REMOTE}\n')
+        sys.exit(1)
+    
+    upload = args.DIRECTION == 'upload'
+    if upload and not os.path.isdir(args.LOCAL):
+        sys.stderr.write(f'local folder does not exist: {args.LOCAL}\n')
+        sys.exit(1)
+    
+    if upload:
+        part_size = args.part_size * MB if multipart_available() else None
+    else:
+        part_size = args.part_size * MB
+    
+    try:
+        total, failed = sync(args.LOCAL, str(args.REMOTE), upload, args.dry_run,
+                             args.checksum, args.threads, part_size, args.verify)
+    except ValueError as err:
+        sys.stderr.write(err.args[0] + '\n')
+        sys.exit(1)
+    
+    if not args.dry_run:
+        report_batch(total, failed, f'{args.DIRECTION}ed')
@@ -0,0 +1,126 @@
+
+import os
+import threading
+import time
+
+# how far latency can rise above the fastest recent calls before we back off
+LATENCY_FACTOR = 4
+
+class Throttle:
+    ''' limit the rate and concurrency of API calls, shared across the process
+    
+    If a rate is given, calls take a token from a bucket which refills at that
+    rate, so calls never exceed it (e.g. a known limit for the tenant). The
+    number of calls in flight is adjusted AIMD-style: the limit grows by about
+    one for each limit's worth of successful calls, and halves when ICA rate
+    limits us (429/503), or shrinks a little when latency climbs well above
+    the fastest recent calls to the same endpoint (as a large listing is slower
+    than a delete, without any congestion). So bulk operations settle near the
+    most the tenant tolerates. A Retry-After from
+    ICA pauses every call until it passes.
+    
+    Args:
+        rate: most calls per second, or None for no fixed rate limit
+        burst: most calls which can start at once after a quiet period
+        concurrency: initial limit on calls in flight
+        max_concurrency: highest limit on calls in flight
+        min_concurrency: lowest limit on calls in flight
+    '''
+    def __init__(self, rate: float | None=None, burst: int=10,
+                 concurrency: int=8, max_concurrency: int=64,
+                 min_concurrency: int=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.refilled = time.monotonic()
+        self.limit = float(min(concurrency, max_concurrency))
+        self.max_limit = max_concurrency
+        self.min_limit = min_concurrency
+        self.active = 0
+        self.paused_until = 0.0
+        self.decreased = 0.0
+        self.baselines = {}
+        self.condition = threading.Condition()
+    
+    def refill(self, now: float):
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+    
+    def acquire(self):
+        ''' wait until a call can be made, then count it as in flight
+        '''
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.refill(now)
+                timeout = None
+                if now < self.paused_until:
+                    timeout = self.paused_until - now
+                elif self.active >= int(self.limit):
+                    timeout = None  # until a call finishes
+                elif self.rate is not None and self.tokens < 1:
+                    timeout = (1 - self.tokens) / self.rate
+                else:
+                    self.tokens -= self.rate is not None
+                    self.active += 1
+                    return
+                self.condition.wait(timeout)
+    
+    def decrease(self, factor: float, latency: float):
+        ''' shrink the concurrency limit, at most once per round trip, since
+        calls already in flight report the same congestion
+        '''
+        now = time.monotonic()
+        if now - self.decreased > latency:
+            self.limit = max(self.min_limit, self.limit * factor)
+            self.decreased = now
+    
+    def release(self, status: int | None, latency: float, pause: float=None,
+                endpoint: str=None):
+        ''' record how a call went, and adjust the limits
+        
+        Args:
+            status: HTTP status, or None if the request failed
+            latency: seconds the call took
+            pause: seconds to hold all calls for (e.g. from Retry-After)
+            endpoint: method and endpoint of the call (e.g. 'GET
+                /api/projects/{id}/data'), to compare its latency against
+                earlier calls to the same endpoint
+        '''
+        with self.condition:
+            self.active -= 1
+            if status in (429, 503):
+                self.decrease(0.5, latency)
+                if pause is not None:
+                    self.paused_until = max(self.paused_until, time.monotonic() + pause)
+            elif status is not None and status < 500:
+                # track the fastest recent calls, forgetting old ones slowly
+                baseline = self.baselines.get(endpoint, latency)
+                baseline = self.baselines[endpoint] = min(latency, baseline * 1.01)
+                if latency > max(LATENCY_FACTOR * baseline, 0.5):
+                    self.decrease(0.9, latency)
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+def get_float(name: str, default: float | None) -> float | None:
+    value = os.environ.get(name)
+    return float(value) if value else default
+
+_THROTTLE = None
+_THROTTLE_LOCK = threading.Lock()
+
+def get_throttle() -> Throttle:
+    ''' get the throttle shared by every API call in this process
+    
+    The limits can be set with ICA_MAX_RATE (calls per second, unlimited by
+    default) and ICA_MAX_CONCURRENCY (most calls in flight, default=64).
+    '''
+    global _THROTTLE
+    with _THROTTLE_LOCK:
+        if _THROTTLE is None:
+            rate = get_float('ICA_MAX_RATE', None)
+            max_concurrency = int(get_float('ICA_MAX_CONCURRENCY', 64))
+            _THROTTLE = Throttle(rate, max_concurrency=max_concurrency)
+    return _THROTTLE
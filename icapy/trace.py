@@ -0,0 +1,167 @@
+
+import json
+import re
+import sys
+import threading
+import time
+from typing import List
+from urllib.parse import urlsplit
+
+# patterns for IDs in API paths, so calls to the same endpoint can be grouped
+ID_PATTERNS = re.compile(r'(?<=/)((fil|fol)\.[0-9a-zA-Z]+|'
+                         r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-'
+                         r'[0-9a-fA-F]{4}-[0-9a-fA-F]{12})')
+
+def api_endpoint(url: str) -> str:
+    ''' get the endpoint of an API URL, with IDs replaced by '{id}'
+    '''
+    return ID_PATTERNS.sub('{id}', urlsplit(url).path)
+
+def percentile(values: List[float], pct: float) -> float:
+    ''' get a percentile (0-100) from sorted values, by the nearest rank
+    '''
+    if len(values) == 0:
+        return 0.0
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+class Tracer:
+    ''' record API calls and transferred bytes, for tracing and progress
+    
+    Each request can be written as a JSON line to a trace file, with the
+    endpoint, status, latency, bytes and retries. Transfers report the bytes
+    they move, for a live progress display, and a summary at the end.
+    
+    Args:
+        path: file to write JSON lines to, or None to only keep totals
+        progress: whether to show transfer progress on stderr
+        interval: seconds between progress updates
+    '''
+    def __init__(self, path: str=None, progress: bool=False, interval: float=0.5):
+        self.lock = threading.Lock()
+        self.handle = open(path, 'w', buffering=1) if path is not None else None
+        self.started = time.perf_counter()
+        self.latencies = {}
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.transferred = 0
+        self.done = threading.Event()
+        self.display = None
+        self.shown = False
+        if progress:
+            self.display = threading.Thread(target=self.show_progress,
+                                            args=(interval, ), daemon=True)
+            self.display.start()
+    
+    def record(self, method: str, url: str, status: int | None, latency: float,
+               sent: int=0, received: int=0, retries: int=0, api: bool=True):
+        ''' record a single HTTP request (including any retries)
+        '''
+        parts = urlsplit(url)
+        # presigned URLs have credentials in the query, so only keep the path
+        if api:
+            endpoint = api_endpoint(url)
+        else:
+            endpoint = f'{parts.netloc} (presigned)'
+        with self.lock:
+            self.calls += 1
+            self.errors += status is None or status >= 400
+            self.retries += retries
+            self.latencies.setdefault(f'{method} {endpoint}', []).append(latency)
+            if self.handle is not None:
+                self.handle.write(json.dumps({
+                    'time': time.time(),
+                    'method': method,
+                    'endpoint': endpoint,
+                    'path': parts.path,
+                    'status': status,
+                    'latency': round(latency, 6),
+                    'sent': sent,
+                    'received': received,
+                    'retries': retries,
+                }) + '\n')
+    
+    def add_bytes(self, size: int):
+        ''' count bytes moved by a transfer (downloads or uploads)
+        '''
+        with self.lock:
+            self.transferred += size
+    
+    def rate(self) -> float:
+        ''' get the transfer rate so far, in MB per second
+        '''
+        elapsed = time.perf_counter() - self.started
+        return self.transferred / (1024 * 1024) / max(elapsed, 1e-9)
+    
+    def show_progress(self, interval: float):
+        ''' write the transfer progress to stderr until stopped
+        '''
+        while not self.done.wait(interval):
+            if self.transferred == 0:
+                continue
+            sys.stderr.write(f'\r{self.transferred / (1024 * 1024):.1f} MB '
+                             f'({self.rate():.1f} MB/s), {self.calls} calls')
+            sys.stderr.flush()
+            self.shown = True
+    
+    def transfer_summary(self) -> str:
+        return f'transferred {self.transferred / (1024 * 1024):.1f} MB ' \
+               f'at {self.rate():.1f} MB/s'
+    
+    def summary(self) -> List[str]:
+        ''' get lines summarising calls (by endpoint) and transfer speed
+        '''
+        elapsed = time.perf_counter() - self.started
+        everything = sorted(x for v in self.latencies.values() for x in v)
+        lines = [f'{self.calls} calls ({self.errors} errors, {self.retries} retries) '
+                 f'in {elapsed:.2f} s, latency p50={percentile(everything, 50) * 1000:.0f} ms '
+                 f'p95={percentile(everything, 95) * 1000:.0f} ms']
+        if self.transferred > 0:
+            lines.append(self.transfer_summary())
+        # show the endpoints which took the most time first
+        for endpoint, values in sorted(self.latencies.items(), key=lambda x: -sum(x[1])):
+            values = sorted(values)
+            lines.append(f'  {endpoint}: {len(values)} calls, '
+                         f'{sum(values):.2f} s total, '
+                         f'p50={percentile(values, 50) * 1000:.0f} ms '
+                         f'p95={percentile(values, 95) * 1000:.0f} ms')
+        return lines
+    
+    def close(self):
+        ''' stop the progress display, and write a summary to stderr
+        '''
+        self.done.set()
+        if self.display is not None:
+            self.display.join()
+            if self.shown:
+                sys.stderr.write('\n')
+        if self.handle is not None:
+            self.handle.close()
+            lines = self.summary()
+        else:
+            # only show progress, without the call details
+            lines = [self.transfer_summary()] if self.transferred > 0 else []
+        if len(lines) > 0:
+            sys.stderr.write('\n'.join(lines) + '\n')
+
+_TRACER = None
+
+def start_tracing(path: str=None, progress: bool=False) -> Tracer:
+    ''' start recording API calls (e.g. for --trace), and transfer progress
+    '''
+    global _TRACER
+    _TRACER = Tracer(path, progress)
+    return _TRACER
+
+def stop_tracing():
+    ''' stop tracing, and write the summary to stderr
+    '''
+    global _TRACER
+    if _TRACER is not None:
+        _TRACER.close()
+    _TRACER = None
+
+def get_tracer() -> Tracer | None:
+    ''' get the active tracer, or None if tracing is off
+    '''
+    return _TRACER
@@ -0,0 +1,372 @@
+
+import base64
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import functools
+import hashlib
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+
+import requests
+
+from icapy.checksum import StreamHasher, clean_etag, multipart_etag
+from icapy.client import get_client
+from icapy.trace import get_tracer
+
+MB = 1024 * 1024
+
+def split_ranges(size: int, part_size: int) -> List[Tuple[int, int]]:
+    ''' split an object into byte ranges, as (start, end) with inclusive ends
+    '''
+    return [(start, min(start + part_size, size) - 1)
+            for start in range(0, size, part_size)]
+
+def get_range_total(r: requests.Response) -> int | None:
+    ''' get the full object size from a Content-Range header (if given)
+    '''
+    total = r.headers.get('Content-Range', '').rpartition('/')[2]
+    return int(total) if total.isdigit() else None
+
+def check_size(total: int | None, size: int):
+    ''' check the size of an object on the server matches the expected size
+    
+    The expected size comes from ICA's details, which could be out of date, and
+    downloading with the wrong size would silently truncate or pad the data.
+    '''
+    if total is not None and total != size:
+        raise ValueError(f'expected {size} bytes, but the server has {total} '
+                         'bytes (the data may have changed, try again)')
+
+def check_empty(url: str):
+    ''' check that an object expected to be empty has no data
+    
+    Empty objects can't be fetched with byte ranges, so this checks the length
+    of a plain request instead.
+    '''
+    r = get_client().fetch('GET', url, stream=True)
+    r.close()
+    length = r.headers.get('Content-Length')
+    check_size(int(length) if length is not None else None, 0)
+
+def read_range(url: str, start: int, end: int,
+               write: Callable[[int, bytes], None], retries: int=3,
+               size: int=None):
+    ''' stream a byte range from a URL, passing each chunk to a write function
+    
+    Args:
+        url: presigned URL to download from
+        start: position of first byte in the range
+        end: position of the last byte in the range (inclusive)
+        write: function called with (offset, chunk) for every chunk received
+        retries: number of times to resume if the connection drops partway
+        size: expected size of the whole object, to check against the server's
+    '''
+    client = get_client()
+    tracer = get_tracer()
+    offset = start
+    for attempt in range(retries + 1):
+        try:
+            headers = {'Range': f'bytes={offset}-{end}'}
+            r = client.fetch('GET', url, headers=headers, stream=True)
+            if r.status_code != 206:
+                raise ValueError('server does not support byte range requests')
+            if size is not None and get_range_total(r) not in (None, size):
+                r.close()
+                check_size(get_range_total(r), size)
+            for chunk in r.iter_content(MB):
+                write(offset, chunk)
+                offset += len(chunk)
+                if tracer is not None:
+                    tracer.add_bytes(len(chunk))
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError):
+            if attempt == retries:
+                raise
+        if offset > end:
+            return
+    raise IOError(f'incomplete download of byte range {start}-{end}')
+
+def fetch_range(url: str, start: int, end: int, size: int=None) -> bytearray:
+    ''' get a byte range (with an inclusive end) from a URL, held in memory
+    
+    If the expected size of the whole object is given, this is checked too.
+    '''
+    buf = bytearray(end - start + 1)
+    def write(offset, chunk):
+        buf[offset - start:offset - start + len(chunk)] = chunk
+    read_range(url, start, end, write, size=size)
+    return buf
+
+def download_to_file(url: str, size: int, path: Path | str, threads: int=8,
+                     part_size: int=32 * MB, checksum: bool=False,
+                     etag: str=None) -> Dict[str, str] | None:
+    ''' download a URL into a local file, fetching byte ranges concurrently
+    
+    The output file is preallocated to the full size, and each range is written
+    directly into place with positional writes, so the ranges can complete in
+    any order. Each response is checked against the expected size.
+    
+    Args:
+        url: presigned URL to download from
+        size: size of the object in bytes
+        path: local path to write to
+        threads: number of concurrent connections
+        part_size: size of each byte range
+        checksum: whether to compute checksums while downloading
+        etag: ETag of the object on ICA, to pick which checksums to compute
+    
+    Returns:
+        checksums from StreamHasher.result() if requested, otherwise None
+    '''
+    if size == 0:
+        check_empty(url)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    hasher = None
+    try:
+        os.ftruncate(fd, size)
+        if checksum:
+            # chunks are hashed in order as they complete, reading back from
+            # the file if they arrive too far ahead
+            hasher = StreamHasher(size, etag, fd)
+        
+        def write(offset, chunk):
+            start = offset
+            view = memoryview(chunk)
+            while len(view) > 0:
+                written = os.pwrite(fd, view, offset)
+                view = view[written:]
+                offset += written
+            if hasher is not None:
+                hasher.feed(start, chunk)
+        
+        with ThreadPoolExecutor(threads) as pool:
+            jobs = [pool.submit(read_range, url, start, end, write, size=size)
+                    for start, end in split_ranges(size, part_size)]
+            try:
+                for job in as_completed(jobs):
+                    job.result()
+            except BaseException:
+                pool.shutdown(cancel_futures=True)
+                raise
+        return hasher.result() if hasher is not None else None
+    finally:
+        if hasher is not None:
+            hasher.close()
+        os.close(fd)
+
+def stream_ranges(url: str, size: int, threads: int=8,
+                  part_size: int=32 * MB) -> Iterable[bytearray]:
+    ''' yield the contents of a URL in order, while fetching ranges concurrently
+    
+    Ranges are fetched ahead of the consumer, but at most `threads` ranges are
+    in flight (or waiting to be consumed) at once, which bounds memory use.
+    Each response is checked against the expected size.
+    '''
+    if size == 0:
+        check_empty(url)
+    with ThreadPoolExecutor(threads) as pool:
+        pending = deque()
+        try:
+            for start, end in split_ranges(size, part_size):
+                pending.append(pool.submit(fetch_range, url, start, end, size))
+                if len(pending) >= threads:
+                    yield pending.popleft().result()
+            while len(pending) > 0:
+                yield pending.popleft().result()
+        finally:
+            # stop fetching if the consumer exits early (e.g. broken pipe)
+            for job in pending:
+                job.cancel()
+
+# S3 limits on uploads
+MIN_PART_SIZE = 5 * MB
+MAX_PART_SIZE = 5 * 1024 * MB
+MAX_PARTS = 10000
+MAX_SINGLE_UPLOAD = 5 * 1024 * MB
+
+# double the part size after this many parts for streams of unknown length, so
+# the parts reach S3's 5 TB object limit before running out
+PART_GROWTH_INTERVAL = 1000
+
+def multipart_available() -> bool:
+    ''' check if multipart uploads are possible (these need boto3 installed)
+    '''
+    try:
+        import boto3
+    except ImportError:
+        return False
+    return True
+
+def get_part_size(size: int, part_size: int) -> int:
+    ''' adjust a part size to fit within the S3 limits on multipart uploads
+    '''
+    part_size = max(part_size, MIN_PART_SIZE)
+    while size > part_size * MAX_PARTS:
+        part_size *= 2
+    return part_size
+
+def read_part(handle, size: int) -> bytes:
+    ''' read up to `size` bytes from a stream, only stopping short at its end
+    '''
+    data = handle.read(size)
+    # unbuffered streams (e.g. pipes) can return less than asked for
+    while 0 < len(data) < size:
+        chunk = handle.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+def iter_parts(handle, part_size: int, grow_every: int=None) -> Iterator[bytes]:
+    ''' read a stream in parts (the last part may be smaller)
+    
+    Args:
+        handle: stream to read from
+        part_size: size of the first parts
+        grow_every: double the part size after this many parts (up to the S3
+            limit), for streams of unknown length. If None, parts are all
+            part_size.
+    '''
+    number = 0
+    while True:
+        data = read_part(handle, part_size)
+        if not data:
+            return
+        yield data
+        number += 1
+        if grow_every is not None and number % grow_every == 0:
+            part_size = min(part_size * 2, MAX_PART_SIZE)
+
+def multipart_upload(source: Path | str | Iterable[bytes], credentials: Dict[str, str],
+                     part_size: int=64 * MB, threads: int=8, retries: int=3,
+                     backoff: float=0.5) -> str:
+    ''' upload a local file or a stream in parts, using temporary AWS credentials
+    
+    Parts of local files are read with positional reads and uploaded
+    concurrently, so at most `threads` parts are held in memory at once. Streams
+    of unknown size (e.g. stdin) are read a part at a time, and reading waits
+    while `threads` parts are uploading, so memory use stays bounded however
+    long the stream is. A part that fails is retried on its own (with
+    exponential backoff), without restarting the other parts. Once every part
+    is uploaded the object is finalised, or the upload is aborted on failure.
+    
+    Each part is hashed before it is sent, and sent with its MD5 so S3 rejects
+    corrupted parts. The multipart ETag is computed from the part hashes, and
+    checked against the ETag of the finished object.
+    
+    Args:
+        source: path to local file, or the parts of a stream (see iter_parts).
+            Parts of a stream can differ in size, but only the last can be
+            smaller than 5 MB.
+        credentials: awsTempCredentials from ICA's createTemporaryCredentials
+        part_size: size of each part in bytes
+        threads: number of parts to upload concurrently
+        retries: number of times to retry each part
+        backoff: seconds to wait before the first retry of a part, doubling
+            with each later retry
+    
+    Returns:
+        ETag of the uploaded object
+    '''
+    try:
+        import boto3
+        from botocore.config import Config
+    except ImportError:
+        raise ValueError('multipart uploads require boto3, try: pip install icacli[multipart]')
+    
+    s3 = boto3.client('s3',
+                      aws_access_key_id=credentials['accessKey'],
+                      aws_secret_access_key=credentials['secretKey'],
+                      aws_session_token=credentials['sessionToken'],
+                      region_name=credentials['region'],
+                      config=Config(max_pool_connections=threads))
+    bucket = credentials['bucket']
+    key = credentials['objectPrefix']
+    
+    extra = {}
+    if credentials.get('serverSideEncryptionAlgorithm'):
+        extra['ServerSideEncryption'] = credentials['serverSideEncryptionAlgorithm']
+    if credentials.get('serverSideEncryptionKey'):
+        extra['SSEKMSKeyId'] = credentials['serverSideEncryptionKey']
+    
+    fd = None
+    if isinstance(source, (str, Path)):
+        size = os.path.getsize(source)
+        part_size = get_part_size(size, part_size)
+        fd = os.open(source, os.O_RDONLY)
+        # local parts are only read once a thread is free to upload them
+        parts = (functools.partial(os.pread, fd, end - start + 1, start)
+                 for start, end in split_ranges(size, part_size))
+    else:
+        parts = (lambda body=body: body for body in source)
+    
+    try:
+        upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key, **extra)['UploadId']
+    except BaseException:
+        if fd is not None:
+            os.close(fd)
+        raise
+    
+    tracer = get_tracer()
+    def upload_part(number, read):
+        body = read()
+        digest = hashlib.md5(body).digest()
+        for attempt in range(retries + 1):
+            began = time.perf_counter()
+            try:
+                r = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+                                   PartNumber=number, Body=body,
+                                   ContentMD5=base64.b64encode(digest).decode('ascii'))
+            except Exception:
+                if tracer is not None:
+                    tracer.record('PUT', f's3://{bucket}/{key}', None,
+                                  time.perf_counter() - began, api=False)
+                if attempt == retries:
+                    raise
+                time.sleep(backoff * 2 ** attempt)
+                continue
+            if tracer is not None:
+                tracer.record('PUT', f's3://{bucket}/{key}', 200,
+                              time.perf_counter() - began, sent=len(body),
+                              retries=attempt, api=False)
+                tracer.add_bytes(len(body))
+            return {'PartNumber': number, 'ETag': r['ETag']}, digest
+    
+    source_name = source if fd is not None else 'stream'
+    try:
+        with ThreadPoolExecutor(threads) as pool:
+            slots = threading.Semaphore(threads)
+            jobs = []
+            try:
+                for number, read in enumerate(parts, start=1):
+                    if number > MAX_PARTS:
+                        raise ValueError(f'too many parts to upload {source_name}, '
+                                         'try a larger --part-size')
+                    slots.acquire()
+                    if any(x.done() and x.exception() for x in jobs[-threads:]):
+                        break
+                    jobs.append(pool.submit(upload_part, number, read))
+                    jobs[-1].add_done_callback(lambda _: slots.release())
+                parts, digests = zip(*[job.result() for job in jobs])
+            except BaseException:
+                pool.shutdown(cancel_futures=True)
+                raise
+        r = s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                         MultipartUpload={'Parts': list(parts)})
+    except BaseException:
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+    finally:
+        if fd is not None:
+            os.close(fd)
+    
+    etag = multipart_etag(digests)
+    # objects encrypted with KMS keys have ETags which aren't MD5-based
+    if extra.get('ServerSideEncryption') != 'aws:kms' and \
+            clean_etag(r.get('ETag')) not in ('', etag):
+        raise ValueError(f'checksum mismatch after uploading {source_name}: '
+                         f'expected ETag {etag}, got {clean_etag(r["ETag"])}')
+    return etag